@@ -0,0 +1,269 @@
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from prometheus_client import Counter, Gauge
+
+from aifriend.config import var, log
+
+REJECTED_REQUESTS = Counter('aifriend_api_rejected_requests_total', 'Number of requests rejected at admission',
+                            labelnames=('reason',))
+ESTIMATED_QUEUE_WAIT = Gauge('aifriend_api_estimated_queue_wait_seconds',
+                             'Queue wait estimated from the queue depth and the recent service time')
+
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter per client. Buckets are kept in the process memory
+    or in the result backend Redis to share the limits between API processes.
+
+    Parameters
+    ----------
+    rate : float, default=ENV(RATE_LIMIT) or 0
+        Tokens added to a bucket per second, zero disables the limiter.
+    burst : float, default=ENV(RATE_LIMIT_BURST) or 10
+        Bucket capacity.
+    backend : {'memory', 'redis'}, default=ENV(RATE_LIMIT_BACKEND) or 'memory'
+        Buckets storage.
+
+    """
+
+    KEY_PREFIX = 'aifriend-rate-limit-'
+
+    def __init__(self,
+                 rate: float = var.RATE_LIMIT,
+                 burst: float = var.RATE_LIMIT_BURST,
+                 backend: str = var.RATE_LIMIT_BACKEND):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.backend = backend
+        self.buckets: Dict[str, Tuple[float, float]] = dict()
+        self.lock = threading.Lock()
+        self.script = None
+
+    def _acquire_redis(self, client_id: str) -> Optional[float]:
+        from aifriend.app.api.backend.results import get_redis
+
+        if (client := get_redis()) is None:
+            return None
+
+        if self.script is None:
+            self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+        return float(self.script(keys=[self.KEY_PREFIX + client_id], args=[self.rate, self.burst, time.time()]))
+
+    def _acquire_memory(self, client_id: str) -> float:
+        now = time.monotonic()
+
+        with self.lock:
+            tokens, updated = self.buckets.get(client_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+            if tokens >= 1:
+                self.buckets[client_id] = (tokens - 1, now)
+                return 0.0
+
+            self.buckets[client_id] = (tokens, now)
+
+            if len(self.buckets) > 10000:
+                idle = now - self.burst / self.rate
+                self.buckets = {key: value for key, value in self.buckets.items() if value[1] > idle}
+
+        return (1 - tokens) / self.rate
+
+    def acquire(self, client_id: str) -> float:
+        """
+        Take a token from the client bucket.
+
+        Parameters
+        ----------
+        client_id : str
+            Client identifier.
+
+        Returns
+        -------
+        float:
+            Zero if the token is taken or the time in seconds until a token is available.
+
+        """
+
+        if self.rate <= 0:
+            return 0.0
+
+        if self.backend == 'redis':
+            try:
+                if (wait := self._acquire_redis(client_id)) is not None:
+                    return wait
+            except Exception as e:
+                log.project_logger.warning(f'Redis rate limiter is unavailable, using in-process buckets: {e}')
+
+        return self._acquire_memory(client_id)
+
+
+class QueueWaitEstimator:
+    """
+    Estimate the queue wait of a new task as the number of queued tasks times the recent service time
+    divided by the number of consumers. The queue depths are read from the broker at most once per refresh period,
+    the service time is an exponential moving average of the observed task durations.
+
+    A request is admitted before it is routed, so the tasks are counted over all the queues it could land on:
+    the shared queues and, with sticky routing, the direct queues of the workers. The consumers are counted
+    on the shared queues only, since every worker also consumes its own direct queue.
+
+    Parameters
+    ----------
+    queues : Optional[List[str]], default=None
+        Shared queue names, ENV(CELERY_QUEUE) and the queues of the models in ENV(MODELS) if None.
+    service_time : float, default=ENV(SHED_SERVICE_TIME) or 10
+        Initial service time estimate in seconds.
+    refresh : float, default=ENV(SHED_REFRESH) or 1
+        The minimum delay in seconds between two broker requests.
+    alpha : float, default=0.2
+        Smoothing factor of the service time average.
+
+    """
+
+    def __init__(self,
+                 queues: Optional[List[str]] = None,
+                 service_time: float = var.SHED_SERVICE_TIME,
+                 refresh: float = var.SHED_REFRESH,
+                 alpha: float = 0.2):
+        self.queues = queues
+        self.service_time = service_time
+        self.refresh = refresh
+        self.alpha = alpha
+        self.depth = (0, 1)
+        self.updated = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        """ Update the service time average with a task duration in seconds. """
+
+        if seconds > 0:
+            self.service_time += self.alpha * (seconds - self.service_time)
+
+    def _queues(self) -> Tuple[List[str], List[str]]:
+        from aifriend.app.api.backend.affinity import sticky_router
+        from aifriend.app.api.backend.routing import model_queue
+        from celery.utils.nodenames import worker_direct
+
+        shared = self.queues or [var.CELERY_QUEUE, *map(model_queue, var.MODELS)]
+        direct = list()
+
+        if var.STICKY_ROUTING:
+            hostnames = {hostname for ring in sticky_router.rings.values() for hostname in ring.nodes}
+            direct = [worker_direct(hostname).name for hostname in sorted(hostnames)]
+
+        return shared, direct
+
+    def _read_depth(self) -> Tuple[int, int]:
+        from aifriend.app.api.backend.celeryapp import celery_app
+
+        shared, direct = self._queues()
+        total_messages, total_consumers = 0, 0
+
+        with celery_app.connection_for_write() as connection:
+            for queue in shared + direct:
+                # a missing queue closes the channel on RabbitMQ, so every queue is declared on its own channel
+                try:
+                    with connection.channel() as channel:
+                        _, messages, consumers = channel.queue_declare(queue=queue, passive=True)
+                except connection.channel_errors:
+                    continue
+
+                total_messages += messages
+                total_consumers += consumers if queue in shared else 0
+
+        return total_messages, max(total_consumers, 1)
+
+    def estimate(self) -> float:
+        """
+        Estimate the queue wait of a new task.
+
+        Returns
+        -------
+        float:
+            Estimated wait in seconds, zero if the queue depth is unknown.
+
+        """
+
+        now = time.monotonic()
+
+        if now - self.updated >= self.refresh and self.lock.acquire(blocking=False):
+            try:
+                self.depth = self._read_depth()
+            except Exception as e:
+                log.project_logger.warning(f'Queue depth is unavailable: {e}')
+                self.depth = (0, 1)
+            finally:
+                self.updated = now
+                self.lock.release()
+
+        messages, consumers = self.depth
+        wait = messages * self.service_time / consumers
+        ESTIMATED_QUEUE_WAIT.set(wait)
+
+        return wait
+
+
+rate_limiter = RateLimiter()
+wait_estimator = QueueWaitEstimator()
+
+
+def client_id(request: Request) -> str:
+    """ Identify the client by the 'X-API-Key' header or by the host address. """
+
+    if api_key := request.headers.get('x-api-key'):
+        return f'key:{api_key}'
+
+    return f'host:{request.client.host if request.client else "unknown"}'
+
+
+def admit(request: Request) -> None:
+    """
+    FastAPI dependency that rejects requests over the client rate limit with 429 status code
+    and sheds load with 503 status code if the estimated queue wait exceeds the budget.
+    Both responses have the 'Retry-After' header.
+
+    Parameters
+    ----------
+    request : Request
+        Client request information.
+
+    Raises
+    ------
+    HTTPException:
+        If the request is rejected.
+
+    """
+
+    if wait := rate_limiter.acquire(client_id(request)):
+        REJECTED_REQUESTS.labels(reason='rate_limit').inc()
+        raise HTTPException(status_code=429, detail='Too many requests',
+                            headers={'Retry-After': str(math.ceil(wait))})
+
+    if var.QUEUE_WAIT_BUDGET > 0 and (wait := wait_estimator.estimate()) > var.QUEUE_WAIT_BUDGET:
+        REJECTED_REQUESTS.labels(reason='overload').inc()
+        raise HTTPException(status_code=503, detail='The service is overloaded',
+                            headers={'Retry-After': str(math.ceil(wait - var.QUEUE_WAIT_BUDGET))})
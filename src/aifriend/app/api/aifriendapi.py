@@ -1,22 +1,40 @@
+import time
 from datetime import datetime
 from functools import wraps
 from http import HTTPStatus
-from typing import Dict, Callable
+from typing import Dict, Callable, Optional
+from uuid import uuid4
 
+from celery import states
 from celery.result import AsyncResult
-from fastapi import FastAPI, Request, Path
+from fastapi import FastAPI, Request, Path, Query, Header, Depends
+from fastapi.responses import PlainTextResponse
 from prometheus_fastapi_instrumentator import Instrumentator
 from prometheus_fastapi_instrumentator.metrics import latency
 
+from aifriend.app.api.admission import admit, wait_estimator
+from aifriend.app.api.backend.affinity import conversation_key, sticky_router
 from aifriend.app.api.backend.celeryapp import celery_app
+from aifriend.app.api.backend.idempotency import claim, fingerprint, forget_task, release
+from aifriend.app.api.backend.results import consume_result, get_result, get_results, start_compaction
+from aifriend.app.api.backend.routing import model_queue, route
+from aifriend.app.api.backend.scheduling import length_predictor
 from aifriend.app.api.backend.tasks import predict
-from aifriend.app.api.schemas import HumanMessage, TalkResponse, BaseResponse, AIMessage
-from aifriend.config import log
+from aifriend.app.api.schemas import (
+    GenerationParameters,
+    HumanMessage,
+    TalkResponse,
+    BaseResponse,
+    AIMessage,
+    StatusBatchRequest,
+    StatusBatchResponse
+)
+from aifriend.config import var, log
 
 api = FastAPI(title='AIfriendAPI', description='API for falcon-7b-instruct model')
 
 instrumentator = Instrumentator().instrument(api).expose(api)
-instrumentator.add(latency(buckets=(1, 2, 3, 4, 5, 6, 7, 8, 9, 10,)))
+instrumentator.add(latency(buckets=var.FASTAPI_LATENCY_BUCKETS))
 
 
 @api.on_event('startup')
@@ -24,6 +42,8 @@ def startup() -> None:
     """ API startup handler. """
 
     log.project_logger.info('FatAPI launched')
+    start_compaction()
+    sticky_router.start()
 
 
 def construct_response(handler: Callable[..., Dict]) -> Callable[..., Dict]:
@@ -70,6 +90,60 @@ def construct_response(handler: Callable[..., Dict]) -> Callable[..., Dict]:
     return wrap
 
 
+def task_response(task_id: str, meta: Dict) -> Dict:
+    """
+    Build the status response fields of a task.
+
+    Parameters
+    ----------
+    task_id : str
+        Celery task id.
+    meta : Dict
+        Task meta with 'status' and 'result' fields.
+
+    Returns
+    -------
+    response : Dict
+        Status, status code and either the generated message, updated history and timings,
+        the error description or the current task state.
+
+    """
+
+    if meta['status'] in states.PROPAGATE_STATES:
+        response = {
+            'status': str(meta['result']),
+            'status_code': HTTPStatus.CONFLICT
+        }
+
+    elif meta['status'] == states.SUCCESS:
+        message, history, *extra = meta['result']
+
+        response = {
+            'status': HTTPStatus.OK.phrase,
+            'status_code': HTTPStatus.OK,
+            'message': message,
+            'history': history,
+        }
+
+        if len(extra) > 1 and 'generated_tokens' in (usage := extra[1]):
+            length_predictor.observe(task_id, usage['generated_tokens'])
+
+        if extra:
+            timings = extra[0]
+            response['timings'] = {**timings, 'fetched': time.time()}
+
+            if 'postprocessed' in timings and (started := timings.get('loaded', timings.get('dequeued'))):
+                wait_estimator.observe(timings['postprocessed'] - started)
+    else:
+        response = {
+            'status': HTTPStatus.PROCESSING.phrase,
+            'status_code': HTTPStatus.PROCESSING,
+            'state': meta['status'],
+        }
+
+    return response
+
+
 @api.get('/', tags=['General'])
 @construct_response
 def index(request: Request) -> Dict:
@@ -94,9 +168,12 @@ def index(request: Request) -> Dict:
     }
 
 
-@api.post('/talk', tags=['Prediction'], response_model=TalkResponse)
+@api.post('/talk', tags=['Prediction'], response_model=TalkResponse, dependencies=[Depends(admit)])
 @construct_response
-def talk(request: Request, payload: HumanMessage) -> Dict:
+def talk(request: Request,
+         payload: HumanMessage,
+         idempotency_key: Optional[str] = Header(None, min_length=1, max_length=255)
+         ) -> Dict:
     """
     Talk to AI friend.
 
@@ -105,21 +182,70 @@ def talk(request: Request, payload: HumanMessage) -> Dict:
     request : Request
         Client request information.
     payload : HumanMessage
-        Message for conversation.
+        Message for conversation and optional generation parameters.
+    idempotency_key : Optional[str]
+        Key from the 'Idempotency-Key' header (or the 'idempotency_key' payload field) that identifies retries
+        of the same request: a retry gets the id of the task published for the first request.
 
     Returns
     -------
     response : TalkResponse
-        Response containing the id of the celery task in the 'task_id' field.
+        Response containing the id of the celery task in the 'task_id' field,
+        the token limit capped by the server in the 'max_new_tokens' field
+        and the model chosen by the routing policy (if several models are served) in the 'model' field.
 
     """
 
-    task = predict.delay(payload.message, payload.history)
+    key = idempotency_key or payload.idempotency_key
+    task_id, duplicate = str(uuid4()), False
+    max_new_tokens = min(payload.max_new_tokens or var.MAX_NEW_TOKENS, var.MAX_NEW_TOKENS)
+    parameters = {**payload.dict(include=set(GenerationParameters.__fields__), exclude_none=True),
+                  'max_new_tokens': max_new_tokens}
+    model = route(payload.message, payload.history)
+
+    if key:
+        try:
+            task_id, duplicate = claim(key, task_id, fingerprint(payload.message, payload.history, parameters))
+        except ValueError as e:
+            return {
+                'status': str(e),
+                'status_code': HTTPStatus.UNPROCESSABLE_ENTITY
+            }
+
+    if not duplicate:
+        try:
+            options = dict()
+
+            if var.SJF_SCHEDULING:
+                options['priority'] = length_predictor.priority(task_id, payload.message, payload.history,
+                                                                max_new_tokens)
+
+            queue = model_queue(model) if model else var.CELERY_QUEUE
+            # the derived key only spreads conversations over the workers: different conversations opening
+            # with the same message share it, so it must not key the per-conversation state of the worker
+            routing_key = payload.conversation_id or conversation_key(payload.message, payload.history)
+
+            if var.STICKY_ROUTING and (direct_queue := sticky_router.route(routing_key, queue)) is not None:
+                # the shared queue lets the router hand the task over if the worker leaves before taking it
+                options.update(queue=direct_queue, headers={'shared_queue': queue})
+            elif model:
+                options['queue'] = queue
+
+            predict.apply_async((payload.message, payload.history),
+                                {**parameters, 'conversation_id': payload.conversation_id},
+                                task_id=task_id, **options)
+        except Exception:
+            if key:
+                release(key)
+            raise
 
     response = {
         'status': HTTPStatus.ACCEPTED.phrase,
         'status_code': HTTPStatus.ACCEPTED,
-        'task_id': task.id
+        'task_id': task_id,
+        'duplicate': duplicate,
+        'max_new_tokens': max_new_tokens,
+        'model': model
     }
 
     return response
@@ -130,7 +256,8 @@ def talk(request: Request, payload: HumanMessage) -> Dict:
 def status(request: Request,
            task_id: str = Path(...,
                                title='The ID of the task to get status',
-                               regex=r'[a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12}')
+                               regex=r'[a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12}'),
+           consume: bool = Query(False, description='Delete the result once it is returned')
            ) -> Dict:
     """
     Get a celery task status.
@@ -141,37 +268,59 @@ def status(request: Request,
         Client request information.
     task_id : str
         Celery task id.
+    consume : bool
+        Delete the result in the same backend request if the task is finished,
+        so that no separate DELETE request is needed.
 
     Returns
     -------
     response : AIMessage
-        Response containing the result of text generation in the 'message' field and updated history in 'history' field.
+        Response containing the result of text generation in the 'message' field, updated history in 'history' field
+        and processing stages timestamps in 'timings' field.
 
     """
 
-    task = AsyncResult(task_id, app=celery_app)
+    meta = consume_result(task_id) if consume else get_result(task_id)
 
-    if task.failed():
-        response = {
-            'status': str(task.info),
-            'status_code': HTTPStatus.CONFLICT
-        }
+    if consume and meta['status'] in states.READY_STATES:
+        forget_task(task_id)
 
-    elif task.ready():
-        message, history = task.get()
+    return task_response(task_id, meta)
 
-        response = {
-            'status': HTTPStatus.OK.phrase,
-            'status_code': HTTPStatus.OK,
-            'message': message,
-            'history': history,
-        }
-    else:
-        response = {
-            'status': HTTPStatus.PROCESSING.phrase,
-            'status_code': HTTPStatus.PROCESSING,
-            'state': task.status,
-        }
+
+@api.post('/status/batch', tags=['Prediction'], response_model=StatusBatchResponse)
+@construct_response
+def status_batch(request: Request, payload: StatusBatchRequest) -> Dict:
+    """
+    Get the status of many celery tasks with a single backend request.
+
+    Parameters
+    ----------
+    request : Request
+        Client request information.
+    payload : StatusBatchRequest
+        Task ids and the flag to delete the results of the finished tasks.
+
+    Returns
+    -------
+    response : StatusBatchResponse
+        Response containing the per-task statuses in the order of the task ids in the 'tasks' field.
+
+    """
+
+    metas = get_results(payload.task_ids, consume=payload.consume)
+
+    if payload.consume:
+        for task_id, meta in zip(payload.task_ids, metas):
+            if meta['status'] in states.READY_STATES:
+                forget_task(task_id)
+
+    response = {
+        'status': HTTPStatus.OK.phrase,
+        'status_code': HTTPStatus.OK,
+        'tasks': [{'task_id': task_id, **task_response(task_id, meta)}
+                  for task_id, meta in zip(payload.task_ids, metas)]
+    }
 
     return response
 
@@ -207,9 +356,43 @@ def delete_prediction(request: Request,
     else:
         task.revoke(terminate=True)
 
+    forget_task(task_id)
+
     response = {
         'status': HTTPStatus.OK.phrase,
         'status_code': HTTPStatus.OK
     }
 
     return response
+
+
+@api.get('/debug/profile', tags=['Debug'], response_class=PlainTextResponse)
+def debug_profile(seconds: float = Query(5, gt=0, le=60, description='Sampling duration in seconds'),
+                  x_admin_token: Optional[str] = Header(None)
+                  ) -> PlainTextResponse:
+    """
+    Sample the stacks of the API process threads. Available only if the ADMIN_TOKEN environment variable is set
+    and the same token is passed in the 'X-Admin-Token' header.
+
+    Parameters
+    ----------
+    seconds : float
+        Sampling duration in seconds.
+    x_admin_token : Optional[str]
+        Admin token.
+
+    Returns
+    -------
+    response : PlainTextResponse
+        Stack samples in the folded format that can be rendered with flamegraph tools.
+
+    """
+
+    import secrets
+
+    from aifriend.utils.profiling import sample_stacks
+
+    if not var.ADMIN_TOKEN or not secrets.compare_digest(x_admin_token or '', var.ADMIN_TOKEN):
+        return PlainTextResponse(HTTPStatus.FORBIDDEN.phrase, status_code=HTTPStatus.FORBIDDEN)
+
+    return PlainTextResponse(sample_stacks(seconds))
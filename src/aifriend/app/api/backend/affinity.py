@@ -0,0 +1,300 @@
+import bisect
+import hashlib
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+from aifriend.app.api.backend.celeryapp import celery_app
+from aifriend.config import var, log
+
+STICKY_ROUTES = Counter('aifriend_api_sticky_routes_total', 'Number of talk requests by the sticky routing outcome',
+                        labelnames=('result',))
+STICKY_WORKERS = Gauge('aifriend_api_sticky_workers', 'Number of live workers in the sticky routing rings')
+HANDED_OVER_TASKS = Counter('aifriend_api_handed_over_tasks_total',
+                            'Number of tasks moved from the direct queues of departed workers to the shared queues')
+
+
+def key_hash(key: str) -> int:
+    """ Hash a key onto the ring. """
+
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+def conversation_key(message: str, history: List[Dict[str, Any]]) -> str:
+    """
+    Get the routing key of a conversation without an explicit id from its first human message,
+    which stays at the head of the history on the next turns. Conversations that open with the same message
+    share the key, so it is only used to choose the worker and not passed to the task as the conversation id.
+
+    Parameters
+    ----------
+    message : str
+        Human message.
+    history : List[Dict[str, Any]]
+        Chat history.
+
+    Returns
+    -------
+    str:
+        Routing key.
+
+    """
+
+    first = next((m.get('data', {}).get('content', '') for m in history if m.get('type') == 'human'), message)
+
+    return hashlib.sha256(str(first).encode()).hexdigest()[:32]
+
+
+class HashRing:
+    """
+    Consistent hashing ring of worker hostnames: when a worker joins or leaves,
+    only the conversations of its ring segments move to other workers.
+
+    Parameters
+    ----------
+    nodes : Iterable[str], default=()
+        Worker hostnames.
+    vnodes : int, default=ENV(STICKY_VNODES) or 64
+        The number of ring points per worker, more points spread the conversations more evenly.
+
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = var.STICKY_VNODES):
+        self.nodes = sorted(set(nodes))
+        self.points = sorted((key_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in self.points]
+
+    def node(self, key: str) -> Optional[str]:
+        """ Get the worker hostname of the key or None if the ring is empty. """
+
+        if not self.points:
+            return None
+
+        return self.points[bisect.bisect(self.hashes, key_hash(key)) % len(self.points)][1]
+
+
+class StickyRouter:
+    """
+    Route the tasks of a conversation to the direct queue of the same worker, chosen by consistent hashing
+    over the live workers that consume the shared queue, so that the per-conversation state of the worker
+    is reused on the next turns. Tasks spill to the shared queue if the direct queue of the worker is backlogged.
+
+    Worker membership is refreshed in the background with a broadcast, queue depths are read
+    from the broker at most once per depth refresh period and counted locally in between.
+
+    When a worker leaves the rings (it stopped, or was drained by a scale down), the tasks left in its direct queue
+    are moved back to the shared queue they were routed from, so that the other workers process them.
+    A hot reload keeps the worker hostname, so the new worker consumes the direct queue of the old one instead.
+    The direct queues of the workers that left before the router started are not known to it and keep their tasks
+    until a worker with the same hostname comes back.
+
+    Parameters
+    ----------
+    refresh : float, default=ENV(STICKY_REFRESH) or 10
+        Delay in seconds between two worker membership updates.
+    max_backlog : int, default=ENV(STICKY_MAX_BACKLOG) or 2
+        The number of tasks waiting in the direct queue of a worker above which the tasks spill.
+    vnodes : int, default=ENV(STICKY_VNODES) or 64
+        The number of ring points per worker.
+    depth_refresh : float, default=1
+        The minimum delay in seconds between two depth requests of a direct queue.
+
+    """
+
+    def __init__(self,
+                 refresh: float = var.STICKY_REFRESH,
+                 max_backlog: int = var.STICKY_MAX_BACKLOG,
+                 vnodes: int = var.STICKY_VNODES,
+                 depth_refresh: float = 1):
+        self.refresh = refresh
+        self.max_backlog = max_backlog
+        self.vnodes = vnodes
+        self.depth_refresh = depth_refresh
+        self.rings: Dict[str, HashRing] = dict()
+        self.depths: Dict[str, Tuple[int, float]] = dict()
+        self.lock = threading.Lock()
+
+    def update(self, timeout: float = 1) -> None:
+        """ Rebuild the rings from the queues the live workers consume. """
+
+        from celery.utils.nodenames import WORKER_DIRECT_QUEUE_FORMAT
+
+        replies = celery_app.control.inspect(timeout=timeout).active_queues() or dict()
+        direct_suffix = WORKER_DIRECT_QUEUE_FORMAT.format(hostname='')
+        consumers: Dict[str, List[str]] = dict()
+
+        for hostname, queues in replies.items():
+            if WORKER_DIRECT_QUEUE_FORMAT.format(hostname=hostname) not in {q['name'] for q in queues}:
+                continue
+
+            for queue in queues:
+                if not queue['name'].endswith(direct_suffix):
+                    consumers.setdefault(queue['name'], list()).append(hostname)
+
+        rings = {queue: HashRing(nodes, vnodes=self.vnodes) for queue, nodes in consumers.items()}
+
+        with self.lock:
+            for queue in rings.keys() | self.rings.keys():
+                if rings.get(queue, HashRing()).nodes != self.rings.get(queue, HashRing()).nodes:
+                    log.project_logger.info(f"Sticky routing workers of '{queue}': "
+                                            f"{', '.join(rings[queue].nodes) if queue in rings else 'none'}")
+
+            hostnames = {hostname for ring in rings.values() for hostname in ring.nodes}
+            departed = {hostname: queue for queue, ring in self.rings.items() for hostname in ring.nodes
+                        if hostname not in hostnames}
+            self.rings = rings
+
+            for hostname in departed:
+                self.depths.pop(hostname, None)
+
+        STICKY_WORKERS.set(len(hostnames))
+
+        for hostname, queue in departed.items():
+            try:
+                self.hand_over(hostname, queue)
+            except Exception as e:
+                log.project_logger.warning(f'Direct queue of {hostname} could not be handed over: {e}')
+
+    @staticmethod
+    def hand_over(hostname: str, queue: str) -> int:
+        """
+        Move the tasks waiting in the direct queue of a worker to the shared queues they were routed from.
+
+        Parameters
+        ----------
+        hostname : str
+            Worker hostname.
+        queue : str
+            Shared queue of the tasks whose headers do not record it, e.g. published by an older API.
+
+        Returns
+        -------
+        int:
+            The number of moved tasks.
+
+        """
+
+        from celery.utils.nodenames import worker_direct
+        from kombu import Producer
+
+        moved = 0
+
+        with celery_app.connection_for_write() as connection:
+            channel = connection.default_channel
+            direct_queue = worker_direct(hostname).bind(channel)
+            producer = Producer(channel)
+
+            # a task is acknowledged in the direct queue only once it is published to the shared one,
+            # so a failure in between duplicates it rather than losing it
+            while (message := direct_queue.get(no_ack=False)) is not None:
+                properties = message.properties
+                producer.publish(message.body,
+                                 exchange='',
+                                 routing_key=message.headers.get('shared_queue') or queue,
+                                 headers=message.headers,
+                                 content_type=message.content_type,
+                                 content_encoding=message.content_encoding,
+                                 priority=properties.get('priority'),
+                                 correlation_id=properties.get('correlation_id'),
+                                 reply_to=properties.get('reply_to'))
+                message.ack()
+                moved += 1
+
+        if moved:
+            HANDED_OVER_TASKS.inc(moved)
+            log.project_logger.info(f'{moved} tasks of the departed worker {hostname} are moved to the shared queue')
+
+        return moved
+
+    def _backlog(self, hostname: str) -> int:
+        from celery.utils.nodenames import worker_direct
+
+        now = time.monotonic()
+
+        with self.lock:
+            depth, updated = self.depths.get(hostname, (0, 0.0))
+
+        if now - updated >= self.depth_refresh:
+            try:
+                with celery_app.connection_for_write() as connection:
+                    _, depth, _ = connection.default_channel.queue_declare(queue=worker_direct(hostname).name,
+                                                                           passive=True)
+            except Exception as e:
+                log.project_logger.warning(f'Direct queue of {hostname} is unavailable: {e}')
+                depth = self.max_backlog
+
+            updated = now
+
+            with self.lock:
+                self.depths[hostname] = (depth, updated)
+
+        return depth
+
+    def route(self, conversation_id: str, queue: str) -> Optional[Any]:
+        """
+        Choose the queue of a conversation task.
+
+        Parameters
+        ----------
+        conversation_id : str
+            Conversation id.
+        queue : str
+            Shared queue of the task.
+
+        Returns
+        -------
+        Optional[kombu.Queue]:
+            Direct queue of the conversation worker or None to publish to the shared queue.
+
+        """
+
+        from celery.utils.nodenames import worker_direct
+
+        if (hostname := self.rings.get(queue, HashRing()).node(conversation_id)) is None:
+            STICKY_ROUTES.labels(result='shared').inc()
+            return None
+
+        if self._backlog(hostname) >= self.max_backlog:
+            STICKY_ROUTES.labels(result='spilled').inc()
+            return None
+
+        with self.lock:
+            depth, updated = self.depths[hostname]
+            self.depths[hostname] = (depth + 1, updated)
+
+        STICKY_ROUTES.labels(result='sticky').inc()
+
+        return worker_direct(hostname)
+
+    def start(self) -> Optional[threading.Thread]:
+        """
+        Update the worker membership periodically in a daemon thread.
+
+        Returns
+        -------
+        Optional[threading.Thread]:
+            Update thread or None if the sticky routing is disabled.
+
+        """
+
+        if not var.STICKY_ROUTING:
+            return None
+
+        def run() -> None:
+            while True:
+                try:
+                    self.update()
+                except Exception as e:
+                    log.project_logger.warning(f'Sticky routing workers update failed: {e}')
+
+                time.sleep(self.refresh)
+
+        thread = threading.Thread(target=run, name='StickyRouting', daemon=True)
+        thread.start()
+
+        return thread
+
+
+sticky_router = StickyRouter()
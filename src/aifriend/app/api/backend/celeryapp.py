@@ -1,6 +1,21 @@
+import os
+import time
+from pathlib import Path
+
 from celery import Celery
-from celery.signals import after_setup_task_logger, after_setup_logger
+from celery.signals import (
+    after_setup_task_logger,
+    after_setup_logger,
+    before_task_publish,
+    worker_init,
+    worker_process_init,
+    worker_process_shutdown,
+    worker_ready,
+    worker_shutdown
+)
+from celery.worker.control import control_command
 
+from aifriend.app.api.backend.serialization import serializer_config
 from aifriend.config import var, log
 
 celery_app = Celery('AIfriend',
@@ -9,27 +24,107 @@ celery_app = Celery('AIfriend',
                     include=['aifriend.app.api.backend.tasks'])
 
 celery_app.conf.update({
-    'task_serializer': 'json',
-    'result_serializer': 'json',
-    'accept_content': ['json'],
+    **serializer_config(var.CELERY_SERIALIZER),
     'worker_prefetch_multiplier': 1,
     'task_acks_late': True,
     'task_track_started': True,
     'task_reject_on_worker_lost': True,
+    'result_expires': var.RESULT_EXPIRES or None,
 })
 
+if var.SJF_SCHEDULING:
+    # RabbitMQ honours message priorities only in queues declared with x-max-priority,
+    # an existing queue declared without it has to be deleted first
+    celery_app.conf.task_queue_max_priority = var.SJF_PRIORITY_LEVELS - 1
+
+if var.STICKY_ROUTING:
+    # every worker also consumes its own '<hostname>.dq2' queue for the conversations hashed onto it
+    celery_app.conf.worker_direct = True
+
 
 @after_setup_task_logger.connect
 def setup_task_logger(logger, *args, **kwargs):
     """ Customize celery task logger. """
 
-    logger.addHandler(hdlr=log.error_handler)
-    logger.addHandler(hdlr=log.info_handler)
+    logger.addHandler(hdlr=log.queue_handler)
 
 
 @after_setup_logger.connect
 def setup_task_logger(logger, *args, **kwargs):
     """ Customize celery logger. """
 
-    logger.addHandler(hdlr=log.error_handler)
-    logger.addHandler(hdlr=log.info_handler)
+    logger.addHandler(hdlr=log.queue_handler)
+
+
+@worker_process_init.connect
+def warmup_worker(*args, **kwargs):
+    """ Load the model as soon as the worker process starts if warmup is enabled. """
+
+    if var.CELERY_WARMUP:
+        celery_app.tasks['aifriend.app.api.backend.tasks.predict'].load()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def close_attention_cache(*args, **kwargs):
+    """
+    Delete the cold tier files of the attention cache when the worker process exits,
+    the solo pool only sends worker_shutdown.
+    """
+
+    llm = celery_app.tasks['aifriend.app.api.backend.tasks.predict'].llm
+
+    if (cache := getattr(llm, 'attention_cache', None)) is not None:
+        cache.close()
+
+
+@worker_ready.connect
+def mark_worker_ready(sender=None, **kwargs):
+    """
+    Write the worker pid to ENV(WORKER_READY_FILE) once the worker consumes tasks, which is after the model
+    warmup with the solo pool. The hot reload switches to a new worker only when this file appears,
+    so a worker whose model failed to load is not marked ready.
+    """
+
+    from celery.concurrency.solo import TaskPool as SoloPool
+
+    if not var.WORKER_READY_FILE:
+        return
+
+    if var.CELERY_WARMUP and isinstance(sender.pool, SoloPool) and \
+            celery_app.tasks['aifriend.app.api.backend.tasks.predict'].llm is None:
+        log.project_logger.error('The model is not loaded, the worker is not marked ready')
+        return
+
+    Path(var.WORKER_READY_FILE).write_text(str(os.getpid()))
+
+
+@worker_init.connect
+def start_worker_metrics(*args, **kwargs):
+    """ Expose worker metrics for Prometheus. """
+
+    from aifriend.app.api.backend.metrics import start_metrics_server
+
+    start_metrics_server()
+
+
+@before_task_publish.connect
+def stamp_published_time(headers=None, **kwargs):
+    """ Record the task publishing time to measure the queue wait on the worker side. """
+
+    headers['published_at'] = time.time()
+
+
+@control_command(args=[('tasks', int), ('mode', str)], signature='[tasks=1] [mode=sampling]')
+def profile(state, tasks=1, mode='sampling'):
+    """ Profile the next predict tasks processed by the worker with the 'sampling' or 'torch' profiler. """
+
+    if mode not in ('sampling', 'torch'):
+        return {'error': f"Unknown profiler type '{mode}'"}
+
+    predict = celery_app.tasks['aifriend.app.api.backend.tasks.predict']
+    predict.profile_tasks = tasks
+    predict.profile_mode = mode
+
+    return {'ok': f'{mode} profiler is enabled for the next {tasks} predict tasks, '
+                  f'traces are saved to {log.PROFILES_DIR}'}
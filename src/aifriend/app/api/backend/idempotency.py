@@ -0,0 +1,170 @@
+import hashlib
+import json
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter
+
+from aifriend.app.api.backend.results import get_redis
+from aifriend.config import var
+
+IDEMPOTENT_REQUESTS = Counter('aifriend_api_idempotent_requests_total',
+                              'Number of requests with an idempotency key by the outcome',
+                              labelnames=('result',))
+
+KEY_PREFIX = 'aifriend-idempotency-'
+
+_local_keys: Dict[str, Tuple[str, float]] = dict()
+_local_lock = threading.Lock()
+
+
+def fingerprint(message: str, history: List[Dict[str, Any]], parameters: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Get the fingerprint of a talk request to detect idempotency keys reused for different requests.
+
+    Parameters
+    ----------
+    message : str
+        Human message.
+    history : List[Dict[str, Any]]
+        Chat history.
+    parameters : Optional[Dict[str, Any]], default=None
+        Generation parameters of the request.
+
+    Returns
+    -------
+    str:
+        Hex digest of the request contents.
+
+    """
+
+    return hashlib.sha256(json.dumps([message, history, parameters or {}], sort_keys=True).encode()).hexdigest()[:32]
+
+
+def _storage_key(idempotency_key: str) -> str:
+    return KEY_PREFIX + hashlib.sha256(idempotency_key.encode()).hexdigest()
+
+
+def _task_key(task_id: str) -> str:
+    return f'{KEY_PREFIX}task-{task_id}'
+
+
+def _set_if_absent(key: str, value: str, ttl: int) -> Optional[str]:
+    if (client := get_redis()) is not None:
+        with client.pipeline(transaction=True) as pipe:
+            created, existing = pipe.set(key, value, nx=True, ex=ttl).get(key).execute()
+
+        return None if created else existing.decode()
+
+    with _local_lock:
+        now = time.monotonic()
+
+        for expired in [k for k, (_, deadline) in _local_keys.items() if deadline <= now]:
+            del _local_keys[expired]
+
+        if key in _local_keys:
+            return _local_keys[key][0]
+
+        _local_keys[key] = (value, now + ttl)
+
+    return None
+
+
+def claim(idempotency_key: str, task_id: str, request_fingerprint: str,
+          ttl: int = var.IDEMPOTENCY_TTL) -> Tuple[str, bool]:
+    """
+    Map the idempotency key to the task id unless it is already mapped. Uses SET NX in the result backend Redis
+    or an in-process map with other backends.
+
+    Parameters
+    ----------
+    idempotency_key : str
+        Client idempotency key.
+    task_id : str
+        Id of the task to publish if the key is new.
+    request_fingerprint : str
+        Fingerprint of the request contents.
+    ttl : int, default=ENV(IDEMPOTENCY_TTL) or 600
+        Time in seconds to remember the key.
+
+    Returns
+    -------
+    (task_id, duplicate) : Tuple[str, bool]
+        The given task id and False if the key is new, or the id of the task published for the key earlier and True.
+
+    Raises
+    ------
+    ValueError:
+        If the key is already used for a request with different contents.
+
+    """
+
+    key = _storage_key(idempotency_key)
+
+    if (existing := _set_if_absent(key, f'{task_id} {request_fingerprint}', ttl)) is None:
+        _set_if_absent(_task_key(task_id), key, ttl)
+        IDEMPOTENT_REQUESTS.labels(result='new').inc()
+        return task_id, False
+
+    existing_task_id, existing_fingerprint = existing.split(' ', 1)
+
+    if existing_fingerprint != request_fingerprint:
+        IDEMPOTENT_REQUESTS.labels(result='mismatch').inc()
+        raise ValueError('The idempotency key is already used for a different request')
+
+    IDEMPOTENT_REQUESTS.labels(result='duplicate').inc()
+
+    return existing_task_id, True
+
+
+def release(idempotency_key: str) -> None:
+    """
+    Forget the idempotency key, e.g. if the task could not be published, so that a retry publishes it again.
+
+    A concurrent duplicate that was given the task id before the publishing failed keeps the id of a task
+    that was never published, and its status stays PENDING. Such a client recovers by sending the request
+    again with the same key after its polling timeout: it gets the id of the task published by the retry.
+
+    Parameters
+    ----------
+    idempotency_key : str
+        Client idempotency key.
+
+    """
+
+    key = _storage_key(idempotency_key)
+
+    if (client := get_redis()) is not None:
+        client.delete(key)
+    else:
+        with _local_lock:
+            _local_keys.pop(key, None)
+
+
+def forget_task(task_id: str) -> None:
+    """
+    Forget the idempotency key mapped to the task once its result is consumed: the result is deleted,
+    so a retry with the same key would get the id of a task whose status stays PENDING,
+    instead it publishes the request again.
+
+    Parameters
+    ----------
+    task_id : str
+        Id of the task whose result is consumed.
+
+    """
+
+    task_key = _task_key(task_id)
+
+    if (client := get_redis()) is not None:
+        if (key := client.get(task_key)) is not None and \
+                (value := client.get(key)) is not None and value.decode().split(' ', 1)[0] == task_id:
+            client.delete(key)
+
+        client.delete(task_key)
+    else:
+        with _local_lock:
+            if (key := _local_keys.pop(task_key, (None, 0))[0]) is not None and \
+                    _local_keys.get(key, ('', 0))[0].split(' ', 1)[0] == task_id:
+                del _local_keys[key]
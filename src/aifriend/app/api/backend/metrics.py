@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, start_http_server
+
+from aifriend.config import var, log
+
+PROMPT_TOKENS = Histogram('aifriend_worker_prompt_tokens', 'Number of prompt tokens per generation',
+                          buckets=(64, 128, 256, 512, 768, 1024, 1536, 2048, 3072, 4096))
+GENERATED_TOKENS = Histogram('aifriend_worker_generated_tokens', 'Number of generated tokens per generation',
+                             buckets=(8, 16, 32, 64, 128, 192, 256, 300, 384, 512))
+PREFILL_SECONDS = Histogram('aifriend_worker_prefill_seconds', 'Time to the first generated token',
+                            buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16))
+DECODE_SECONDS = Histogram('aifriend_worker_decode_seconds', 'Time spent generating tokens after the first one',
+                           buckets=(0.5, 1, 2, 4, 8, 16, 32, 64, 128))
+TOKENS_PER_SECOND = Histogram('aifriend_worker_tokens_per_second', 'Decoding speed after the first token',
+                              buckets=(1, 2, 4, 8, 12, 16, 24, 32, 48, 64, 128))
+QUEUE_WAIT_SECONDS = Histogram('aifriend_worker_queue_wait_seconds', 'Time from task publishing to task start',
+                               buckets=(0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300))
+MODEL_LOAD_SECONDS = Gauge('aifriend_worker_model_load_seconds', 'Duration of the last model loading',
+                           multiprocess_mode='max')
+STOP_REASONS = Counter('aifriend_worker_stop_reason_total', 'Number of generations by the reason they stopped',
+                       labelnames=('reason',))
+MODEL_TASK_SECONDS = Histogram('aifriend_worker_model_task_seconds', 'Predict task processing time by model',
+                               labelnames=('model',), buckets=(0.5, 1, 2, 4, 8, 16, 32, 64, 128))
+MODEL_GENERATED_TOKENS = Counter('aifriend_worker_model_generated_tokens_total', 'Number of generated tokens by model',
+                                 labelnames=('model',))
+CACHE_REQUESTS = Counter('aifriend_worker_cache_requests_total', 'Number of worker cache lookups',
+                         labelnames=('cache', 'result'))
+CACHED_PROMPT_TOKENS = Histogram('aifriend_worker_cached_prompt_tokens',
+                                 'Number of prompt tokens whose attention tensors were reused per generation',
+                                 buckets=(0, 64, 128, 256, 512, 768, 1024, 1536, 2048, 3072, 4096))
+MEMORY_RECALL_SECONDS = Histogram('aifriend_worker_memory_recall_seconds',
+                                  'Time to index the old turns and recall the relevant ones',
+                                  buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+RECALLED_TURNS = Histogram('aifriend_worker_recalled_turns', 'Number of old turns recalled into the prompt',
+                           buckets=(0, 1, 2, 4, 8, 16))
+ATTENTION_CACHE_BYTES = Gauge('aifriend_worker_attention_cache_bytes', 'Bytes stored in the attention cache by tier',
+                              labelnames=('tier',), multiprocess_mode='livesum')
+ATTENTION_CACHE_ENTRIES = Gauge('aifriend_worker_attention_cache_entries', 'Number of attention cache entries by tier',
+                                labelnames=('tier',), multiprocess_mode='livesum')
+
+
+def observe_generation(stats) -> None:
+    """
+    Record the statistics of a single generation call.
+
+    Parameters
+    ----------
+    stats : GenerationStats
+        Token counts and timings of the generation.
+
+    """
+
+    PROMPT_TOKENS.observe(stats.prompt_tokens)
+    GENERATED_TOKENS.observe(stats.generated_tokens)
+    PREFILL_SECONDS.observe(stats.prefill_time)
+    DECODE_SECONDS.observe(stats.decode_time)
+    STOP_REASONS.labels(reason=stats.stop_reason).inc()
+
+    if tokens_per_sec := stats.tokens_per_sec:
+        TOKENS_PER_SECOND.observe(tokens_per_sec)
+
+
+def observe_task(model: str, seconds: float, generated_tokens: int) -> None:
+    """
+    Record the processing time and the generated tokens of a predict task by model
+    to compare the latency and throughput of the models served side by side.
+
+    Parameters
+    ----------
+    model : str
+        Model name.
+    seconds : float
+        Task processing time from dequeuing to postprocessing.
+    generated_tokens : int
+        The number of generated tokens.
+
+    """
+
+    MODEL_TASK_SECONDS.labels(model=model).observe(seconds)
+    MODEL_GENERATED_TOKENS.labels(model=model).inc(generated_tokens)
+
+
+def observe_cache(cache: str, hit: bool) -> None:
+    """
+    Record a single cache lookup.
+
+    Parameters
+    ----------
+    cache : str
+        Cache name.
+    hit : bool
+        Whether the lookup was a hit.
+
+    """
+
+    CACHE_REQUESTS.labels(cache=cache, result='hit' if hit else 'miss').inc()
+
+
+def observe_attention_cache(cache, stats) -> None:
+    """
+    Record the attention cache lookup of a generation and the cache usage by tier.
+
+    Parameters
+    ----------
+    cache : TieredCache
+        Attention cache of the model.
+    stats : GenerationStats
+        Token counts and timings of the generation.
+
+    """
+
+    observe_cache('attention', hit=stats.cached_tokens > 0)
+    CACHED_PROMPT_TOKENS.observe(stats.cached_tokens)
+
+    for tier, (entries, nbytes) in cache.usage().items():
+        ATTENTION_CACHE_ENTRIES.labels(tier=tier).set(entries)
+        ATTENTION_CACHE_BYTES.labels(tier=tier).set(nbytes)
+
+
+def observe_memory(turns: int, seconds: float) -> None:
+    """
+    Record a long-term memory recall.
+
+    Parameters
+    ----------
+    turns : int
+        The number of recalled turns.
+    seconds : float
+        Time to index the old turns and recall the relevant ones.
+
+    """
+
+    RECALLED_TURNS.observe(turns)
+    MEMORY_RECALL_SECONDS.observe(seconds)
+
+
+def process_alive(pid: int) -> bool:
+    """ Check if the process with given pid exists. """
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def clear_dead_processes(multiproc_dir: Path) -> None:
+    """
+    Delete the metrics files of the processes that are not running anymore, e.g. of a previous worker run.
+    The files of the live processes are kept, so that the metrics of a worker draining next to its replacement
+    during a hot reload are still exported and its counters do not reset.
+
+    Parameters
+    ----------
+    multiproc_dir : Path
+        Prometheus multiprocess directory.
+
+    """
+
+    for path in multiproc_dir.glob('*.db'):
+        pid = path.stem.rsplit('_', 1)[-1]
+
+        if not pid.isdigit() or not process_alive(int(pid)):
+            path.unlink(missing_ok=True)
+
+
+def start_metrics_server(port: int = var.WORKER_METRICS_PORT) -> None:
+    """
+    Expose worker metrics over HTTP. If the prometheus_multiproc_dir (PROMETHEUS_MULTIPROC_DIR)
+    environment variable is set, metrics of all the pool processes are aggregated,
+    which is required for the prefork pool. Must be called before the pool processes are started.
+    If the port is taken, e.g. by the worker replaced by a hot reload, the server is started once it is free.
+
+    Parameters
+    ----------
+    port : int, default=ENV(WORKER_METRICS_PORT) or 8002
+        Metrics server port, zero disables the server.
+
+    """
+
+    if not port:
+        return
+
+    registry = REGISTRY
+
+    if multiproc_dir := os.getenv('prometheus_multiproc_dir') or os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        Path(multiproc_dir).mkdir(parents=True, exist_ok=True)
+        clear_dead_processes(Path(multiproc_dir))
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+
+    def serve_when_free() -> None:
+        while True:
+            time.sleep(1)
+
+            try:
+                start_http_server(port, registry=registry)
+            except OSError:
+                continue
+
+            log.project_logger.info(f'Worker metrics server is started on port {port}')
+            return
+
+    try:
+        start_http_server(port, registry=registry)
+    except OSError as e:
+        # the port is held by the worker being replaced during a hot reload until it has drained
+        log.project_logger.warning(f'Worker metrics server is not started on port {port}: {e}, '
+                                   'retrying until the port is free')
+        threading.Thread(target=serve_when_free, name='MetricsServer', daemon=True).start()
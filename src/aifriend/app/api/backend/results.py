@@ -0,0 +1,282 @@
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from celery import states
+from prometheus_client import Counter, Gauge, Histogram
+
+from aifriend.app.api.backend.celeryapp import celery_app
+from aifriend.config import var, log
+
+STORED_RESULTS = Gauge('aifriend_backend_results', 'Number of task results stored in the backend')
+RESULTS_MEMORY = Gauge('aifriend_backend_results_memory_bytes', 'Backend memory used by stored task results')
+RESULT_MAX_MEMORY = Gauge('aifriend_backend_result_max_memory_bytes', 'Backend memory used by the largest result')
+COMPACTED_RESULTS = Counter('aifriend_backend_compacted_results_total', 'Number of results changed by compaction',
+                            labelnames=('action',))
+RESULT_BYTES = Histogram('aifriend_backend_result_bytes', 'Serialized size of the consumed task results',
+                         buckets=(512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072, 262144))
+CONSUMED_RESULTS = Counter('aifriend_backend_consumed_results_total', 'Number of results read and deleted at once')
+
+COMPACTION_LOCK = 'aifriend-results-compaction-lock'
+
+
+def get_redis() -> Optional[Any]:
+    """
+    Get the Redis client of the result backend.
+
+    Returns
+    -------
+    Optional[Redis]:
+        Redis client or None if the result backend is not Redis.
+
+    """
+
+    from celery.backends.redis import RedisBackend
+
+    if isinstance(backend := celery_app.backend, RedisBackend):
+        return backend.client
+
+    return None
+
+
+def get_result(task_id: str) -> Dict[str, Any]:
+    """
+    Get the task state and result with a single backend request.
+
+    Parameters
+    ----------
+    task_id : str
+        Celery task id.
+
+    Returns
+    -------
+    meta : Dict[str, Any]
+        Task meta with 'status' and 'result' fields. Failures hold the exception in the 'result' field.
+
+    """
+
+    return celery_app.backend.get_task_meta(task_id)
+
+
+def consume_result(task_id: str) -> Dict[str, Any]:
+    """
+    Get the task state and result and delete the result if the task is finished. With Redis backend
+    the result is read and deleted atomically in a single transaction, and the state of an unfinished task
+    is put back unless the worker has already replaced it.
+
+    Parameters
+    ----------
+    task_id : str
+        Celery task id.
+
+    Returns
+    -------
+    meta : Dict[str, Any]
+        Task meta with 'status' and 'result' fields. Failures hold the exception in the 'result' field.
+
+    """
+
+    backend = celery_app.backend
+
+    if (client := get_redis()) is None:
+        meta = backend.get_task_meta(task_id)
+
+        if meta['status'] in states.READY_STATES:
+            backend.forget(task_id)
+            CONSUMED_RESULTS.inc()
+
+        return meta
+
+    key = backend.get_key_for_task(task_id)
+
+    with client.pipeline(transaction=True) as pipe:
+        ttl, value, _ = pipe.pttl(key).get(key).delete(key).execute()
+
+    if not value:
+        return {'status': states.PENDING, 'result': None}
+
+    meta = backend.decode_result(value)
+
+    if meta['status'] in states.READY_STATES:
+        CONSUMED_RESULTS.inc()
+        RESULT_BYTES.observe(len(value))
+    else:
+        client.set(key, value, px=ttl if ttl > 0 else None, nx=True)
+
+    return meta
+
+
+def get_results(task_ids: List[str], consume: bool = False) -> List[Dict[str, Any]]:
+    """
+    Get the states and results of many tasks. With Redis backend all of them are fetched with a single MGET,
+    and with the consume flag the finished results are deleted in the same transaction.
+
+    Parameters
+    ----------
+    task_ids : List[str]
+        Celery task ids.
+    consume : bool, default=False
+        Delete the results of the finished tasks.
+
+    Returns
+    -------
+    metas : List[Dict[str, Any]]
+        Task metas in the order of the task ids.
+
+    """
+
+    backend = celery_app.backend
+
+    if not task_ids:
+        return list()
+
+    if (client := get_redis()) is None:
+        return [consume_result(task_id) if consume else get_result(task_id) for task_id in task_ids]
+
+    keys = [backend.get_key_for_task(task_id) for task_id in task_ids]
+
+    if not consume:
+        values = client.mget(keys)
+    else:
+        with client.pipeline(transaction=True) as pipe:
+            for key in keys:
+                pipe.pttl(key)
+
+            *ttls, values, _ = pipe.mget(keys).delete(*keys).execute()
+
+    metas = list()
+    unfinished = list()
+
+    for i, value in enumerate(values):
+        if not value:
+            metas.append({'status': states.PENDING, 'result': None})
+            continue
+
+        meta = backend.decode_result(value)
+        metas.append(meta)
+
+        if consume and meta['status'] in states.READY_STATES:
+            CONSUMED_RESULTS.inc()
+            RESULT_BYTES.observe(len(value))
+        elif consume:
+            unfinished.append(i)
+
+    if unfinished:
+        with client.pipeline(transaction=False) as pipe:
+            for i in unfinished:
+                pipe.set(keys[i], values[i], px=ttls[i] if ttls[i] > 0 else None, nx=True)
+
+            pipe.execute()
+
+    return metas
+
+
+def compact_results(max_age: int = var.RESULT_EXPIRES, batch: int = 500) -> Dict[str, int]:
+    """
+    Scan the results stored in Redis, set the expiration time of the results stored without it
+    (e.g. before result expiration was configured or by clients that never fetched them)
+    and update the backend memory metrics.
+
+    Parameters
+    ----------
+    max_age : int, default=ENV(RESULT_EXPIRES) or 3600
+        Expiration time in seconds of the results without it, zero keeps such results.
+    batch : int, default=500
+        The number of keys inspected per Redis round trip.
+
+    Returns
+    -------
+    report : Dict[str, int]
+        The number of results, their memory usage in bytes and the number of results given an expiration time.
+
+    """
+
+    report = {'results': 0, 'memory': 0, 'max_memory': 0, 'expired': 0}
+
+    if (client := get_redis()) is None:
+        return report
+
+    def inspect(keys) -> None:
+        with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.memory_usage(key, samples=0).ttl(key)
+
+            replies = pipe.execute()
+
+        orphans = list()
+
+        for key, memory, ttl in zip(keys, replies[::2], replies[1::2]):
+            if memory is None:
+                continue
+
+            report['results'] += 1
+            report['memory'] += memory
+            report['max_memory'] = max(report['max_memory'], memory)
+
+            if ttl == -1 and max_age:
+                orphans.append(key)
+
+        if orphans:
+            with client.pipeline(transaction=False) as pipe:
+                for key in orphans:
+                    pipe.expire(key, max_age)
+
+                report['expired'] += sum(pipe.execute())
+
+    keys = list()
+
+    for key in client.scan_iter(match=celery_app.backend.task_keyprefix + b'*', count=batch):
+        keys.append(key)
+
+        if len(keys) == batch:
+            inspect(keys)
+            keys = list()
+
+    if keys:
+        inspect(keys)
+
+    STORED_RESULTS.set(report['results'])
+    RESULTS_MEMORY.set(report['memory'])
+    RESULT_MAX_MEMORY.set(report['max_memory'])
+    COMPACTED_RESULTS.labels(action='expire').inc(report['expired'])
+
+    return report
+
+
+def start_compaction(interval: float = var.RESULT_COMPACT_INTERVAL) -> Optional[threading.Thread]:
+    """
+    Run the results compaction periodically in a daemon thread. If several API processes run it,
+    a Redis lock lets only one of them compact per interval.
+
+    Parameters
+    ----------
+    interval : float, default=ENV(RESULT_COMPACT_INTERVAL) or 300
+        Delay in seconds between two compactions, zero disables the compaction.
+
+    Returns
+    -------
+    Optional[threading.Thread]:
+        Compaction thread or None if the compaction is disabled or the result backend is not Redis.
+
+    """
+
+    if not interval or get_redis() is None:
+        return None
+
+    def run() -> None:
+        while True:
+            try:
+                if get_redis().set(COMPACTION_LOCK, os.getpid(), nx=True, ex=max(int(interval), 1)):
+                    report = compact_results()
+                    log.project_logger.info(f"Results compaction: {report['results']} results, "
+                                            f"{report['memory']} bytes, {report['expired']} given a TTL")
+            except Exception as e:
+                log.project_logger.warning(f'Results compaction failed: {e}')
+
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='ResultsCompaction', daemon=True)
+    thread.start()
+
+    return thread
@@ -0,0 +1,96 @@
+from typing import Any, Dict, List, Optional
+
+from prometheus_client import Counter
+
+from aifriend.config import var, log
+
+ROUTED_TASKS = Counter('aifriend_api_routed_tasks_total', 'Number of talk requests routed by model',
+                       labelnames=('model',))
+
+
+def model_queue(model: str) -> str:
+    """ Get the name of the queue consumed by the workers of the model. """
+
+    return f'{var.CELERY_QUEUE}.{model}'
+
+
+def get_persona(history: List[Dict[str, Any]]) -> str:
+    """
+    Get the persona of the prompt the worker builds for the chat history,
+    with the same thresholds as the conversation chain.
+
+    Parameters
+    ----------
+    history : List[Dict[str, Any]]
+        Chat history.
+
+    Returns
+    -------
+    str:
+        'introduction', 'friend' or 'flirty'.
+
+    """
+
+    if history:
+        if len(history[0]) > var.FLIRTY_THRESHOLD:
+            return 'flirty'
+
+        if len(history[0]) > var.FRIEND_THRESHOLD:
+            return 'friend'
+
+    return 'introduction'
+
+
+def prompt_length(message: str, history: List[Dict[str, Any]]) -> int:
+    """ Get the number of words in the message and the last ENV(HISTORY_SIZE) pairs of the chat history. """
+
+    contents = [m.get('data', {}).get('content', '') for m in history[-2 * var.HISTORY_SIZE:]]
+
+    return len(message.split()) + sum(len(str(content).split()) for content in contents)
+
+
+def route(message: str, history: List[Dict[str, Any]]) -> Optional[str]:
+    """
+    Choose the model to answer the message with the ENV(MODEL_ROUTING) policy:
+
+    - static: always the ENV(MODEL_DEFAULT) model;
+    - persona: the model of the prompt persona in ENV(MODEL_PERSONAS), e.g. 'introduction=small,flirty=large';
+    - length: the model of the highest prompt length threshold in ENV(MODEL_LENGTH_ROUTES) the prompt reaches,
+      e.g. '0=small,300=large'.
+
+    Parameters
+    ----------
+    message : str
+        Human message.
+    history : List[Dict[str, Any]]
+        Chat history.
+
+    Returns
+    -------
+    Optional[str]:
+        Model name from ENV(MODELS) or None if the deployment serves a single model on the default queue.
+
+    """
+
+    if not var.MODELS:
+        return None
+
+    model = var.MODEL_DEFAULT
+
+    if var.MODEL_ROUTING == var.ModelRouting.persona:
+        model = var.MODEL_PERSONAS.get(get_persona(history), model)
+
+    elif var.MODEL_ROUTING == var.ModelRouting.length:
+        length = prompt_length(message, history)
+
+        for threshold, threshold_model in sorted(var.MODEL_LENGTH_ROUTES.items()):
+            if length >= threshold:
+                model = threshold_model
+
+    if model not in var.MODELS:
+        log.project_logger.warning(f"Unknown model '{model}', routing to '{var.MODEL_DEFAULT}'")
+        model = var.MODEL_DEFAULT
+
+    ROUTED_TASKS.labels(model=model).inc()
+
+    return model
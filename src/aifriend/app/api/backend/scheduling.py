@@ -0,0 +1,159 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter, Histogram
+
+from aifriend.app.api.backend.routing import get_persona, prompt_length
+from aifriend.config import var
+
+TOKEN_LIMITS = Histogram('aifriend_worker_token_limit', 'Generation token limit applied per task',
+                         buckets=(8, 16, 32, 64, 128, 192, 256, 300, 384, 512))
+REDUCED_TOKEN_LIMITS = Counter('aifriend_worker_reduced_token_limits_total',
+                               'Number of tasks whose token limit was reduced because of the queue wait')
+TASK_PRIORITIES = Counter('aifriend_api_task_priorities_total', 'Number of published tasks by priority',
+                          labelnames=('priority',))
+
+
+def token_limit(requested: Optional[int] = None, queue_wait: Optional[float] = None) -> int:
+    """
+    Get the generation token limit of a task: the requested limit capped by the server limit
+    and reduced in proportion to the queue wait once it exceeds the adaptive threshold, so that
+    the workers catch up faster under load.
+
+    Parameters
+    ----------
+    requested : Optional[int], default=None
+        Limit requested by the client, the server limit if None.
+    queue_wait : Optional[float], default=None
+        Time in seconds the task spent in the queue.
+
+    Returns
+    -------
+    int:
+        Maximum number of tokens to generate, never below ENV(MIN_NEW_TOKENS) unless a lower limit is requested.
+
+    """
+
+    limit = min(requested or var.MAX_NEW_TOKENS, var.MAX_NEW_TOKENS)
+
+    if var.ADAPTIVE_TOKENS_WAIT > 0 and queue_wait and queue_wait > var.ADAPTIVE_TOKENS_WAIT:
+        reduced = max(int(limit * var.ADAPTIVE_TOKENS_WAIT / queue_wait), min(var.MIN_NEW_TOKENS, limit))
+
+        if reduced < limit:
+            REDUCED_TOKEN_LIMITS.inc()
+            limit = reduced
+
+    TOKEN_LIMITS.observe(limit)
+
+    return limit
+
+
+class LengthPredictor:
+    """
+    Predict the reply length of a task as the smaller of its token limit and the moving average
+    of the reply lengths observed for similar requests, and map it to a broker priority: the shorter
+    the predicted reply, the higher the priority (shortest job first). Long replies can wait behind a steady flow
+    of short ones, so the adaptive token limit is advised along with it.
+
+    Requests are grouped by their prompt persona and the power-of-two buckets of their token limit
+    and of their prompt length in words, a group without observations is predicted with the average
+    of all the replies. Each published task
+    is observed once, with the number of tokens the worker generated for it.
+
+    Parameters
+    ----------
+    levels : int, default=ENV(SJF_PRIORITY_LEVELS) or 10
+        The number of priorities.
+    alpha : float, default=0.1
+        Smoothing factor of the reply length averages.
+    capacity : int, default=10000
+        The number of published tasks remembered until their reply is observed.
+
+    """
+
+    def __init__(self, levels: int = var.SJF_PRIORITY_LEVELS, alpha: float = 0.1, capacity: int = 10000):
+        self.levels = max(levels, 1)
+        self.alpha = alpha
+        self.capacity = capacity
+        self.reply_tokens = float(var.MAX_NEW_TOKENS)
+        self.group_tokens: Dict[Tuple[str, int, int], float] = dict()
+        self.pending: 'OrderedDict[str, Tuple[str, int, int]]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def group(message: str,
+              history: List[Dict[str, Any]],
+              max_new_tokens: Optional[int] = None
+              ) -> Tuple[str, int, int]:
+        """ Get the group of a request: its persona and the buckets of its token limit and of its prompt length. """
+
+        limit = min(max_new_tokens or var.MAX_NEW_TOKENS, var.MAX_NEW_TOKENS)
+
+        return get_persona(history), limit.bit_length(), prompt_length(message, history).bit_length()
+
+    def observe(self, task_id: str, tokens: int) -> None:
+        """ Update the reply length averages with the number of tokens generated for a task published before. """
+
+        with self.lock:
+            if (group := self.pending.pop(task_id, None)) is None:
+                return
+
+            self.reply_tokens += self.alpha * (tokens - self.reply_tokens)
+
+            if (average := self.group_tokens.get(group)) is None:
+                self.group_tokens[group] = float(tokens)
+            else:
+                self.group_tokens[group] = average + self.alpha * (tokens - average)
+
+    def predict(self, message: str, history: List[Dict[str, Any]], max_new_tokens: Optional[int] = None) -> float:
+        """ Predict the reply length of a request. """
+
+        group = self.group(message, history, max_new_tokens)
+
+        with self.lock:
+            average = self.group_tokens.get(group, self.reply_tokens)
+
+        return min(max_new_tokens or var.MAX_NEW_TOKENS, var.MAX_NEW_TOKENS, average)
+
+    def priority(self,
+                 task_id: str,
+                 message: str,
+                 history: List[Dict[str, Any]],
+                 max_new_tokens: Optional[int] = None
+                 ) -> int:
+        """
+        Get the broker priority of a task and remember its group to observe its reply.
+
+        Parameters
+        ----------
+        task_id : str
+            Celery task id.
+        message : str
+            Human message.
+        history : List[Dict[str, Any]]
+            Chat history.
+        max_new_tokens : Optional[int], default=None
+            Token limit requested by the client.
+
+        Returns
+        -------
+        int:
+            Priority from 0 (the longest predicted replies) to levels - 1 (the shortest).
+
+        """
+
+        bucket = int(self.predict(message, history, max_new_tokens) * self.levels / var.MAX_NEW_TOKENS)
+        priority = self.levels - 1 - min(bucket, self.levels - 1)
+        TASK_PRIORITIES.labels(priority=str(priority)).inc()
+
+        with self.lock:
+            self.pending[task_id] = self.group(message, history, max_new_tokens)
+
+            while len(self.pending) > self.capacity:
+                self.pending.popitem(last=False)
+
+        return priority
+
+
+length_predictor = LengthPredictor()
@@ -0,0 +1,251 @@
+from datetime import date, datetime
+from typing import Any, Dict, List
+
+from aifriend.config import log
+
+COMPACT_SERIALIZER = 'msgpack-zstd'
+COMPACT_CONTENT_TYPE = 'application/x-aifriend-msgpack-zstd'
+
+HISTORY_EXT = 1
+MESSAGE_TYPES = ('human', 'ai', 'system')
+MESSAGE_FIELDS = {'content', 'additional_kwargs', 'example'}
+
+RAW = b'\x00'
+ZSTD = b'\x01'
+ZSTD_LEVEL = 3
+ZSTD_MIN_SIZE = 256
+
+
+def is_history(value: Any) -> bool:
+    """
+    Check if the value is a chat history made by langchain messages_to_dict that can be encoded compactly.
+
+    Parameters
+    ----------
+    value : Any
+        Value to check.
+
+    Returns
+    -------
+    bool:
+        True if the value is a non-empty list of human, ai or system messages without extra fields.
+
+    """
+
+    return (isinstance(value, list) and len(value) > 0 and
+            all(isinstance(m, dict) and m.keys() == {'type', 'data'} and m['type'] in MESSAGE_TYPES and
+                isinstance(m['data'], dict) and 'content' in m['data'] and m['data'].keys() <= MESSAGE_FIELDS
+                for m in value))
+
+
+def compact_history(history: List[Dict[str, Any]]) -> List[List[Any]]:
+    """
+    Encode the chat history as [type, content] pairs, keeping additional_kwargs and example only if they are set.
+
+    Parameters
+    ----------
+    history : List[Dict[str, Any]]
+        Chat history made by langchain messages_to_dict.
+
+    Returns
+    -------
+    List[List[Any]]:
+        Compact chat history.
+
+    """
+
+    compact = list()
+
+    for message in history:
+        data = message['data']
+        item = [MESSAGE_TYPES.index(message['type']), data['content']]
+
+        if data.get('additional_kwargs') or data.get('example'):
+            item.extend((data.get('additional_kwargs') or {}, bool(data.get('example'))))
+
+        compact.append(item)
+
+    return compact
+
+
+def expand_history(compact: List[List[Any]]) -> List[Dict[str, Any]]:
+    """
+    Restore the chat history encoded by compact_history.
+
+    Parameters
+    ----------
+    compact : List[List[Any]]
+        Compact chat history.
+
+    Returns
+    -------
+    List[Dict[str, Any]]:
+        Chat history in the langchain messages_to_dict format.
+
+    """
+
+    return [{'type': MESSAGE_TYPES[item[0]],
+             'data': {'content': item[1],
+                      'additional_kwargs': item[2] if len(item) > 2 else {},
+                      'example': item[3] if len(item) > 3 else False}}
+            for item in compact]
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serialize a Celery message body with msgpack, encoding chat histories compactly,
+    and compress it with zstd if it is large enough.
+
+    Parameters
+    ----------
+    obj : Any
+        Value to serialize.
+
+    Returns
+    -------
+    bytes:
+        Serialized value prefixed with the compression flag.
+
+    """
+
+    import msgpack
+    import zstandard
+
+    def default(value: Any) -> Any:
+        if isinstance(value, (tuple, set, frozenset)):
+            return list(value)
+
+        if isinstance(value, (date, datetime)):
+            return value.isoformat()
+
+        raise TypeError(f'Object of type {type(value).__name__} is not serializable')
+
+    def encode(value: Any) -> Any:
+        if is_history(value):
+            return msgpack.ExtType(HISTORY_EXT, msgpack.packb(compact_history(value), use_bin_type=True))
+
+        if isinstance(value, dict):
+            return {key: encode(item) for key, item in value.items()}
+
+        if isinstance(value, (list, tuple)):
+            return [encode(item) for item in value]
+
+        return value
+
+    packed = msgpack.packb(encode(obj), default=default, use_bin_type=True)
+
+    if len(packed) < ZSTD_MIN_SIZE:
+        return RAW + packed
+
+    return ZSTD + zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(packed)
+
+
+def loads(data: bytes) -> Any:
+    """
+    Deserialize a value serialized by dumps.
+
+    Parameters
+    ----------
+    data : bytes
+        Serialized value.
+
+    Returns
+    -------
+    Any:
+        Deserialized value. Tuples are restored as lists, as with the json serializer.
+
+    """
+
+    import msgpack
+    import zstandard
+
+    if isinstance(data, str):
+        data = data.encode('latin-1')
+
+    flag, packed = data[:1], data[1:]
+
+    if flag == ZSTD:
+        packed = zstandard.ZstdDecompressor().decompress(packed)
+
+    def ext_hook(code: int, payload: bytes) -> Any:
+        if code == HISTORY_EXT:
+            return expand_history(msgpack.unpackb(payload, raw=False))
+
+        return msgpack.ExtType(code, payload)
+
+    return msgpack.unpackb(packed, ext_hook=ext_hook, raw=False, strict_map_key=False)
+
+
+def register_compact_serializer() -> bool:
+    """
+    Register the compact serializer in kombu if msgpack and zstandard are installed.
+
+    Returns
+    -------
+    bool:
+        True if the serializer is registered.
+
+    """
+
+    try:
+        import msgpack  # noqa: F401
+        import zstandard  # noqa: F401
+    except ImportError:
+        return False
+
+    from kombu.serialization import register
+
+    register(COMPACT_SERIALIZER, dumps, loads, content_type=COMPACT_CONTENT_TYPE, content_encoding='binary')
+
+    return True
+
+
+def get_serializer(name: str) -> str:
+    """
+    Get the serializer to publish tasks with.
+
+    Parameters
+    ----------
+    name : str
+        Requested serializer name: 'json' or 'msgpack-zstd'.
+
+    Returns
+    -------
+    str:
+        Requested serializer or 'json' if the compact one is not available.
+
+    """
+
+    if name == COMPACT_SERIALIZER and not register_compact_serializer():
+        log.project_logger.warning(f"The '{COMPACT_SERIALIZER}' serializer requires msgpack and zstandard, "
+                                   f"falling back to 'json'")
+        return 'json'
+
+    return name
+
+
+def serializer_config(name: str) -> Dict[str, Any]:
+    """
+    Get the Celery serialization settings of a service. Task messages are decoded by their content type,
+    so both the API and the worker accept JSON and the compact format (if available) and the task format
+    can be switched one service at a time. Results are always stored as JSON: the result backends ignore
+    the content type and decode a result with the serializer of the reader, so a result stored compactly
+    by a worker could not be read by an API still on JSON and vice versa.
+
+    Parameters
+    ----------
+    name : str
+        Requested task serializer name: 'json' or 'msgpack-zstd'.
+
+    Returns
+    -------
+    Dict[str, Any]:
+        The task_serializer, result_serializer and accept_content settings.
+
+    """
+
+    return {
+        'task_serializer': get_serializer(name),
+        'result_serializer': 'json',
+        'accept_content': ['json', COMPACT_SERIALIZER] if register_compact_serializer() else ['json'],
+    }
@@ -1,16 +1,26 @@
-from typing import Tuple, List, Dict, Any
+import time
+from typing import Tuple, List, Dict, Any, Optional
 
 from aifriend.app.api.backend.celeryapp import celery_app
 from aifriend.app.api.backend.tasksbase import PredictTask
+from aifriend.config import var
 
 
 @celery_app.task(bind=True, base=PredictTask)
 def predict(self: PredictTask,
             message: str,
-            history: List[Dict[str, Any]]
-            ) -> Tuple[str, List[Dict[str, Any]]]:
+            history: List[Dict[str, Any]],
+            max_new_tokens: Optional[int] = None,
+            temperature: Optional[float] = None,
+            top_k: Optional[int] = None,
+            top_p: Optional[float] = None,
+            repetition_penalty: Optional[float] = None,
+            seed: Optional[int] = None,
+            conversation_id: Optional[str] = None
+            ) -> Tuple[str, List[Dict[str, Any]], Dict[str, float], Dict[str, int]]:
     """
     Celery task implementation that performs text generation.
+    The generation parameters that are None keep the model defaults.
 
     Parameters
     ----------
@@ -19,12 +29,29 @@ def predict(self: PredictTask,
     message : str
         Human message to answer.
     history : List[Dict[str, Any]]
-        Chat history.
+        Chat history, its messages carry their token ids if ENV(PRETOKENIZED_HISTORY) is set.
+    max_new_tokens : Optional[int], default=None
+        Maximum number of tokens to generate, capped by the server limit and reduced under load.
+    temperature : Optional[float], default=None
+        Sampling temperature.
+    top_k : Optional[int], default=None
+        The number of the most likely tokens to sample from.
+    top_p : Optional[float], default=None
+        Cumulative probability of the most likely tokens to sample from.
+    repetition_penalty : Optional[float], default=None
+        Penalty of the repeated tokens.
+    seed : Optional[int], default=None
+        Random seed of the sampling.
+    conversation_id : Optional[str], default=None
+        Conversation id to measure the affinity of the conversation routing,
+        to reuse the attention tensors of the previous turns if the attention cache is enabled
+        and to recall the old turns if ENV(LONG_TERM_MEMORY) is set.
 
     Returns
     -------
-    (ai_response, updated_history) : Tuple[str, List[Dict[str, Any]]]
-        AI friend answer and updated history chat.
+    (ai_response, updated_history, timings, usage) : Tuple[str, List[Dict[str, Any]], Dict[str, float], Dict[str, int]]
+        AI friend answer, updated history chat, processing stages timestamps and the prompt and generated token
+        counts (empty if the model does not report them).
 
     Raises
     ------
@@ -33,12 +60,67 @@ def predict(self: PredictTask,
 
     """
     from langchain.schema import messages_to_dict
-    from aifriend.utils.inference import get_conversation_chain
+    from aifriend.app.api.backend.metrics import observe_attention_cache, observe_generation, observe_memory, \
+        observe_task
+    from aifriend.app.api.backend.scheduling import token_limit
+    from aifriend.app.api.backend.tracing import export_timings
+    from aifriend.utils.inference import get_conversation_chain, pretokenize_history
 
     assert len(message) != 0, "Human message is empty"
 
-    conversation_chain = get_conversation_chain(llm=self.llm, history=history)
+    self.observe_conversation(conversation_id)
+
+    queue_wait = self.timings['dequeued'] - self.timings['enqueued'] if 'enqueued' in self.timings else None
+    parameters = dict(temperature=temperature, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty,
+                      seed=seed)
+    llm_kwargs = {'max_new_tokens': token_limit(max_new_tokens, queue_wait),
+                  **{name: value for name, value in parameters.items() if value is not None}}
+
+    if (attention_cache := getattr(self.llm, 'attention_cache', None)) is not None and conversation_id is not None:
+        llm_kwargs['conversation_id'] = conversation_id
+
+    chain_kwargs = dict(llm_kwargs)
+    tokenizer = getattr(self.llm, 'tokenizer', None) if var.PRETOKENIZED_HISTORY else None
+
+    if tokenizer is not None:
+        chain_kwargs['token_segments'] = pretokenize_history(history, tokenizer)
+
+    memories = None
+
+    if self.long_term_memory is not None and conversation_id is not None:
+        started = time.perf_counter()
+        memories = self.long_term_memory.recall(conversation_id, history, message)
+        observe_memory(len(memories), time.perf_counter() - started)
+        self.timings['recalled'] = time.time()
+
+    conversation_chain = get_conversation_chain(llm=self.llm, history=history, llm_kwargs=chain_kwargs,
+                                                memories=memories)
     output = conversation_chain(message)
+    timings = dict(self.timings)
+    attributes = {'model': var.MODEL_NAME, **llm_kwargs}
+    usage = dict()
+
+    if (stats := self.llm.last_stats) is not None:
+        observe_generation(stats)
+
+        if attention_cache is not None:
+            observe_attention_cache(attention_cache, stats)
+
+        timings.update(prompt_built=stats.started_at, tokenized=stats.tokenized_at,
+                       prefilled=stats.prefilled_at, decoded=stats.decoded_at)
+        attributes.update(prompt_tokens=stats.prompt_tokens, generated_tokens=stats.generated_tokens,
+                          stop_reason=stats.stop_reason, cached_tokens=stats.cached_tokens)
+        usage.update(prompt_tokens=stats.prompt_tokens, generated_tokens=stats.generated_tokens)
+
     history = messages_to_dict(conversation_chain.memory.chat_memory.messages)
 
-    return output['response'], history
+    if tokenizer is not None:
+        pretokenize_history(history, tokenizer)
+
+    timings['postprocessed'] = time.time()
+
+    observe_task(var.MODEL_NAME, timings['postprocessed'] - timings['dequeued'],
+                 stats.generated_tokens if stats is not None else 0)
+    export_timings(self.request.id, timings, attributes)
+
+    return output['response'], history, timings, usage
@@ -1,3 +1,8 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
 import celery
 
 from aifriend.config import var, log
@@ -8,6 +13,25 @@ class PredictTask(celery.Task):
         super(PredictTask, self).__init__()
 
         self.llm = None
+        self.long_term_memory = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.profile_tasks = 0
+        self.profile_mode = 'sampling'
+        self.conversations = OrderedDict()
+
+    @property
+    def timings(self) -> dict:
+        """ Processing stages timestamps of the current task, per thread for the threads pool. """
+
+        if not hasattr(self.local, 'timings'):
+            self.local.timings = dict()
+
+        return self.local.timings
+
+    @timings.setter
+    def timings(self, value: dict) -> None:
+        self.local.timings = value
 
     def __call__(self, *args, **kwargs):
         """
@@ -16,14 +40,81 @@ class PredictTask(celery.Task):
 
         """
 
-        if not self.llm:
-            from aifriend.utils.inference import get_llm
+        from aifriend.app.api.backend import metrics
+
+        self.timings = {'dequeued': time.time()}
+
+        if published_at := getattr(self.request, 'published_at', None):
+            self.timings['enqueued'] = published_at
+            metrics.QUEUE_WAIT_SECONDS.observe(max(self.timings['dequeued'] - published_at, 0))
 
+        metrics.observe_cache('model', hit=self.llm is not None)
+
+        if not self.llm:
             self.update_state(state='LOADING')
-            log.project_console.print(f"Load {var.MODEL_ID} model", style="bright_blue")
-            self.llm = get_llm()
-            log.project_console.print(f"{var.MODEL_ID} is loaded", style="bright_blue")
+
+            with self.lock:
+                if not self.llm:
+                    self.load()
+
+            self.timings['loaded'] = time.time()
 
         self.update_state(state='PREDICT')
 
+        if self.profile_tasks > 0:
+            from aifriend.utils.profiling import profile
+
+            self.profile_tasks -= 1
+
+            with profile(log.PROFILES_DIR / f'{self.name.rsplit(".", 1)[-1]}-{self.request.id}', self.profile_mode):
+                return self.run(*args, **kwargs)
+
         return self.run(*args, **kwargs)
+
+    def observe_conversation(self, conversation_id: Optional[str]) -> None:
+        """
+        Record whether the worker process has served the conversation recently,
+        which is the affinity hit rate of the conversation routing, and start promoting
+        the attention tensors of the conversation while the prompt is built.
+
+        Parameters
+        ----------
+        conversation_id : Optional[str]
+            Conversation id, nothing is recorded if None.
+
+        """
+
+        from aifriend.app.api.backend.metrics import observe_cache
+
+        if conversation_id is None:
+            return
+
+        with self.lock:
+            observe_cache('conversation', hit=conversation_id in self.conversations)
+
+            self.conversations[conversation_id] = None
+            self.conversations.move_to_end(conversation_id)
+
+            while len(self.conversations) > var.AFFINITY_CACHE_SIZE:
+                self.conversations.popitem(last=False)
+
+        if (cache := getattr(self.llm, 'attention_cache', None)) is not None:
+            cache.prefetch(conversation_id)
+
+    def load(self) -> None:
+        """ Load the model into the worker process. """
+
+        from aifriend.app.api.backend.metrics import MODEL_LOAD_SECONDS
+        from aifriend.utils.inference import get_llm
+
+        log.project_console.print(f"Load {var.MODEL_ID} model", style="bright_blue")
+        start = time.perf_counter()
+        self.llm = get_llm()
+
+        if var.LONG_TERM_MEMORY:
+            from aifriend.utils.memory import LongTermMemory
+
+            self.long_term_memory = LongTermMemory()
+
+        MODEL_LOAD_SECONDS.set(time.perf_counter() - start)
+        log.project_console.print(f"{var.MODEL_ID} is loaded", style="bright_blue")
@@ -0,0 +1,85 @@
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+from aifriend.config import var, log
+
+STAGES = (
+    ('enqueued', None),
+    ('dequeued', 'queue'),
+    ('loaded', 'load'),
+    ('recalled', 'recall'),
+    ('prompt_built', 'prompt'),
+    ('tokenized', 'tokenize'),
+    ('prefilled', 'prefill'),
+    ('decoded', 'decode'),
+    ('postprocessed', 'postprocess'),
+)
+
+
+@lru_cache(maxsize=None)
+def get_tracer() -> Optional[Any]:
+    """
+    Get the OpenTelemetry tracer that writes spans as JSON lines to the traces log file.
+
+    Returns
+    -------
+    Optional[Tracer]:
+        Tracer instance or None if tracing is disabled or OpenTelemetry SDK is not installed.
+
+    """
+
+    if not var.TRACING:
+        return None
+
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    except ImportError:
+        log.project_logger.warning('Tracing is disabled because opentelemetry-sdk is not installed')
+        return None
+
+    log.TRACES_LOG.parent.mkdir(parents=True, exist_ok=True)
+    exporter = ConsoleSpanExporter(out=log.TRACES_LOG.open(mode='a'),
+                                   formatter=lambda span: span.to_json(indent=None) + '\n')
+
+    provider = TracerProvider(resource=Resource.create({'service.name': 'aifriend-worker'}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+
+    return provider.get_tracer('aifriend')
+
+
+def export_timings(task_id: str, timings: Dict[str, float], attributes: Optional[Dict[str, Any]] = None) -> None:
+    """
+    Export the stage timestamps of a prediction as a trace: a root 'predict' span with a child span per stage.
+
+    Parameters
+    ----------
+    task_id : str
+        Celery task id.
+    timings : Dict[str, float]
+        Stage end timestamps in seconds since the epoch, keyed by the STAGES names.
+    attributes : Optional[Dict[str, Any]], default=None
+        Extra attributes of the root span.
+
+    """
+
+    if (tracer := get_tracer()) is None or not timings:
+        return
+
+    from opentelemetry import trace
+
+    def ns(timestamp: float) -> int:
+        return int(timestamp * 1e9)
+
+    stages = [(name, span_name) for name, span_name in STAGES if name in timings]
+
+    root = tracer.start_span('predict', start_time=ns(timings[stages[0][0]]),
+                             attributes={'celery.task_id': task_id, **(attributes or {})})
+    context = trace.set_span_in_context(root)
+
+    for (previous, _), (name, span_name) in zip(stages, stages[1:]):
+        span = tracer.start_span(span_name, context=context, start_time=ns(timings[previous]))
+        span.end(end_time=ns(timings[name]))
+
+    root.end(end_time=ns(timings[stages[-1][0]]))
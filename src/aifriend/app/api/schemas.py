@@ -1,13 +1,30 @@
 from typing import List, Dict, Any, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, confloat, conint, conlist, constr
 
+from aifriend.config import var
 
-class HumanMessage(BaseModel):
+TaskId = constr(regex=r'^[a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12}$')
+
+
+class GenerationParameters(BaseModel):
+    """ Optional generation parameters of a single request, the worker defaults are used for the missing ones """
+
+    max_new_tokens: Optional[conint(ge=1)]
+    temperature: Optional[confloat(gt=0, le=2)]
+    top_k: Optional[conint(ge=1, le=1000)]
+    top_p: Optional[confloat(gt=0, le=1)]
+    repetition_penalty: Optional[confloat(ge=1, le=2)]
+    seed: Optional[conint(ge=0, lt=2 ** 32)]
+
+
+class HumanMessage(GenerationParameters):
     """ Content declaration of the request body to communicate with AI friend """
 
     message: str
     history: List[Dict[str, Any]]
+    idempotency_key: Optional[constr(min_length=1, max_length=255)]
+    conversation_id: Optional[constr(min_length=1, max_length=255)]
 
     class Config:
         """ Conversation example for API documentation"""
@@ -30,7 +47,15 @@ class HumanMessage(BaseModel):
                          "example": False
                      }
                      }
-                ]
+                ],
+                "idempotency_key": "0c8f1d2e-6a0b-4f5e-9b1c-3d2a7e4f5a6b",
+                "conversation_id": "5f0c6a1e-2b7d-4c39-8e4a-9d1b3f6e7a20",
+                "max_new_tokens": 128,
+                "temperature": 0.7,
+                "top_k": 10,
+                "top_p": 0.9,
+                "repetition_penalty": 1.1,
+                "seed": 42
             }
         }
 
@@ -62,6 +87,9 @@ class TalkResponse(BaseResponse):
     """ Contents declaration of the "talk" handler response body. """
 
     task_id: Optional[str]
+    duplicate: Optional[bool]
+    max_new_tokens: Optional[int]
+    model: Optional[str]
 
     class Config:
         """ TalkResponse example for API documentation"""
@@ -83,6 +111,7 @@ class AIMessage(BaseResponse):
 
     message: Optional[str]
     history: Optional[List[Dict[str, Any]]]
+    timings: Optional[Dict[str, float]]
     state: Optional[str]
 
     class Config:
@@ -117,6 +146,75 @@ class AIMessage(BaseResponse):
                                     "whereas search embeddings allow a more granular representation of concepts by "
                                     "using words as placeholders in a document to represent similar documents.",
                          "additional_kwargs": {},
-                         "example": False}}]
+                         "example": False}}],
+                "timings": {
+                    "enqueued": 1688475215.512412,
+                    "dequeued": 1688475215.518701,
+                    "prompt_built": 1688475215.520135,
+                    "tokenized": 1688475215.523517,
+                    "prefilled": 1688475216.104322,
+                    "decoded": 1688475223.846051,
+                    "postprocessed": 1688475223.847213,
+                    "fetched": 1688475224.011958
+                }
+            }
+        }
+
+
+class StatusBatchRequest(BaseModel):
+    """ Content declaration of the request body to get the status of many tasks at once """
+
+    task_ids: conlist(TaskId, min_items=1, max_items=var.STATUS_BATCH_SIZE)
+    consume: bool = False
+
+    class Config:
+        """ Batch status request example for API documentation"""
+
+        schema_extra = {
+            "example": {
+                "task_ids": ["909e4817-cca3-4dbf-a598-f7f83c5d60c9", "5b1f3c52-3c0e-4d3f-9a0e-2f1d7c8b6a41"],
+                "consume": False
+            }
+        }
+
+
+class TaskStatus(BaseModel):
+    """ Contents declaration of a single task status in the "status/batch" handler response body. """
+
+    task_id: str
+    status: str
+    status_code: int
+    message: Optional[str]
+    history: Optional[List[Dict[str, Any]]]
+    timings: Optional[Dict[str, float]]
+    state: Optional[str]
+
+
+class StatusBatchResponse(BaseResponse):
+    """ Contents declaration of the "status/batch" handler response body. """
+
+    tasks: List[TaskStatus]
+
+    class Config:
+        """ StatusBatchResponse example for API documentation"""
+
+        schema_extra = {
+            "example": {
+                "status": "OK",
+                "method": "POST",
+                "status_code": 200,
+                "timestamp": "2023-07-04T12:53:35.512412",
+                "url": "http://localhost:8001/status/batch",
+                "tasks": [
+                    {"task_id": "909e4817-cca3-4dbf-a598-f7f83c5d60c9",
+                     "status": "OK",
+                     "status_code": 200,
+                     "message": "V8Cars - pronounced as 'Vee eeee' or 'Vee Eights.'",
+                     "history": []},
+                    {"task_id": "5b1f3c52-3c0e-4d3f-9a0e-2f1d7c8b6a41",
+                     "status": "Processing",
+                     "status_code": 102,
+                     "state": "PREDICT"}
+                ]
             }
         }
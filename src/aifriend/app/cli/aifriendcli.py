@@ -1,18 +1,44 @@
+from importlib import import_module
 from pathlib import Path
+from typing import List, Optional
 
+import click
 import typer
 from typer import Typer, Option, Context
+from typer.core import TyperGroup
 
-from aifriend.app.cli import dashboard, api, worker, broker, backend
 from aifriend.config import var, log
 
-cli = Typer(name='AIfriend-cli', add_completion=False)
+SUBCOMMANDS = {
+    'dashboard': 'aifriend.app.cli.dashboard',
+    'api': 'aifriend.app.cli.api',
+    'worker': 'aifriend.app.cli.worker',
+    'broker': 'aifriend.app.cli.broker',
+    'backend': 'aifriend.app.cli.backend',
+    'bench': 'aifriend.app.cli.bench',
+    'batch': 'aifriend.app.cli.batch',
+    'supervisor': 'aifriend.app.cli.supervisor',
+}
 
-cli.add_typer(dashboard.cli, name='dashboard')
-cli.add_typer(api.cli, name='api')
-cli.add_typer(worker.cli, name='worker')
-cli.add_typer(broker.cli, name='broker')
-cli.add_typer(backend.cli, name='backend')
+
+class LazyGroup(TyperGroup):
+    """ Command group that imports the module of a sub-app only when the sub-app is invoked or listed in the help. """
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        lazy = [name for name in SUBCOMMANDS if name not in self.commands]
+
+        return [*super(LazyGroup, self).list_commands(ctx), *lazy]
+
+    def get_command(self, ctx: click.Context, name: str) -> Optional[click.Command]:
+        if name in SUBCOMMANDS and name not in self.commands:
+            command = typer.main.get_group(import_module(SUBCOMMANDS[name]).cli)
+            command.name = name
+            self.add_command(command, name)
+
+        return super(LazyGroup, self).get_command(ctx, name)
+
+
+cli = Typer(name='AIfriend-cli', cls=LazyGroup, add_completion=False)
 
 
 @cli.command(help="Initialize project's environment")
@@ -1,3 +1,5 @@
+from typing import List, Optional
+
 from typer import Typer, Option, Argument, Context
 
 from aifriend.config import var, log
@@ -5,6 +7,37 @@ from aifriend.config import var, log
 cli = Typer(name='API-cli', add_completion=False, help='Manage API service')
 
 
+def api_argv(host: str, port: int, loglevel: var.LogLevel, concurrency: int) -> List[str]:
+    """
+    Build the API service command.
+
+    Parameters
+    ----------
+    host : str
+        Bind socket to this host.
+    port : int
+        Bind socket to this port.
+    loglevel : {'debug', 'info', 'warning', 'error', 'critical'}
+        Level of logging.
+    concurrency : int
+        The number of worker processes.
+
+    Returns
+    -------
+    argv : List[str]
+        Uvicorn command.
+
+    """
+
+    return [
+        'uvicorn', 'aifriend.app.api.aifriendapi:api',
+        '--host', host,
+        '--port', str(port),
+        '--workers', str(concurrency),
+        '--log-level', loglevel
+    ]
+
+
 @cli.callback(invoke_without_command=True)
 def api_state_verification(ctx: Context) -> None:
     """
@@ -99,13 +132,7 @@ def api_start(host: str = Option(var.FASTAPI_HOST, '--host', '-h', help='Bind so
     from aifriend.config import log
     from aifriend.utils.cli import start_service
 
-    argv = [
-        'uvicorn', 'aifriend.app.api.aifriendapi:api',
-        '--host', host,
-        '--port', str(port),
-        '--workers', str(concurrency),
-        '--log-level', loglevel
-    ]
+    argv = api_argv(host=host, port=port, loglevel=loglevel, concurrency=concurrency)
 
     if no_daemon:
         run(argv)
@@ -113,7 +140,7 @@ def api_start(host: str = Option(var.FASTAPI_HOST, '--host', '-h', help='Bind so
         start_service(argv, name='API', logfile=log.API_LOG, pidfile=var.API_PID)
 
         if attach:
-            api_attach(live=False)
+            api_attach(live=False, tail=0, level=None, pattern=None)
 
 
 @cli.command(name='stop', help='Stop service')
@@ -137,7 +164,12 @@ def api_status() -> None:
 
 @cli.command(name='attach', help='Attach local output stream to a service')
 def api_attach(live: bool = Option(False, '--live', '-l', is_flag=True,
-                                   help='Stream only fresh log records')
+                                   help='Stream only fresh log records'),
+               tail: int = Option(0, '--tail', '-n', help='Start from the last log lines.'),
+               level: Optional[var.LogLevel] = Option(None, '--level', case_sensitive=False,
+                                                      help='Stream only records of this level or higher.'),
+               pattern: Optional[str] = Option(None, '--grep', '-g',
+                                               help='Stream only lines matching the regular expression.')
                ) -> None:
     """
     Attach local output stream to a running API service.
@@ -146,13 +178,20 @@ def api_attach(live: bool = Option(False, '--live', '-l', is_flag=True,
     ----------
     live : bool, Default=False
         Stream only fresh log records
+    tail : int, default=0
+        Start from the last log lines. Takes precedence over live.
+    level : Optional[LogLevel], default=None
+        Stream only records of this level or higher.
+    pattern : Optional[str], default=None
+        Stream only lines matching the regular expression.
 
     """
 
     from aifriend.utils.cli import stream
 
     with log.project_console.screen():
-        for record in stream(('API', log.API_LOG), live=live):
+        for record in stream(('API', log.API_LOG), live=live, lines=tail, level=level and level.value,
+                             pattern=pattern):
             log.project_console.print(record)
 
     log.project_console.clear()
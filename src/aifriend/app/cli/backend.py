@@ -18,6 +18,9 @@ def backend_state_verification(ctx: Context) -> None:
 
     """
 
+    if ctx.invoked_subcommand == 'compact':
+        return
+
     from aifriend.config import log
     from aifriend.utils.docker import is_docker_running, get_container
 
@@ -176,5 +179,39 @@ def backend_attach() -> None:
     log.project_console.clear()
 
 
+@cli.command(name='compact', help='Give stored task results an expiration time and report their memory usage')
+def backend_compact(max_age: int = Option(var.RESULT_EXPIRES, '--max-age', '-m',
+                                          help='Expiration time in seconds of results stored without it.'),
+                    backend_url: str = Option(var.CELERY_BACKEND, '--backend', help='Backend url.')
+                    ) -> None:
+    """
+    Compact task results stored in the backend once.
+
+    Parameters
+    ----------
+    max_age : int, default=ENV(RESULT_EXPIRES) or 3600
+        Expiration time in seconds of results stored without it.
+    backend_url : str, default=ENV(CELERY_BACKEND) or 'redis://localhost'
+        Backend url.
+
+    """
+
+    from aifriend.app.api.backend.celeryapp import celery_app
+    from aifriend.app.api.backend.results import compact_results, get_redis
+    from aifriend.config import log
+
+    celery_app.conf.result_backend = backend_url
+
+    if get_redis() is None:
+        log.project_console.print('Only Redis result backend can be compacted', style='yellow')
+        return
+
+    report = compact_results(max_age=max_age)
+
+    log.project_console.print(f"{report['results']} results use {report['memory']} bytes "
+                              f"(the largest one uses {report['max_memory']} bytes), "
+                              f"{report['expired']} results are given an expiration time", style='bright_blue')
+
+
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,79 @@
+from pathlib import Path
+from typing import Optional
+
+from typer import Typer, Option, BadParameter
+
+from aifriend.config import var
+
+cli = Typer(name='Batch-cli', add_completion=False, help='Run offline batch inference')
+
+
+@cli.command(name='run', help='Answer the conversations of a JSONL file offline')
+def batch_run(input_path: Path = Option(..., '--input', '-i', exists=True, dir_okay=False,
+                                        help='Input JSONL file of conversations.'),
+              output_path: Path = Option(..., '--output', '-o', dir_okay=False,
+                                         help='Output JSONL file of replies, a run resumes after its records.'),
+              batch_size: int = Option(8, '--batch-size', '-b', help='The number of conversations per model call.'),
+              window: int = Option(256, '--window', '-w',
+                                   help='The number of records sorted by prompt length at once.'),
+              workers: int = Option(1, '--workers', '-n', help='The number of worker processes.'),
+              max_new_tokens: int = Option(var.MAX_NEW_TOKENS, '--max-tokens', '-t',
+                                           help='The maximum number of generated tokens per reply.'),
+              temperature: Optional[float] = Option(None, '--temperature', help='Sampling temperature.'),
+              greedy: bool = Option(False, '--greedy', is_flag=True, help='Decode greedily instead of sampling.'),
+              seed: Optional[int] = Option(None, '--seed', help='Random seed of the sampling.'),
+              report: Optional[Path] = Option(None, '--report', '-r', help='Path to the JSON run report.')
+              ) -> None:
+    """
+    Answer the last message of each conversation of a JSONL file with the local model,
+    loaded once per worker process, without the API and the broker.
+
+    Each input line is a record with the 'message' to answer, an optional 'history' in the langchain
+    messages_to_dict format and an optional 'id'. Each output line has the input line number ('index'),
+    the id, the response, the updated history and the token counts.
+
+    Parameters
+    ----------
+    input_path : Path
+        Input JSONL file of conversations.
+    output_path : Path
+        Output JSONL file of replies, a run resumes after the records it already holds.
+    batch_size : int, default=8
+        The number of conversations per model call.
+    window : int, default=256
+        The number of records sorted by prompt length at once.
+    workers : int, default=1
+        The number of worker processes, each of them loads the model.
+    max_new_tokens : int, default=ENV(MAX_NEW_TOKENS) or 300
+        The maximum number of generated tokens per reply.
+    temperature : Optional[float], default=None
+        Sampling temperature, the model default if None.
+    greedy : bool, default=False
+        Decode greedily instead of sampling.
+    seed : Optional[int], default=None
+        Random seed of the sampling.
+    report : Optional[Path], default=None
+        Path to the JSON run report.
+
+    """
+
+    from aifriend.app.cli.bench import print_report, save_report
+    from aifriend.utils.batch import run_batch
+
+    if batch_size < 1 or workers < 1:
+        raise BadParameter('The batch size and the number of workers must be positive.')
+
+    parameters = dict(max_new_tokens=max_new_tokens, temperature=temperature, seed=seed,
+                      do_sample=False if greedy else None)
+    llm_kwargs = {name: value for name, value in parameters.items() if value is not None}
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    run_report = run_batch(input_path, output_path, batch_size=batch_size, window=window, workers=workers,
+                           llm_kwargs=llm_kwargs)
+
+    print_report('Batch inference', run_report)
+    save_report(run_report, report)
+
+
+if __name__ == '__main__':
+    cli()
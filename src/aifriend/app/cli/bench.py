@@ -0,0 +1,532 @@
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from typer import Typer, Option, Context, Exit
+
+from aifriend.config import var
+
+cli = Typer(name='Bench-cli', add_completion=False, help='Run performance benchmarks')
+
+
+@cli.callback(invoke_without_command=True)
+def bench_state_verification(ctx: Context) -> None:
+    """
+    Run the load benchmark with default settings if no benchmark is specified.
+
+    Parameters
+    ----------
+    ctx : Context
+        Typer (Click like) special internal object that holds state relevant
+        for the script execution at every single level.
+
+    """
+
+    if ctx.invoked_subcommand is None:
+        bench_load(url=var.FASTAPI_URL, local=True, conversations=20, turns=3, concurrency=4, rate=0, poll=0.05,
+                   token_delay=var.FAKE_TOKEN_DELAY, seed=0, max_tokens=[], output=None)
+
+
+def print_report(title: str, report: Dict[str, Any]) -> None:
+    """
+    Print a benchmark report as a table.
+
+    Parameters
+    ----------
+    title : str
+        Table title.
+    report : Dict[str, Any]
+        Benchmark report. Nested dictionaries are printed as rows of statistics.
+
+    """
+
+    from rich.table import Table
+
+    from aifriend.config import log
+
+    scalars = {key: value for key, value in report.items() if not isinstance(value, dict)}
+    stats = {key: value for key, value in report.items() if isinstance(value, dict)}
+
+    table = Table(title=title)
+    table.add_column('metric')
+    table.add_column('value', justify='right')
+
+    for key, value in scalars.items():
+        table.add_row(key, f'{value:.3f}' if isinstance(value, float) else str(value))
+
+    log.project_console.print(table)
+
+    if stats:
+        columns = list(next(iter(stats.values())).keys())
+        table = Table()
+        table.add_column('')
+
+        for column in columns:
+            table.add_column(column, justify='right')
+
+        for key, values in stats.items():
+            table.add_row(key, *('-' if values[c] is None else f'{values[c]:.3f}' for c in columns))
+
+        log.project_console.print(table)
+
+
+def save_report(report: Dict[str, Any], output: Optional[Path]) -> None:
+    """
+    Save a benchmark report as JSON.
+
+    Parameters
+    ----------
+    report : Dict[str, Any]
+        Benchmark report.
+    output : Optional[Path]
+        Path to the JSON file. Nothing is saved if it is None.
+
+    """
+
+    import json
+
+    from aifriend.config import log
+
+    if output is None:
+        return
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    with output.open('w') as f:
+        json.dump(report, f, indent=2)
+
+    log.project_console.print(f'The report is saved to {output}', style='bright_blue')
+
+
+@cli.command(name='load', help='Replay synthetic conversations against the API')
+def bench_load(url: str = Option(var.FASTAPI_URL, '--url', help='API url.'),
+               local: bool = Option(False, '--local', '-L', is_flag=True,
+                                    help='Run the API and a fake-model worker in-process with in-memory '
+                                         'broker and backend'),
+               conversations: int = Option(20, '--conversations', '-n', help='The number of conversations.'),
+               turns: int = Option(3, '--turns', '-t', help='The number of messages per conversation.'),
+               concurrency: int = Option(4, '--concurrency', '-c', help='The number of simultaneous conversations.'),
+               rate: float = Option(0, '--rate', '-r',
+                                    help='Conversation arrivals per second (0 - as fast as concurrency allows).'),
+               poll: float = Option(0.05, '--poll', help='Delay in seconds between status requests.'),
+               token_delay: float = Option(var.FAKE_TOKEN_DELAY, '--token-delay',
+                                           help='Fake model time per generated token in seconds (--local only).'),
+               seed: int = Option(0, '--seed', help='Random seed.'),
+               max_tokens: List[int] = Option([], '--max-tokens', '-m',
+                                              help='The max_new_tokens values messages pick from at random '
+                                                   '(repeatable, the server limit if not set).'),
+               output: Optional[Path] = Option(None, '--output', '-o', help='Path to the JSON report.')
+               ) -> None:
+    """
+    Replay synthetic multi-turn conversations against the API and report latency, queue wait,
+    throughput and error rate.
+
+    Parameters
+    ----------
+    url : str, default=ENV(FASTAPI_URL)
+        API url. Ignored with the local flag.
+    local : bool, default=False
+        Run the API and a fake-model worker in-process with in-memory broker and backend.
+    conversations : int, default=20
+        The number of conversations.
+    turns : int, default=3
+        The number of messages per conversation.
+    concurrency : int, default=4
+        The number of simultaneous conversations.
+    rate : float, default=0
+        Conversation arrivals per second (0 - as fast as concurrency allows).
+    poll : float, default=0.05
+        Delay in seconds between status requests.
+    token_delay : float, default=ENV(FAKE_TOKEN_DELAY) or 0.005
+        Fake model time per generated token in seconds (local mode only).
+    seed : int, default=0
+        Random seed.
+    max_tokens : List[int], default=[]
+        The max_new_tokens values messages pick from at random, the server limit if empty.
+    output : Optional[Path], default=None
+        Path to the JSON report.
+
+    """
+
+    from aifriend.utils.bench import local_stack, run_load
+
+    if local:
+        with local_stack(token_delay=token_delay) as local_url:
+            report = run_load(local_url, conversations=conversations, turns=turns, concurrency=concurrency,
+                              rate=rate, poll=poll, seed=seed, max_tokens=tuple(max_tokens))
+    else:
+        report = run_load(url, conversations=conversations, turns=turns, concurrency=concurrency,
+                          rate=rate, poll=poll, seed=seed, max_tokens=tuple(max_tokens))
+
+    print_report('Load benchmark', report)
+    save_report(report, output)
+
+
+@cli.command(name='overload', help='Overload the in-process stack with and without load shedding')
+def bench_overload(conversations: int = Option(100, '--conversations', '-n', help='The number of conversations.'),
+                   turns: int = Option(1, '--turns', '-t', help='The number of messages per conversation.'),
+                   concurrency: int = Option(64, '--concurrency', '-c',
+                                             help='The number of simultaneous conversations.'),
+                   rate: float = Option(10, '--rate', '-r', help='Conversation arrivals per second.'),
+                   budget: float = Option(2, '--budget', '-b', help='Queue wait budget in seconds.'),
+                   token_delay: float = Option(var.FAKE_TOKEN_DELAY, '--token-delay',
+                                               help='Fake model time per generated token in seconds.'),
+                   seed: int = Option(0, '--seed', help='Random seed.'),
+                   output: Optional[Path] = Option(None, '--output', '-o', help='Path to the JSON report.')
+                   ) -> None:
+    """
+    Overload the in-process stack (API and a fake-model worker) with arrivals above its capacity,
+    first without admission control and then with load shedding, and compare the latency of accepted requests.
+
+    Parameters
+    ----------
+    conversations : int, default=100
+        The number of conversations per run.
+    turns : int, default=1
+        The number of messages per conversation.
+    concurrency : int, default=64
+        The number of simultaneous conversations.
+    rate : float, default=10
+        Conversation arrivals per second.
+    budget : float, default=2
+        Queue wait budget in seconds of the load shedding run.
+    token_delay : float, default=ENV(FAKE_TOKEN_DELAY) or 0.005
+        Fake model time per generated token in seconds.
+    seed : int, default=0
+        Random seed.
+    output : Optional[Path], default=None
+        Path to the JSON report.
+
+    """
+
+    from aifriend.utils.bench import run_overload
+
+    report = run_overload(conversations=conversations, turns=turns, concurrency=concurrency, rate=rate,
+                          budget=budget, token_delay=token_delay, seed=seed)
+
+    print_report('Overload benchmark (seconds)', report)
+    save_report(report, output)
+
+
+@cli.command(name='scheduling', help='Compare FIFO, adaptive token limits and shortest-job-first under load')
+def bench_scheduling(conversations: int = Option(100, '--conversations', '-n', help='The number of conversations.'),
+                     turns: int = Option(1, '--turns', '-t', help='The number of messages per conversation.'),
+                     concurrency: int = Option(64, '--concurrency', '-c',
+                                               help='The number of simultaneous conversations.'),
+                     rate: float = Option(8, '--rate', '-r', help='Conversation arrivals per second.'),
+                     max_tokens: List[int] = Option([16, 64], '--max-tokens', '-m',
+                                                    help='The max_new_tokens values messages pick from (repeatable).'),
+                     wait: float = Option(1, '--wait', '-w',
+                                          help='Queue wait in seconds above which the token limit is reduced.'),
+                     token_delay: float = Option(var.FAKE_TOKEN_DELAY, '--token-delay',
+                                                 help='Fake model time per generated token in seconds.'),
+                     seed: int = Option(0, '--seed', help='Random seed.'),
+                     output: Optional[Path] = Option(None, '--output', '-o', help='Path to the JSON report.')
+                     ) -> None:
+    """
+    Load the in-process stack (API and a fake-model worker) above its capacity with a mix of token limits
+    and compare FIFO scheduling, the adaptive token limit, shortest-job-first priorities and both.
+
+    Parameters
+    ----------
+    conversations : int, default=100
+        The number of conversations per run.
+    turns : int, default=1
+        The number of messages per conversation.
+    concurrency : int, default=64
+        The number of simultaneous conversations.
+    rate : float, default=8
+        Conversation arrivals per second.
+    max_tokens : List[int], default=[16, 64]
+        The max_new_tokens values messages pick from at random.
+    wait : float, default=1
+        Queue wait in seconds above which the adaptive runs reduce the token limit.
+    token_delay : float, default=ENV(FAKE_TOKEN_DELAY) or 0.005
+        Fake model time per generated token in seconds.
+    seed : int, default=0
+        Random seed.
+    output : Optional[Path], default=None
+        Path to the JSON report.
+
+    """
+
+    from aifriend.utils.bench import run_scheduling
+
+    report = run_scheduling(conversations=conversations, turns=turns, concurrency=concurrency, rate=rate,
+                            max_tokens=tuple(max_tokens), wait=wait, token_delay=token_delay, seed=seed)
+
+    print_report('Scheduling benchmark (seconds)', report)
+    save_report(report, output)
+
+
+@cli.command(name='status', help='Compare individual and batch status requests')
+def bench_status(url: str = Option(var.FASTAPI_URL, '--url', help='API url.'),
+                 local: bool = Option(False, '--local', '-L', is_flag=True,
+                                      help='Run the API and a fake-model worker in-process with in-memory '
+                                           'broker and backend'),
+                 tasks: int = Option(50, '--tasks', '-n', help='The number of tasks polled per cycle.'),
+                 repeat: int = Option(20, '--repeat', '-r', help='The number of poll cycles per method.'),
+                 output: Optional[Path] = Option(None, '--output', '-o', help='Path to the JSON report.')
+                 ) -> None:
+    """
+    Compare a poll cycle over many tasks made of individual 'GET /status/{task_id}' requests
+    with a single 'POST /status/batch' request.
+
+    Parameters
+    ----------
+    url : str, default=ENV(FASTAPI_URL)
+        API url. Ignored with the local flag.
+    local : bool, default=False
+        Run the API and a fake-model worker in-process with in-memory broker and backend.
+    tasks : int, default=50
+        The number of tasks polled per cycle.
+    repeat : int, default=20
+        The number of poll cycles per method.
+    output : Optional[Path], default=None
+        Path to the JSON report.
+
+    """
+
+    from aifriend.utils.bench import local_stack, run_status
+
+    if local:
+        with local_stack(token_delay=0) as local_url:
+            report = run_status(local_url, tasks=tasks, repeat=repeat)
+    else:
+        report = run_status(url, tasks=tasks, repeat=repeat)
+
+    print_report('Status benchmark (poll cycle in milliseconds)', report)
+    save_report(report, output)
+
+
+@cli.command(name='logging', help='Measure per-record logging overhead of the file logging pipelines')
+def bench_logging(records: int = Option(2000, '--records', '-n', help='The number of records per pipeline.'),
+                  error_every: int = Option(50, '--error-every', '-e',
+                                            help='Log every n-th record as an error with a traceback '
+                                                 '(0 - no errors).'),
+                  output: Optional[Path] = Option(None, '--output', '-o', help='Path to the JSON report.')
+                  ) -> None:
+    """
+    Compare the time the calling thread spends per log record with the synchronous Rich file handlers
+    and the queued Rich and JSON pipelines.
+
+    Parameters
+    ----------
+    records : int, default=2000
+        The number of records per pipeline.
+    error_every : int, default=50
+        Log every n-th record as an error with a traceback (0 - no errors).
+    output : Optional[Path], default=None
+        Path to the JSON report.
+
+    """
+
+    from aifriend.utils.bench import run_logging
+
+    report = run_logging(records=records, error_every=error_every)
+
+    print_report('Logging benchmark (overhead in microseconds per record)', report)
+    save_report(report, output)
+
+
+@cli.command(name='serializers', help='Compare JSON and compact Celery serializers on chat histories')
+def bench_serializers(sizes: List[int] = Option([10, 25, 50, 100, 200], '--size', '-s',
+                                                help='History length in messages (repeatable).'),
+                      repeat: int = Option(200, '--repeat', '-r', help='Encodings per measurement.'),
+                      output: Optional[Path] = Option(None, '--output', '-o', help='Path to the JSON report.')
+                      ) -> None:
+    """
+    Compare bytes on the wire and encoding/decoding time of the JSON and the msgpack-zstd serializers
+    on task payloads and results with chat histories of different lengths.
+
+    Parameters
+    ----------
+    sizes : List[int], default=[10, 25, 50, 100, 200]
+        History lengths in messages.
+    repeat : int, default=200
+        The number of encodings and decodings per measurement.
+    output : Optional[Path], default=None
+        Path to the JSON report.
+
+    """
+
+    from aifriend.utils.bench import run_serializers
+
+    report = run_serializers(sizes=tuple(sizes), repeat=repeat)
+
+    print_report('Serializers benchmark (bytes, microseconds)', report)
+    save_report(report, output)
+
+
+@cli.command(name='kv-cache', help='Compare the full precision and the quantized attention caches on a local model')
+def bench_kv_cache(model: str = Option(var.MODEL_ID, '--model', '-m', help='Model id or path.'),
+                   prompt_tokens: int = Option(512, '--prompt-tokens', '-p', help='The number of prompt tokens.'),
+                   new_tokens: int = Option(64, '--new-tokens', '-t', help='The number of generated tokens.'),
+                   bits: List[int] = Option([8, 4], '--bits', '-b', help='Quantization bits (repeatable).'),
+                   repeat: int = Option(3, '--repeat', '-r', help='Timed generations per mode.'),
+                   seed: int = Option(0, '--seed', help='Random seed.'),
+                   output: Optional[Path] = Option(None, '--output', '-o', help='Path to the JSON report.')
+                   ) -> None:
+    """
+    Generate from a random prompt with the full precision attention cache and with the quantized ones,
+    and compare memory per sequence, decoding speed and output divergence.
+
+    Parameters
+    ----------
+    model : str, default=ENV(MODEL_ID)
+        Model id or path, a tiny local model is enough to compare the modes.
+    prompt_tokens : int, default=512
+        The number of prompt tokens, reduced to fit the model context.
+    new_tokens : int, default=64
+        The number of generated tokens.
+    bits : List[int], default=[8, 4]
+        Quantization bits to compare with the full precision.
+    repeat : int, default=3
+        The number of timed generations per mode.
+    seed : int, default=0
+        Random seed.
+    output : Optional[Path], default=None
+        Path to the JSON report.
+
+    """
+
+    from aifriend.utils.bench import run_kv_quantization
+
+    report = run_kv_quantization(model_id=model, prompt_tokens=prompt_tokens, new_tokens=new_tokens,
+                                 bits=tuple(bits), repeat=repeat, seed=seed)
+
+    print_report('Attention cache quantization benchmark', report)
+    save_report(report, output)
+
+
+@cli.command(name='prefill', help='Compare prefill chunk sizes of the generation engine on a local model')
+def bench_prefill(model: str = Option(var.MODEL_ID, '--model', '-m', help='Model id or path.'),
+                  chunks: List[int] = Option([0, 256, 64], '--chunk', '-c',
+                                             help='Prefill chunk size in tokens (repeatable, 0 - unchunked).'),
+                  decoders: int = Option(4, '--decoders', '-d', help='The number of decoding sequences.'),
+                  decode_tokens: int = Option(128, '--decode-tokens', '-t',
+                                              help='The number of tokens per decoding sequence.'),
+                  long_prompts: int = Option(2, '--long-prompts', '-n', help='The number of long prompts.'),
+                  long_prompt_tokens: int = Option(2048, '--long-prompt-tokens', '-p',
+                                                   help='The number of tokens per long prompt.'),
+                  seed: int = Option(0, '--seed', help='Random seed.'),
+                  output: Optional[Path] = Option(None, '--output', '-o', help='Path to the JSON report.')
+                  ) -> None:
+    """
+    Decode a few sequences in the generation engine while long prompts arrive, and compare the inter-token
+    latency of the decoding sequences and the time to the first token of the long prompts per prefill chunk size.
+
+    Parameters
+    ----------
+    model : str, default=ENV(MODEL_ID)
+        Model id or path, a tiny local model is enough to compare the chunk sizes.
+    chunks : List[int], default=[0, 256, 64]
+        Prefill chunk sizes in tokens, zero prefills whole prompts at once.
+    decoders : int, default=4
+        The number of decoding sequences with short prompts.
+    decode_tokens : int, default=128
+        The number of tokens each decoding sequence generates.
+    long_prompts : int, default=2
+        The number of long prompts.
+    long_prompt_tokens : int, default=2048
+        The number of tokens per long prompt.
+    seed : int, default=0
+        Random seed.
+    output : Optional[Path], default=None
+        Path to the JSON report.
+
+    """
+
+    from aifriend.utils.bench import run_prefill
+
+    report = run_prefill(model_id=model, chunks=tuple(chunks), decoders=decoders, decode_tokens=decode_tokens,
+                         long_prompts=long_prompts, long_prompt_tokens=long_prompt_tokens, seed=seed)
+
+    print_report('Chunked prefill benchmark (milliseconds)', report)
+    save_report(report, output)
+
+
+@cli.command(name='memory', help='Measure the long-term memory index of a long conversation')
+def bench_memory(turns: int = Option(10000, '--turns', '-n', help='The number of indexed turns.'),
+                 queries: int = Option(200, '--queries', '-q', help='The number of queries.'),
+                 top_k: int = Option(4, '--top-k', '-k', help='The number of results per query.'),
+                 dim: int = Option(384, '--dim', help='Vector size.'),
+                 nprobe: int = Option(var.MEMORY_NPROBE, '--nprobe', help='The number of clusters scored per query.'),
+                 seed: int = Option(0, '--seed', help='Random seed.'),
+                 output: Optional[Path] = Option(None, '--output', '-o', help='Path to the JSON report.')
+                 ) -> None:
+    """
+    Index the turns of a long synthetic conversation one by one, and compare the latency of the exact
+    and the IVF search along with the recall of the IVF search.
+
+    Parameters
+    ----------
+    turns : int, default=10000
+        The number of indexed turns.
+    queries : int, default=200
+        The number of queries.
+    top_k : int, default=4
+        The number of results per query.
+    dim : int, default=384
+        Vector size.
+    nprobe : int, default=ENV(MEMORY_NPROBE) or 8
+        The number of clusters scored per IVF query.
+    seed : int, default=0
+        Random seed.
+    output : Optional[Path], default=None
+        Path to the JSON report.
+
+    """
+
+    from aifriend.utils.bench import run_memory
+
+    report = run_memory(turns=turns, queries=queries, top_k=top_k, dim=dim, nprobe=nprobe, seed=seed)
+
+    print_report('Long-term memory benchmark (milliseconds)', report)
+    save_report(report, output)
+
+
+@cli.command(name='startup', help='Measure the CLI import and status commands time against a budget')
+def bench_startup(commands: List[str] = Option(['worker status', 'api status', 'dashboard status'], '--command', '-c',
+                                               help='CLI command to run (repeatable).'),
+                  repeat: int = Option(5, '--repeat', '-r', help='The number of runs per command.'),
+                  budget: Optional[float] = Option(None, '--budget-ms', '-b',
+                                                   help='Fail if the median wall time of a command exceeds it.'),
+                  output: Optional[Path] = Option(None, '--output', '-o', help='Path to the JSON report.')
+                  ) -> None:
+    """
+    Measure the import time of the CLI, the heaviest modules the first command imports (python -X importtime)
+    and the wall time of the commands, then check the median wall times against the budget.
+
+    Parameters
+    ----------
+    commands : List[str], default=['worker status', 'api status', 'dashboard status']
+        CLI commands to run.
+    repeat : int, default=5
+        The number of runs per command.
+    budget : Optional[float], default=None
+        Maximum median wall time of a command in milliseconds, the check is skipped if None.
+    output : Optional[Path], default=None
+        Path to the JSON report.
+
+    """
+
+    from aifriend.config import log
+    from aifriend.utils.bench import run_startup
+
+    report = run_startup(commands=tuple(tuple(command.split()) for command in commands), repeat=repeat)
+
+    print_report('CLI startup benchmark (milliseconds)', report)
+    save_report(report, output)
+
+    if budget is not None:
+        over = [command for command in commands if report[f'{command} wall_ms']['p50'] > budget]
+
+        if over:
+            log.project_console.print(f"Over the {budget:.0f} ms budget: {', '.join(over)}", style='red')
+            raise Exit(1)
+
+        log.project_console.print(f'All the commands are within the {budget:.0f} ms budget', style='green')
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,3 +1,5 @@
+from typing import List, Optional
+
 from typer import Typer, Option, Context
 
 from aifriend.config import var, log
@@ -5,6 +7,41 @@ from aifriend.config import var, log
 cli = Typer(name="Dashboard-cli", add_completion=False, help="Manage Dashboard service")
 
 
+def dashboard_argv(host: str, port: int, loglevel: var.LogLevel) -> List[str]:
+    """
+    Build the dashboard service command.
+
+    Parameters
+    ----------
+    host : str
+        The address where the server will listen for client and browser connections.
+    port : int
+        The port where the server will listen for browser connections.
+    loglevel : {"debug", "info", "warning", "error", "critical"}
+        Level of logging.
+
+    Returns
+    -------
+    argv : List[str]
+        Streamlit command.
+
+    """
+
+    from importlib.util import find_spec
+
+    return ["streamlit",
+            "run", find_spec("aifriend.app.dashboard").origin,
+            "--server.address", host,
+            "--server.port", str(port),
+            "--logger.level", loglevel,
+            "--global.suppressDeprecationWarnings", "True",
+            "--theme.backgroundColor", "#FFFFFF",
+            "--theme.secondaryBackgroundColor", "#EAEAF2",
+            "--theme.primaryColor", "#FF8068",
+            "--theme.textColor", "#48466D"
+            ]
+
+
 @cli.callback(invoke_without_command=True)
 def dashboard_state_verification(ctx: Context) -> None:
     """
@@ -64,20 +101,9 @@ def dashboard_start(host: str = Option(var.STREAMLIT_HOST, "--host", "-h", help=
 
     from subprocess import run
 
-    from aifriend.app import dashboard
     from aifriend.utils.cli import start_service
 
-    argv = ["streamlit",
-            "run", dashboard.__file__,
-            "--server.address", host,
-            "--server.port", str(port),
-            "--logger.level", loglevel,
-            "--global.suppressDeprecationWarnings", "True",
-            "--theme.backgroundColor", "#FFFFFF",
-            "--theme.secondaryBackgroundColor", "#EAEAF2",
-            "--theme.primaryColor", "#FF8068",
-            "--theme.textColor", "#48466D"
-            ]
+    argv = dashboard_argv(host=host, port=port, loglevel=loglevel)
 
     if no_daemon:
         run(argv)
@@ -85,7 +111,7 @@ def dashboard_start(host: str = Option(var.STREAMLIT_HOST, "--host", "-h", help=
         start_service(argv, name="dashboard", logfile=log.DASHBOARD_LOG, pidfile=var.DASHBOARD_PID)
 
         if attach:
-            dashboard_attach(live=False)
+            dashboard_attach(live=False, tail=0, level=None, pattern=None)
 
 
 @cli.command(name="stop", help="Stop service")
@@ -108,7 +134,12 @@ def dashboard_status() -> None:
 
 @cli.command(name="attach", help="Attach local output stream to a service")
 def dashboard_attach(live: bool = Option(False, "--live", "-l", is_flag=True,
-                                         help="Stream only fresh log records")
+                                         help="Stream only fresh log records"),
+                     tail: int = Option(0, "--tail", "-n", help="Start from the last log lines."),
+                     level: Optional[var.LogLevel] = Option(None, "--level", case_sensitive=False,
+                                                            help="Stream only records of this level or higher."),
+                     pattern: Optional[str] = Option(None, "--grep", "-g",
+                                                     help="Stream only lines matching the regular expression.")
                      ) -> None:
     """
     Attach local output stream to a running dashboard service.
@@ -117,13 +148,20 @@ def dashboard_attach(live: bool = Option(False, "--live", "-l", is_flag=True,
     ----------
     live : bool, Default=False
         Stream only fresh log records
+    tail : int, default=0
+        Start from the last log lines. Takes precedence over live.
+    level : Optional[LogLevel], default=None
+        Stream only records of this level or higher.
+    pattern : Optional[str], default=None
+        Stream only lines matching the regular expression.
 
     """
 
     from aifriend.utils.cli import stream
 
     with log.project_console.screen():
-        for record in stream(("dashboard", log.DASHBOARD_LOG), live=live):
+        for record in stream(("dashboard", log.DASHBOARD_LOG), live=live, lines=tail, level=level and level.value,
+                             pattern=pattern):
             log.project_console.print(record)
 
     log.project_console.clear()
@@ -0,0 +1,250 @@
+from typing import List, Optional
+
+from typer import Typer, Option, Argument, BadParameter, Exit
+
+from aifriend.config import var
+
+cli = Typer(name='Supervisor-cli', add_completion=False, help='Manage services with a supervisor daemon')
+
+SERVICES = ('api', 'worker', 'dashboard')
+
+
+def service_specs(services: List[str], pool: var.PoolType, concurrency: int) -> List:
+    """
+    Build the commands of the supervised services.
+
+    Parameters
+    ----------
+    services : List[str]
+        Service names: 'api', 'worker' and 'dashboard'.
+    pool : str, {'prefork', 'eventlet', 'gevent', 'processes', 'threads', 'solo'}
+        Worker processes/threads pool type.
+    concurrency : int
+        The number of worker processes.
+
+    Returns
+    -------
+    List[ServiceSpec]:
+        Service commands, the worker ones with the ENV(WORKER_DRAIN_TIMEOUT) stop timeout
+        to finish their current tasks.
+
+    """
+
+    from aifriend.app.cli.api import api_argv
+    from aifriend.app.cli.dashboard import dashboard_argv
+    from aifriend.app.cli.worker import worker_argv
+    from aifriend.config import log
+    from aifriend.utils.supervisor import ServiceSpec
+
+    specs = list()
+
+    for service in services:
+        if service == 'api':
+            specs.append(ServiceSpec('api', api_argv(host=var.FASTAPI_HOST, port=var.FASTAPI_PORT,
+                                                     loglevel=var.LogLevel.info, concurrency=var.FASTAPI_WORKERS),
+                                     logfile=log.API_LOG))
+        elif service == 'dashboard':
+            specs.append(ServiceSpec('dashboard', dashboard_argv(host=var.STREAMLIT_HOST, port=var.STREAMLIT_PORT,
+                                                                 loglevel=var.LogLevel.info),
+                                     logfile=log.DASHBOARD_LOG))
+        elif service == 'worker':
+            specs.append(ServiceSpec('worker', worker_argv(name='AIfriendWorker', pool=pool,
+                                                           loglevel=var.LogLevel.info, concurrency=concurrency,
+                                                           broker_url=var.CELERY_BROKER,
+                                                           backend_url=var.CELERY_BACKEND),
+                                     logfile=log.WORKER_LOG, env={'CELERY_WARMUP': 'True'},
+                                     stop_timeout=var.WORKER_DRAIN_TIMEOUT))
+        else:
+            raise BadParameter(f"Unknown service '{service}', the supervisor runs: {', '.join(SERVICES)}")
+
+    return specs
+
+
+def print_status(response: Optional[dict]) -> None:
+    """ Print the supervisor response as a table of the services. """
+
+    from rich.table import Table
+
+    from aifriend.config import log
+
+    if response is None:
+        log.project_console.print('The supervisor is not started', style='yellow')
+        raise Exit(1)
+
+    if 'error' in response:
+        log.project_console.print(response['error'], style='red')
+        raise Exit(1)
+
+    table = Table(title='Supervised services')
+
+    for column in ('service', 'state', 'pid', 'uptime, s', 'restarts', 'exit code'):
+        table.add_column(column, justify='left' if column in ('service', 'state') else 'right')
+
+    styles = {'running': 'bright_blue', 'stopping': 'yellow', 'backoff': 'red', 'stopped': 'white'}
+
+    for service in response['services']:
+        state = service['state'] if service['restart_in'] is None else \
+            f"{service['state']} ({service['restart_in']:.0f} s)"
+        table.add_row(service['name'], f"[{styles[service['state']]}]{state}", str(service['pid'] or '-'),
+                      '-' if service['uptime'] is None else f"{service['uptime']:.0f}", str(service['restarts']),
+                      '-' if service['exit_code'] is None else str(service['exit_code']))
+
+    log.project_console.print(table)
+
+
+@cli.command(name='start', help='Start the supervisor with its services')
+def supervisor_start(services: List[str] = Option(var.SUPERVISOR_SERVICES, '--service', '-s',
+                                                  help='Service to supervise (repeatable): api, worker, dashboard.'),
+                     pool: var.PoolType = Option(var.PoolType.solo, '--pool', '-p',
+                                                 help='Worker processes/threads pool type.'),
+                     concurrency: int = Option(var.CELERY_WORKERS, '-c', help='The number of worker processes.'),
+                     no_daemon: bool = Option(False, '--no-daemon', is_flag=True,
+                                              help='Do not run as a daemon process')
+                     ) -> None:
+    """
+    Start the supervisor daemon that runs the services, restarts them with backoff when they exit
+    and answers the status and control commands over a local socket.
+
+    Parameters
+    ----------
+    services : List[str], default=ENV(SUPERVISOR_SERVICES) or ['api', 'worker']
+        Services to supervise.
+    pool : str, {'prefork', 'eventlet', 'gevent', 'processes', 'threads', 'solo'}, default='solo'
+        Worker processes/threads pool type.
+    concurrency : int, default=ENV(CELERY_WORKERS) or 1
+        The number of worker processes.
+    no_daemon : bool, default=False
+        Do not run as a daemon process.
+
+    """
+
+    import sys
+
+    from aifriend.config import log
+    from aifriend.utils.cli import start_service
+    from aifriend.utils.supervisor import Supervisor, supervisor_request
+
+    specs = service_specs(services, pool=pool, concurrency=concurrency)
+
+    if supervisor_request('status') is not None:
+        log.project_console.print(':rocket: The supervisor is already started', style='bright_blue')
+        return
+
+    if no_daemon:
+        Supervisor(specs).run()
+    else:
+        argv = [sys.executable, '-m', 'aifriend.app.cli.aifriendcli', 'supervisor', 'start', '--no-daemon',
+                '--pool', pool.value, '-c', str(concurrency), *(f'--service={service}' for service in services)]
+        start_service(argv, name='supervisor', logfile=var.LOGS_DIR / 'supervisor.log', pidfile=var.SUPERVISOR_PID)
+
+
+@cli.command(name='stop', help='Stop the services and the supervisor')
+def supervisor_stop(timeout: Optional[float] = Option(None, '--timeout', '-t',
+                                                      help='Kill the services still running after it (seconds).'),
+                    wait: bool = Option(True, '--wait/--no-wait', help='Wait until the supervisor exits.')
+                    ) -> None:
+    """
+    Stop the services, the workers finish their current tasks first, then stop the supervisor.
+
+    Parameters
+    ----------
+    timeout : Optional[float], default=None
+        Delay in seconds after which the services still running are killed, ENV(WORKER_DRAIN_TIMEOUT)
+        for the workers and ENV(SUPERVISOR_STOP_TIMEOUT) for the others if None.
+    wait : bool, default=True
+        Wait until the supervisor exits.
+
+    """
+
+    import time
+
+    from aifriend.config import log
+    from aifriend.utils.supervisor import supervisor_request
+
+    if supervisor_request('shutdown', timeout=timeout) is None:
+        log.project_console.print('The supervisor is not started', style='yellow')
+        raise Exit(1)
+
+    with log.project_console.status('Stopping the services'):
+        while wait and supervisor_request('status') is not None:
+            time.sleep(0.5)
+
+    var.SUPERVISOR_PID.unlink(missing_ok=True)
+    log.project_console.print('The supervisor is stopped' if wait else 'The supervisor is stopping',
+                              style='bright_blue')
+
+
+@cli.command(name='status', help='Display the services status')
+def supervisor_status() -> None:
+    """ Display the state, pid, uptime and restarts of the supervised services. """
+
+    from aifriend.utils.supervisor import supervisor_request
+
+    print_status(supervisor_request('status'))
+
+
+@cli.command(name='restart', help='Restart services')
+def supervisor_restart(services: Optional[List[str]] = Argument(None, help='Services to restart, all if omitted.'),
+                       timeout: Optional[float] = Option(None, '--timeout', '-t',
+                                                         help='Kill the services still running after it (seconds).')
+                       ) -> None:
+    """
+    Stop the services, the workers finish their current tasks first, and start them again once they have exited.
+
+    Parameters
+    ----------
+    services : Optional[List[str]], default=None
+        Services to restart, all the supervised services if None.
+    timeout : Optional[float], default=None
+        Delay in seconds after which the services still running are killed.
+
+    """
+
+    from aifriend.utils.supervisor import supervisor_request
+
+    print_status(supervisor_request('restart', services=services or None, timeout=timeout))
+
+
+@cli.command(name='service-start', help='Start stopped services')
+def supervisor_service_start(services: Optional[List[str]] = Argument(None, help='Services to start, all if omitted.')
+                             ) -> None:
+    """
+    Start the stopped supervised services.
+
+    Parameters
+    ----------
+    services : Optional[List[str]], default=None
+        Services to start, all the supervised services if None.
+
+    """
+
+    from aifriend.utils.supervisor import supervisor_request
+
+    print_status(supervisor_request('start', services=services or None))
+
+
+@cli.command(name='service-stop', help='Stop services and keep them stopped')
+def supervisor_service_stop(services: Optional[List[str]] = Argument(None, help='Services to stop, all if omitted.'),
+                            timeout: Optional[float] = Option(None, '--timeout', '-t',
+                                                              help='Kill the services still running after it '
+                                                                   '(seconds).')
+                            ) -> None:
+    """
+    Stop the supervised services without stopping the supervisor, the workers finish their current tasks first.
+
+    Parameters
+    ----------
+    services : Optional[List[str]], default=None
+        Services to stop, all the supervised services if None.
+    timeout : Optional[float], default=None
+        Delay in seconds after which the services still running are killed.
+
+    """
+
+    from aifriend.utils.supervisor import supervisor_request
+
+    print_status(supervisor_request('stop', services=services or None, timeout=timeout))
+
+
+if __name__ == '__main__':
+    cli()
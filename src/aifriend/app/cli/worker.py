@@ -1,3 +1,6 @@
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple
+
 from typer import Typer, Option, Context, BadParameter
 
 from aifriend.config import var
@@ -5,6 +8,113 @@ from aifriend.config import var
 cli = Typer(name='Worker-cli', add_completion=False, help='Manage Worker service')
 
 
+def worker_argv(name: str,
+                pool: var.PoolType,
+                loglevel: var.LogLevel,
+                concurrency: int,
+                broker_url: str,
+                backend_url: str,
+                queues: Optional[List[str]] = None
+                ) -> List[str]:
+    """
+    Build the celery worker command.
+
+    Parameters
+    ----------
+    name : str
+        Custom worker hostname.
+    pool : str, {'prefork', 'eventlet', 'gevent', 'processes', 'threads', 'solo'}
+        Worker processes/threads pool type.
+    loglevel : {'debug', 'info', 'warning', 'error', 'critical'}
+        Level of logging.
+    concurrency : int
+        The number of worker processes.
+    broker_url : str
+        Broker url.
+    backend_url : str
+        Backend url.
+    queues : Optional[List[str]], default=None
+        Queues to consume, the default queue if None.
+
+    Returns
+    -------
+    argv : List[str]
+        Celery worker command.
+
+    """
+
+    argv = [
+        'celery',
+        '--broker', broker_url,
+        '--result-backend', backend_url,
+        '--app', 'aifriend.app.api.backend.celeryapp', 'worker',
+        '--hostname', name,
+        '--concurrency', str(concurrency),
+        '--pool', pool,
+        '--loglevel', loglevel
+    ]
+
+    if queues:
+        argv.extend(('--queues', ','.join(queues)))
+
+    return argv
+
+
+def worker_model(model: Optional[str]) -> Optional[str]:
+    """
+    Get the name of a model from ENV(MODELS) by its name or id.
+
+    Parameters
+    ----------
+    model : Optional[str]
+        Model name or id.
+
+    Returns
+    -------
+    Optional[str]:
+        Model name or None if no model is given.
+
+    Raises
+    ------
+    typer.BadParameter:
+        If the model is not in ENV(MODELS).
+
+    """
+
+    if model is None or model in var.MODELS:
+        return model
+
+    for name, model_id in var.MODELS.items():
+        if model_id == model:
+            return name
+
+    raise BadParameter(f"Unknown model '{model}', the MODELS variable lists: {', '.join(var.MODELS) or 'nothing'}")
+
+
+def worker_files(model: Optional[str]) -> Tuple[Path, Path]:
+    """
+    Get the pid and log files of the worker service that serves the model.
+
+    Parameters
+    ----------
+    model : Optional[str]
+        Model name or None for the single-model worker.
+
+    Returns
+    -------
+    (pidfile, logfile) : Tuple[Path, Path]
+        Worker service pid and log files paths.
+
+    """
+
+    from aifriend.config import log
+
+    if model is None:
+        return var.WORKER_PID, log.WORKER_LOG
+
+    return var.CONFIG_DIR / f'worker-{model}.pid', var.LOGS_DIR / f'worker-{model}.log'
+
+
 @cli.callback(invoke_without_command=True)
 def worker_state_verification(ctx: Context) -> None:
     """
@@ -21,16 +131,17 @@ def worker_state_verification(ctx: Context) -> None:
     from aifriend.config import log
 
     if var.WORKER_PID.exists():
-        if ctx.invoked_subcommand in ('start', None):
+        if ctx.invoked_subcommand is None:
             log.project_console.print(':rocket: The worker service is already started', style='bright_blue')
             ctx.exit(0)
 
     elif ctx.invoked_subcommand is None:
         worker_start(name='AIfriendWorker', pool=var.PoolType.solo, loglevel=var.LogLevel.info,
                      concurrency=var.CELERY_WORKERS, broker_url=var.CELERY_BROKER,
-                     backend_url=var.CELERY_BACKEND, attach=False, no_daemon=False)
+                     backend_url=var.CELERY_BACKEND, warmup=False, model=None, attach=False, no_daemon=False)
 
-    elif ctx.invoked_subcommand != 'start':
+    elif ctx.invoked_subcommand not in ('start', 'autoscale', 'profile') and \
+            not any(var.CONFIG_DIR.glob('worker-*.pid')):
         log.project_console.print('The worker service is not started', style='yellow')
         ctx.exit(1)
 
@@ -43,6 +154,10 @@ def worker_start(name: str = Option('AIfriendWorker', '--name', '-n', help='Set
                  concurrency: int = Option(var.CELERY_WORKERS, '-c', help='The number of worker processes.'),
                  broker_url: str = Option(var.CELERY_BROKER, '--broker', help='Broker url.'),
                  backend_url: str = Option(var.CELERY_BACKEND, '--backend', help='Backend url.'),
+                 warmup: bool = Option(var.CELERY_WARMUP, '--warmup', is_flag=True,
+                                       help='Load the model before consuming the first task'),
+                 model: Optional[str] = Option(None, '--model', '-m',
+                                               help='Serve a model from the MODELS variable on its own queue.'),
                  attach: bool = Option(False, '--attach', '-a', is_flag=True, help='Attach output and error streams'),
                  no_daemon: bool = Option(False, '--no-daemon', is_flag=True, help='Do not run as a daemon process')
                  ) -> None:
@@ -53,7 +168,7 @@ def worker_start(name: str = Option('AIfriendWorker', '--name', '-n', help='Set
     ----------
     name : str, default='AIfriendWorker'
         Custom worker hostname.
-    pool : str, {'prefork', 'eventlet', 'gevent', 'processes', 'solo'}, default='solo'
+    pool : str, {'prefork', 'eventlet', 'gevent', 'processes', 'threads', 'solo'}, default='solo'
         Worker processes/threads pool type.
     loglevel : {'debug', 'info', 'warning', 'error', 'critical'}, default='info'
         Level of logging.
@@ -63,6 +178,11 @@ def worker_start(name: str = Option('AIfriendWorker', '--name', '-n', help='Set
         Broker url.
     backend_url : str, default=ENV(CELERY_BACKEND) or 'redis://localhost'
         Backend url.
+    warmup : bool, default=ENV(CELERY_WARMUP) or False
+        Load the model before consuming the first task.
+    model : Optional[str], default=None
+        Name or id of a model from ENV(MODELS). The worker loads it and consumes only its queue,
+        the single-model worker loads ENV(MODEL_ID) and consumes the default queue.
     attach : bool, default=False
         Attach output and error streams.
     no_daemon : bool, default=False
@@ -71,61 +191,401 @@ def worker_start(name: str = Option('AIfriendWorker', '--name', '-n', help='Set
     Raises
     ------
     typer.BadParameter:
-        If non-solo pool type is selected for windows platform.
+        If non-solo pool type is selected for windows platform or the model is unknown.
 
     """
 
+    import os
     import platform
     from subprocess import run
 
+    from aifriend.app.api.backend.routing import model_queue
     from aifriend.config import log
     from aifriend.utils.cli import start_service
 
     if platform.system() == 'Windows' and pool != var.PoolType.solo:
         raise BadParameter("Windows platform only supports 'solo' pool")
 
-    argv = [
-        'celery',
-        '--broker', broker_url,
-        '--result-backend', backend_url,
-        '--app', 'aifriend.app.api.backend.celeryapp', 'worker',
-        '--hostname', name,
-        '--concurrency', str(concurrency),
-        '--pool', pool,
-        '--loglevel', loglevel
-    ]
+    model = worker_model(model)
+    pidfile, logfile = worker_files(model)
+
+    if pidfile.exists():
+        log.project_console.print(f':rocket: The {pidfile.stem} service is already started', style='bright_blue')
+        return
+
+    argv = worker_argv(name=f'{name}-{model}' if model else name, pool=pool, loglevel=loglevel,
+                       concurrency=concurrency, broker_url=broker_url, backend_url=backend_url,
+                       queues=[model_queue(model)] if model else None)
+    env = {'CELERY_WARMUP': str(warmup)}
+
+    if model:
+        env.update(MODEL_ID=var.MODELS[model], TOKENIZER_ID=var.MODELS[model], MODEL_NAME=model)
 
     if no_daemon:
-        run(argv)
+        run(argv, env={**os.environ, **env})
     else:
-        start_service(argv, name='worker', logfile=log.WORKER_LOG, pidfile=var.WORKER_PID)
+        start_service(argv, name=pidfile.stem, logfile=logfile, pidfile=pidfile, env=env)
 
         if attach:
-            worker_attach(live=False)
+            worker_attach(live=False, tail=0, level=None, pattern=None, model=model)
 
 
 @cli.command(name='stop', help='Stop service')
-def worker_stop() -> None:
-    """ Stop worker service. """
+def worker_stop(model: Optional[str] = Option(None, '--model', '-m', help='Stop the worker of this model.')) -> None:
+    """
+    Stop worker service.
+
+    Parameters
+    ----------
+    model : Optional[str], default=None
+        Name or id of the model the worker serves, the single-model worker if None.
+
+    """
+
+    from aifriend.utils.cli import stop_service
+
+    pidfile, logfile = worker_files(worker_model(model))
+    stop_service(name=pidfile.stem, pidfile=pidfile, logfile=logfile)
+
+
+@cli.command(name='drain', help='Finish the current tasks and stop service')
+def worker_drain(timeout: float = Option(var.WORKER_DRAIN_TIMEOUT, '--timeout', '-t',
+                                         help='Kill the worker still running after it (seconds).'),
+                 model: Optional[str] = Option(None, '--model', '-m', help='Drain the worker of this model.')
+                 ) -> None:
+    """
+    Drain worker service: the worker stops consuming, finishes its current tasks and exits (Celery warm shutdown),
+    so that no generation is lost and redelivered to run again from the beginning.
+
+    Parameters
+    ----------
+    timeout : float, default=ENV(WORKER_DRAIN_TIMEOUT) or 600
+        Delay in seconds after which the worker still running is killed.
+    model : Optional[str], default=None
+        Name or id of the model the worker serves, the single-model worker if None.
+
+    """
 
-    from aifriend.config import log
     from aifriend.utils.cli import stop_service
 
-    stop_service(name='worker', pidfile=var.WORKER_PID, logfile=log.WORKER_LOG)
+    pidfile, logfile = worker_files(worker_model(model))
+    stop_service(name=pidfile.stem, pidfile=pidfile, logfile=logfile, timeout=timeout)
+
+
+@cli.command(name='reload', help='Replace service with a new warm worker without stalling the queue')
+def worker_reload(timeout: float = Option(var.WORKER_DRAIN_TIMEOUT, '--timeout', '-t',
+                                          help='Kill the old worker still running after it (seconds).'),
+                  ready_timeout: float = Option(var.WORKER_READY_TIMEOUT, '--ready-timeout',
+                                                help='Keep the old worker if the new one is not ready after it '
+                                                     '(seconds).'),
+                  model: Optional[str] = Option(None, '--model', '-m', help='Reload the worker of this model.')
+                  ) -> None:
+    """
+    Reload worker service, e.g. to serve a new model version set in the environment or a new prompt.
+    A new worker with the command of the running one is started next to it and loads the model, the old worker
+    is drained only once the new one consumes tasks, so the queue never stalls and no task is interrupted.
+    Both workers have the same hostname, so the direct queue of the sticky routing is taken over too.
+    If the available memory is lower than the memory of the running worker, the worker is drained
+    and started again in place, which stalls its queue during the model loading.
+
+    Parameters
+    ----------
+    timeout : float, default=ENV(WORKER_DRAIN_TIMEOUT) or 600
+        Delay in seconds after which the old worker still running is killed.
+    ready_timeout : float, default=ENV(WORKER_READY_TIMEOUT) or 900
+        Delay in seconds after which the new worker that is still loading is stopped and the old one is kept.
+    model : Optional[str], default=None
+        Name or id of the model the worker serves, the single-model worker if None.
+
+    """
+
+    import time
+
+    import psutil
+    from typer import Exit
+
+    from aifriend.config import log
+    from aifriend.utils.cli import service_alive, start_service, stop_service
+
+    model = worker_model(model)
+    pidfile, logfile = worker_files(model)
+
+    try:
+        pid = int(pidfile.read_text())
+        service = psutil.Process(pid) if service_alive(pid, pidfile) else None
+    except (OSError, ValueError, psutil.NoSuchProcess):
+        service = None
+
+    if service is None:
+        log.project_console.print(f'The {pidfile.stem} service is not running', style='yellow')
+        raise Exit(1)
+
+    argv = service.cmdline()
+    env = {'CELERY_WARMUP': 'True'}
+
+    if model:
+        env.update(MODEL_ID=var.MODELS[model], TOKENIZER_ID=var.MODELS[model], MODEL_NAME=model)
+
+    footprint = sum(process.memory_info().rss for process in (service, *service.children(recursive=True)))
+
+    if psutil.virtual_memory().available < footprint:
+        log.project_console.print(f'Not enough memory for a second {pidfile.stem} service '
+                                  f'({footprint / 2 ** 30:.1f} GiB), reloading it in place', style='yellow')
+        stop_service(name=pidfile.stem, pidfile=pidfile, logfile=logfile, timeout=timeout)
+        start_service(argv, name=pidfile.stem, logfile=logfile, pidfile=pidfile, env=env)
+        return
+
+    next_pidfile, next_logfile = pidfile.with_suffix('.next.pid'), logfile.with_suffix('.next.log')
+    ready_file = pidfile.with_suffix('.ready')
+    ready_file.unlink(missing_ok=True)
+
+    process = start_service(argv, name=f'new {pidfile.stem}', logfile=next_logfile, pidfile=next_pidfile,
+                            env={**env, 'WORKER_READY_FILE': str(ready_file)})
+    deadline = time.monotonic() + ready_timeout
+
+    with log.project_console.status(f'Waiting for the new {pidfile.stem} service to load the model'):
+        while not (ready_file.exists() and ready_file.read_text() == str(process.pid)):
+            if process.poll() is not None or time.monotonic() > deadline:
+                break
+
+            time.sleep(0.5)
+
+    if process.poll() is not None:
+        next_pidfile.unlink(missing_ok=True)
+        log.project_console.print(f'The new {pidfile.stem} service exited with code {process.returncode}, '
+                                  f'the running one is kept, see {next_logfile}', style='red')
+        raise Exit(1)
+
+    if not ready_file.exists():
+        for child in psutil.Process(process.pid).children(recursive=True):
+            child.kill()
+
+        process.kill()
+        process.wait()
+        next_pidfile.unlink(missing_ok=True)
+        log.project_console.print(f'The new {pidfile.stem} service is not ready after {ready_timeout:.0f} s '
+                                  f'and is stopped, the running one is kept, see {next_logfile}', style='red')
+        raise Exit(1)
+
+    ready_file.unlink()
+    stop_service(name=f'old {pidfile.stem}', pidfile=pidfile, logfile=logfile, timeout=timeout)
+    next_pidfile.replace(pidfile)
+    next_logfile.replace(logfile)
+
+    log.project_console.print(f'The {pidfile.stem} service is reloaded', style='bright_blue')
 
 
 @cli.command(name='status', help='Display service status')
-def worker_status() -> None:
-    """ Display worker service status. """
+def worker_status(model: Optional[str] = Option(None, '--model', '-m',
+                                                help='Display the status of the worker of this model.')) -> None:
+    """
+    Display worker service status.
+
+    Parameters
+    ----------
+    model : Optional[str], default=None
+        Name or id of the model the worker serves, the single-model worker if None.
+
+    """
 
     from aifriend.utils.cli import check_service
 
-    check_service(name='worker', pidfile=var.WORKER_PID)
+    pidfile, _ = worker_files(worker_model(model))
+    check_service(name=pidfile.stem, pidfile=pidfile)
+
+
+@cli.command(name='autoscale', help='Scale warm workers to the queue load')
+def worker_autoscale(min_workers: int = Option(var.AUTOSCALE_MIN_WORKERS, '--min', help='Minimum number of workers.'),
+                     max_workers: int = Option(var.AUTOSCALE_MAX_WORKERS, '--max', help='Maximum number of workers.'),
+                     interval: float = Option(var.AUTOSCALE_INTERVAL, '--interval', '-i',
+                                              help='Delay in seconds between queue observations.'),
+                     up_wait: float = Option(var.AUTOSCALE_UP_WAIT, '--up-wait',
+                                             help='Scale up above this p95 queue wait in seconds.'),
+                     down_wait: float = Option(var.AUTOSCALE_DOWN_WAIT, '--down-wait',
+                                               help='Scale down below this p95 queue wait in seconds.'),
+                     up_backlog: float = Option(var.AUTOSCALE_UP_BACKLOG, '--up-backlog',
+                                                help='Scale up above this number of queued tasks per worker.'),
+                     down_backlog: float = Option(var.AUTOSCALE_DOWN_BACKLOG, '--down-backlog',
+                                                  help='Scale down below this number of queued tasks per worker.'),
+                     pool: var.PoolType = Option(var.PoolType.solo, '--pool', '-p',
+                                                 help='Worker processes/threads pool type.'),
+                     loglevel: var.LogLevel = Option(var.LogLevel.info, '--loglevel', '-l', help='Logging level.'),
+                     broker_url: str = Option(var.CELERY_BROKER, '--broker', help='Broker url.'),
+                     backend_url: str = Option(var.CELERY_BACKEND, '--backend', help='Backend url.'),
+                     simulate: bool = Option(False, '--simulate', is_flag=True,
+                                             help='Run against a simulated queue instead of the broker'),
+                     sim_duration: float = Option(3600, '--sim-duration', help='Simulated time in seconds.'),
+                     sim_rate: float = Option(0.05, '--sim-rate', help='Simulated base arrival rate (tasks/s).'),
+                     sim_burst_rate: float = Option(0.5, '--sim-burst-rate',
+                                                    help='Simulated arrival rate during bursts (tasks/s).'),
+                     sim_burst_period: float = Option(900, '--sim-burst-period',
+                                                      help='Simulated seconds between burst starts.'),
+                     sim_burst_length: float = Option(300, '--sim-burst-length',
+                                                      help='Simulated burst length in seconds.'),
+                     sim_service_time: float = Option(6, '--sim-service-time',
+                                                      help='Simulated mean task duration in seconds.'),
+                     sim_warmup: float = Option(30, '--sim-warmup', help='Simulated worker warmup in seconds.'),
+                     sim_seed: int = Option(0, '--sim-seed', help='Simulation random seed.')
+                     ) -> None:
+    """
+    Start warm workers or stop them depending on the queue depth and p95 queue wait.
+
+    Parameters
+    ----------
+    min_workers : int, default=ENV(AUTOSCALE_MIN_WORKERS) or 1
+        Minimum number of workers.
+    max_workers : int, default=ENV(AUTOSCALE_MAX_WORKERS) or 4
+        Maximum number of workers.
+    interval : float, default=ENV(AUTOSCALE_INTERVAL) or 5
+        Delay in seconds between queue observations.
+    up_wait : float, default=ENV(AUTOSCALE_UP_WAIT) or 20
+        Scale up above this p95 queue wait in seconds.
+    down_wait : float, default=ENV(AUTOSCALE_DOWN_WAIT) or 5
+        Scale down below this p95 queue wait in seconds.
+    up_backlog : float, default=ENV(AUTOSCALE_UP_BACKLOG) or 4
+        Scale up above this number of queued tasks per worker.
+    down_backlog : float, default=ENV(AUTOSCALE_DOWN_BACKLOG) or 1
+        Scale down below this number of queued tasks per worker.
+    pool : str, {'prefork', 'eventlet', 'gevent', 'processes', 'threads', 'solo'}, default='solo'
+        Worker processes/threads pool type.
+    loglevel : {'debug', 'info', 'warning', 'error', 'critical'}, default='info'
+        Level of logging.
+    broker_url : str, default=ENV(CELERY_BROKER) or 'pyamqp://guest@localhost'
+        Broker url.
+    backend_url : str, default=ENV(CELERY_BACKEND) or 'redis://localhost'
+        Backend url.
+    simulate : bool, default=False
+        Run against a simulated queue instead of the broker.
+    sim_duration : float, default=3600
+        Simulated time in seconds.
+    sim_rate : float, default=0.05
+        Simulated base arrival rate (tasks/s).
+    sim_burst_rate : float, default=0.5
+        Simulated arrival rate during bursts (tasks/s).
+    sim_burst_period : float, default=900
+        Simulated seconds between burst starts.
+    sim_burst_length : float, default=300
+        Simulated burst length in seconds.
+    sim_service_time : float, default=6
+        Simulated mean task duration in seconds.
+    sim_warmup : float, default=30
+        Simulated worker warmup in seconds.
+    sim_seed : int, default=0
+        Simulation random seed.
+
+    """
+
+    from aifriend.config import log
+    from aifriend.utils.autoscale import Autoscaler, RabbitMQProbe, ScalingPolicy, ServicePool, SimulatedQueue
+
+    try:
+        policy = ScalingPolicy(min_workers=min_workers, max_workers=max_workers, up_wait=up_wait,
+                               down_wait=down_wait, up_backlog=up_backlog, down_backlog=down_backlog)
+    except ValueError as e:
+        raise BadParameter(str(e))
+
+    if simulate:
+        from rich.table import Table
+
+        from aifriend.utils.autoscale import simulate as run_simulation
+        from aifriend.utils.stats import percentile
+
+        def rate(t: float) -> float:
+            return sim_burst_rate if t % sim_burst_period < sim_burst_length else sim_rate
+
+        queue = SimulatedQueue(rate=rate, service_time=sim_service_time, warmup=sim_warmup,
+                               workers=min_workers, seed=sim_seed)
+        decisions = run_simulation(queue, policy, duration=sim_duration, interval=interval)
+
+        table = Table(title='Autoscaler simulation')
+
+        for column in ('time, s', 'ready', 'busy', 'p95 wait, s', 'workers'):
+            table.add_column(column, justify='right')
+
+        for decision in decisions:
+            if decision.target != decision.workers:
+                table.add_row(f'{decision.time:.0f}', str(decision.ready), str(decision.unacked),
+                              f'{decision.p95_wait:.1f}', f'{decision.workers} -> {decision.target}')
+
+        worker_seconds = sum(d.target for d in decisions) * interval
+
+        log.project_console.print(table)
+        log.project_console.print(f'Tasks started: {len(queue.waits)}, drained workers: {queue.drained}\n'
+                                  f'Queue wait p50: {percentile(queue.waits, 50):.1f} s, '
+                                  f'p95: {percentile(queue.waits, 95):.1f} s, '
+                                  f'max: {max(queue.waits, default=0.0):.1f} s\n'
+                                  f'Average workers: {worker_seconds / max(queue.now, interval):.2f}',
+                                  style='bright_blue')
+        return
+
+    def argv_factory(index: int) -> List[str]:
+        return worker_argv(name=f'AIfriendWorker-{index}', pool=pool, loglevel=loglevel, concurrency=1,
+                           broker_url=broker_url, backend_url=backend_url)
+
+    def env_factory(index: int) -> Dict[str, str]:
+        return {'CELERY_WARMUP': 'True', 'WORKER_METRICS_PORT': str(var.WORKER_METRICS_PORT + index)}
+
+    workers = ServicePool(argv_factory=argv_factory, env_factory=env_factory)
+    autoscaler = Autoscaler(probe=RabbitMQProbe(), pool=workers, policy=policy)
+
+    log.project_console.print(f':rocket: The worker autoscaler is started ({min_workers}-{max_workers} workers)',
+                              style='bright_blue')
+
+    try:
+        autoscaler.run(interval=interval)
+    except KeyboardInterrupt:
+        workers.scale_to(0)
+        workers.wait_drained()
+
+
+@cli.command(name='profile', help='Profile the next predict tasks')
+def worker_profile(tasks: int = Option(1, '--tasks', '-t', help='The number of predict tasks to profile.'),
+                   mode: str = Option('sampling', '--mode', '-m', help="Profiler type: 'sampling' or 'torch'."),
+                   broker_url: str = Option(var.CELERY_BROKER, '--broker', help='Broker url.')
+                   ) -> None:
+    """
+    Ask running workers to profile their next predict tasks. Traces are saved to the LOGS_DIR/profiles folder
+    of the worker: folded stacks for the sampling profiler and Chrome traces for the torch profiler.
+    The command reaches the process that executes the tasks only for the solo and threads-based pools.
+
+    Parameters
+    ----------
+    tasks : int, default=1
+        The number of predict tasks to profile.
+    mode : {'sampling', 'torch'}, default='sampling'
+        Profiler type.
+    broker_url : str, default=ENV(CELERY_BROKER) or 'pyamqp://guest@localhost'
+        Broker url.
+
+    """
+
+    from aifriend.app.api.backend.celeryapp import celery_app
+    from aifriend.config import log
+
+    celery_app.conf.broker_url = broker_url
+
+    replies = celery_app.control.broadcast('profile', arguments={'tasks': tasks, 'mode': mode}, reply=True)
+
+    if not replies:
+        log.project_console.print('No worker replied', style='yellow')
+
+    for reply in replies:
+        for hostname, result in reply.items():
+            if 'ok' in result:
+                log.project_console.print(f'{hostname}: {result["ok"]}', style='bright_blue')
+            else:
+                log.project_console.print(f'{hostname}: {result.get("error", result)}', style='red')
 
 
 @cli.command(name='attach', help='Attach local output stream to a service')
 def worker_attach(live: bool = Option(False, '--live', '-l', is_flag=True,
-                                      help='Stream only fresh log records')
+                                      help='Stream only fresh log records'),
+                  tail: int = Option(0, '--tail', '-n', help='Start from the last log lines.'),
+                  level: Optional[var.LogLevel] = Option(None, '--level', case_sensitive=False,
+                                                         help='Stream only records of this level or higher.'),
+                  pattern: Optional[str] = Option(None, '--grep', '-g',
+                                                  help='Stream only lines matching the regular expression.'),
+                  model: Optional[str] = Option(None, '--model', '-m', help='Attach to the worker of this model.')
                   ) -> None:
     """
     Attach local output stream to a running worker service.
@@ -134,14 +594,25 @@ def worker_attach(live: bool = Option(False, '--live', '-l', is_flag=True,
     ----------
     live : bool, Default=False
         Stream only fresh log records.
+    tail : int, default=0
+        Start from the last log lines. Takes precedence over live.
+    level : Optional[LogLevel], default=None
+        Stream only records of this level or higher.
+    pattern : Optional[str], default=None
+        Stream only lines matching the regular expression.
+    model : Optional[str], default=None
+        Name or id of the model the worker serves, the single-model worker if None.
 
     """
 
     from aifriend.config import log
     from aifriend.utils.cli import stream
 
+    pidfile, logfile = worker_files(worker_model(model))
+
     with log.project_console.screen():
-        for record in stream(('worker', log.WORKER_LOG), live=live):
+        for record in stream((pidfile.stem, logfile), live=live, lines=tail, level=level and level.value,
+                             pattern=pattern):
             log.project_console.print(record)
 
     log.project_console.clear()
@@ -163,7 +163,7 @@ def send(human_message: str) -> str:
         else:
             st.session_state.unseen_messages.append(human_message)
 
-        status = requests.get(url=f"{var.FASTAPI_URL}/status/{st.session_state.task_id}")
+        status = requests.get(url=f"{var.FASTAPI_URL}/status/{st.session_state.task_id}", params={"consume": "true"})
         status = status.json()
 
         while status['status_code'] == HTTPStatus.PROCESSING and status['state'] != 'PREDICT':
@@ -176,18 +176,18 @@ def send(human_message: str) -> str:
             else:
                 time.sleep(0.1)
 
-            status = requests.get(url=f'{var.FASTAPI_URL}/status/{st.session_state.task_id}')
+            status = requests.get(url=f'{var.FASTAPI_URL}/status/{st.session_state.task_id}',
+                                  params={'consume': 'true'})
             status = status.json()
 
         while status["status_code"] == HTTPStatus.PROCESSING:
             st.write(f"Typing{'.' * int(time.time() % 4)}")
             time.sleep(0.2)
 
-            status = requests.get(url=f"{var.FASTAPI_URL}/status/{st.session_state.task_id}")
+            status = requests.get(url=f"{var.FASTAPI_URL}/status/{st.session_state.task_id}",
+                                  params={"consume": "true"})
             status = status.json()
 
-        requests.delete(url=f"{var.FASTAPI_URL}/{st.session_state.task_id}")
-
         if status["status_code"] != HTTPStatus.OK:
             st.error(status["message"])
             st.stop()
@@ -1,32 +1,227 @@
+import atexit
+import json
 import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+from typing import Any, Tuple
 
 from rich.console import Console
 from rich.logging import RichHandler
 
 from aifriend.config import var
 
-var.LOGS_DIR.mkdir(parents=True, exist_ok=True)
-
 DASHBOARD_LOG = var.LOGS_DIR / 'dashboard.log'
 API_LOG = var.LOGS_DIR / 'api.log'
 WORKER_LOG = var.LOGS_DIR / 'worker.log'
+ERROR_LOG = var.LOGS_DIR / 'error.log'
+INFO_LOG = var.LOGS_DIR / 'info.log'
+TRACES_LOG = var.LOGS_DIR / 'traces.jsonl'
+PROFILES_DIR = var.LOGS_DIR / 'profiles'
+
+
+class JsonFormatter(logging.Formatter):
+    """ Format log records as single-line JSON objects """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RotatingLogFileHandler(RotatingFileHandler):
+    """
+    Log file handler that rotates the file when it grows over max_bytes or when the interval has passed,
+    and writes records either as JSON lines or rendered by Rich.
+
+    Parameters
+    ----------
+    filename : Path
+        Log file path.
+    max_bytes : int, default=ENV(LOG_MAX_BYTES) or 10 MiB
+        Rotate the file when it exceeds this size, zero disables size-based rotation.
+    backup_count : int, default=ENV(LOG_BACKUP_COUNT) or 5
+        The number of rotated files to keep.
+    interval : float, default=ENV(LOG_ROTATE_INTERVAL) or 0
+        Rotate the file every interval seconds, zero disables time-based rotation.
+    fmt : {'rich', 'json'}, default=ENV(LOG_FORMAT) or 'rich'
+        Records format.
+
+    """
+
+    def __init__(self,
+                 filename: Path,
+                 max_bytes: int = var.LOG_MAX_BYTES,
+                 backup_count: int = var.LOG_BACKUP_COUNT,
+                 interval: float = var.LOG_ROTATE_INTERVAL,
+                 fmt: str = var.LOG_FORMAT):
+        super(RotatingLogFileHandler, self).__init__(filename, mode='a', maxBytes=max_bytes,
+                                                     backupCount=backup_count, encoding='utf-8', delay=True)
+
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+        self.renderer = None
+
+        if fmt == 'json':
+            self.setFormatter(JsonFormatter())
+        else:
+            self.renderer = RichHandler(console=Console(file=open(os.devnull, 'w')), markup=True,
+                                        rich_tracebacks=True, tracebacks_show_locals=True)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+
+        if self.maxBytes > 0 and self.stream is not None:
+            return self.stream.tell() >= self.maxBytes
+
+        return False
+
+    def doRollover(self) -> None:
+        super(RotatingLogFileHandler, self).doRollover()
+
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.renderer is None:
+            return super(RotatingLogFileHandler, self).emit(record)
+
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+
+            if self.stream is None:
+                self.stream = self._open()
+
+            self.renderer.console.file = self.stream
+            self.renderer.emit(record)
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    Queue handler that only merges the message arguments on the calling thread and leaves
+    the formatting (including tracebacks rendering) to the handlers of the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+
+        return record
+
+
+class LogQueueListener(QueueListener):
+    """ Queue listener that can be stopped more than once and restarted in forked child processes. """
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            super(LogQueueListener, self).stop()
+
+    def restart(self) -> None:
+        """ Replace the queue inherited from the parent process and start the listener thread if it was running. """
+
+        self.queue = queue.SimpleQueue()
+
+        if self._thread is not None:
+            self._thread = None
+            self.start()
+
+
+def get_queue_pipeline(*handlers: logging.Handler) -> Tuple[LogQueueHandler, LogQueueListener]:
+    """
+    Create a queue handler and a started listener that passes the queued records to the given handlers
+    in a background thread. The listener is restarted in forked child processes and stopped at exit.
+
+    Parameters
+    ----------
+    *handlers : logging.Handler
+        Handlers that write the records.
+
+    Returns
+    -------
+    (queue_handler, listener) : Tuple[LogQueueHandler, LogQueueListener]
+        Handler to attach to loggers and the listener that consumes its queue.
+
+    """
+
+    listener = LogQueueListener(queue.SimpleQueue(), *handlers, respect_handler_level=True)
+    handler = LogQueueHandler(listener.queue)
+
+    def restart_in_child() -> None:
+        listener.restart()
+        handler.queue = listener.queue
+
+    listener.start()
+    atexit.register(listener.stop)
+
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=restart_in_child)
+
+    return handler, listener
+
+
+HANDLERS = ('project_logger', 'project_console', 'console_handler', 'error_handler', 'info_handler',
+            'queue_handler', 'queue_listener')
+setup_lock = threading.Lock()
+
+
+def setup() -> None:
+    """
+    Create the logs directory, the project logger handlers and the queue listener thread.
+    It runs on the first access to one of the HANDLERS attributes of the module, so that the commands
+    that do not log (e.g. the status ones) do not pay for it.
+    """
+
+    global project_logger, project_console, console_handler, error_handler, info_handler, \
+        queue_handler, queue_listener
+
+    var.LOGS_DIR.mkdir(parents=True, exist_ok=True)
+
+    project_logger = logging.getLogger('aifriend')
+    project_logger.setLevel(logging.DEBUG)
+    project_logger.propagate = False
+
+    project_console = Console(force_terminal=True, record=True)
+    console_handler = RichHandler(console=project_console, markup=True, show_time=False, show_level=False,
+                                  show_path=False)
+    console_handler.setLevel(logging.DEBUG)
+    project_logger.addHandler(hdlr=console_handler)
+
+    error_handler = RotatingLogFileHandler(ERROR_LOG)
+    error_handler.setLevel(logging.ERROR)
+
+    info_handler = RotatingLogFileHandler(INFO_LOG)
+    info_handler.setLevel(logging.INFO)
+
+    queue_handler, queue_listener = get_queue_pipeline(error_handler, info_handler)
+    queue_handler.setLevel(logging.INFO)
+    project_logger.addHandler(hdlr=queue_handler)
 
-project_logger = logging.getLogger('aifriend')
-project_logger.setLevel(logging.DEBUG)
-project_logger.propagate = False
 
-project_console = Console(force_terminal=True, record=True)
-console_handler = RichHandler(console=project_console, markup=True, show_time=False, show_level=False, show_path=False)
-console_handler.setLevel(logging.DEBUG)
-project_logger.addHandler(hdlr=console_handler)
+def __getattr__(name: str) -> Any:
+    if name not in HANDLERS:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
-error_console = Console(file=Path(var.LOGS_DIR, 'error.log').open(mode='a'))
-error_handler = RichHandler(console=error_console, markup=True, rich_tracebacks=True, tracebacks_show_locals=True)
-error_handler.setLevel(logging.ERROR)
-project_logger.addHandler(hdlr=error_handler)
+    with setup_lock:
+        if name not in globals():
+            setup()
 
-info_console = Console(file=Path(var.LOGS_DIR, 'info.log').open(mode='a'))
-info_handler = RichHandler(console=info_console, markup=True, rich_tracebacks=True, tracebacks_show_locals=True)
-info_handler.setLevel(logging.INFO)
-project_logger.addHandler(hdlr=info_handler)
+    return globals()[name]
@@ -0,0 +1,565 @@
+import itertools
+import math
+import random
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+
+import psutil
+
+from aifriend.config import var, log
+from aifriend.utils.cli import drain_service, service_alive, start_service, stop_service
+from aifriend.utils.stats import percentile
+
+
+class QueueSample(NamedTuple):
+    """ Single observation of the task queue state. """
+
+    ready: int
+    unacked: int
+    wait: float
+
+
+class ScalingDecision(NamedTuple):
+    """ Autoscaler state after processing a single queue observation. """
+
+    time: float
+    ready: int
+    unacked: int
+    workers: int
+    p95_wait: float
+    target: int
+
+
+class ScalingPolicy:
+    """
+    Thresholds that control when the autoscaler adds or removes workers.
+
+    The scale-up thresholds are expected to be higher than the scale-down ones,
+    so that the gap between them acts as a hysteresis band where nothing happens.
+
+    Parameters
+    ----------
+    min_workers : int, default=ENV(AUTOSCALE_MIN_WORKERS) or 1
+        The minimum number of workers to keep running.
+    max_workers : int, default=ENV(AUTOSCALE_MAX_WORKERS) or 4
+        The maximum number of workers to run.
+    up_wait : float, default=ENV(AUTOSCALE_UP_WAIT) or 20
+        Scale up when the p95 queue wait (seconds) is above this value.
+    down_wait : float, default=ENV(AUTOSCALE_DOWN_WAIT) or 5
+        Scale down only when the p95 queue wait (seconds) is below this value.
+    up_backlog : float, default=ENV(AUTOSCALE_UP_BACKLOG) or 4
+        Scale up when the number of ready messages per worker is above this value.
+    down_backlog : float, default=ENV(AUTOSCALE_DOWN_BACKLOG) or 1
+        Scale down only when the number of ready messages per worker is below this value.
+    up_samples : int, default=2
+        The number of consecutive overloaded observations required to scale up.
+    down_samples : int, default=6
+        The number of consecutive underloaded observations required to scale down.
+    up_cooldown : float, default=ENV(AUTOSCALE_UP_COOLDOWN) or 30
+        The minimum number of seconds between two scale-up actions.
+    down_cooldown : float, default=ENV(AUTOSCALE_DOWN_COOLDOWN) or 120
+        The minimum number of seconds between any scaling action and a scale-down action.
+    window : int, default=ENV(AUTOSCALE_WINDOW) or 12
+        The number of recent observations used to compute the p95 queue wait.
+
+    Raises
+    ------
+    ValueError:
+        If the worker limits or thresholds are inconsistent.
+
+    """
+
+    def __init__(self,
+                 min_workers: int = var.AUTOSCALE_MIN_WORKERS,
+                 max_workers: int = var.AUTOSCALE_MAX_WORKERS,
+                 up_wait: float = var.AUTOSCALE_UP_WAIT,
+                 down_wait: float = var.AUTOSCALE_DOWN_WAIT,
+                 up_backlog: float = var.AUTOSCALE_UP_BACKLOG,
+                 down_backlog: float = var.AUTOSCALE_DOWN_BACKLOG,
+                 up_samples: int = 2,
+                 down_samples: int = 6,
+                 up_cooldown: float = var.AUTOSCALE_UP_COOLDOWN,
+                 down_cooldown: float = var.AUTOSCALE_DOWN_COOLDOWN,
+                 window: int = var.AUTOSCALE_WINDOW):
+        if not 0 <= min_workers <= max_workers:
+            raise ValueError(f'Invalid worker limits: min={min_workers}, max={max_workers}')
+        if down_wait > up_wait or down_backlog > up_backlog:
+            raise ValueError('Scale-down thresholds must not exceed scale-up thresholds')
+
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.up_wait = up_wait
+        self.down_wait = down_wait
+        self.up_backlog = up_backlog
+        self.down_backlog = down_backlog
+        self.up_samples = up_samples
+        self.down_samples = down_samples
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.window = window
+
+
+class RabbitMQProbe:
+    """
+    Observe the task queues through the RabbitMQ management HTTP API.
+
+    The queue wait is estimated with Little's law as the number of ready messages
+    divided by the current acknowledgement rate. Since tasks are acknowledged late,
+    the acknowledgement rate is the rate at which workers complete tasks.
+
+    The counts and rates are summed over the queues a task can wait in, like the admission control of the API:
+    the shared queues and, with sticky routing, the direct '<hostname>.dq2' queues of the workers.
+
+    Parameters
+    ----------
+    api_url : str, default=ENV(BROKER_API_URL)
+        RabbitMQ management API url including credentials.
+    queues : Optional[List[str]], default=None
+        Names of the observed shared queues, ENV(CELERY_QUEUE) and the queues of the models in ENV(MODELS) if None.
+    direct : bool, default=ENV(STICKY_ROUTING)
+        Whether the direct queues of the workers are observed too.
+    vhost : str, default='/'
+        RabbitMQ virtual host of the queues.
+    timeout : float, default=5
+        HTTP request timeout in seconds.
+
+    """
+
+    def __init__(self,
+                 api_url: str = var.BROKER_API_URL,
+                 queues: Optional[List[str]] = None,
+                 direct: bool = var.STICKY_ROUTING,
+                 vhost: str = '/',
+                 timeout: float = 5):
+        from aifriend.app.api.backend.routing import model_queue
+
+        self.url = f'{api_url.rstrip("/")}/queues/{quote(vhost, safe="")}'
+        self.queues = set(queues or [var.CELERY_QUEUE, *map(model_queue, var.MODELS)])
+        self.direct = direct
+        self.timeout = timeout
+
+    def observed(self, name: str) -> bool:
+        """ Check if the queue with the given name is observed. """
+
+        from celery.utils.nodenames import WORKER_DIRECT_QUEUE_FORMAT
+
+        return name in self.queues or (self.direct and name.endswith(WORKER_DIRECT_QUEUE_FORMAT.format(hostname='')))
+
+    def sample(self) -> QueueSample:
+        """ Get the current state of the observed queues. """
+
+        import requests
+
+        response = requests.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+
+        ready, unacked, ack_rate = 0, 0, 0.0
+
+        for info in response.json():
+            if not self.observed(info.get('name', '')):
+                continue
+
+            ready += int(info.get('messages_ready', 0))
+            unacked += int(info.get('messages_unacknowledged', 0))
+            ack_rate += float(info.get('message_stats', {}).get('ack_details', {}).get('rate', 0.0))
+
+        if ready == 0:
+            wait = 0.0
+        elif ack_rate > 0:
+            wait = ready / ack_rate
+        else:
+            wait = math.inf
+
+        return QueueSample(ready=ready, unacked=unacked, wait=wait)
+
+
+class ServicePool:
+    """
+    A set of numbered worker services managed through pid and log files. Stopped workers are drained:
+    they stop consuming and exit once their current task is finished, and are killed only after the drain timeout.
+
+    Parameters
+    ----------
+    argv_factory : Callable[[int], List[str]]
+        Function that builds the command of the worker service with the given index.
+    name : str, default='worker'
+        Base name of the worker services.
+    env_factory : Optional[Callable[[int], Dict[str, str]]], default=None
+        Function that builds extra environment variables of the worker service with the given index.
+    drain_timeout : float, default=ENV(WORKER_DRAIN_TIMEOUT) or 600
+        Delay in seconds given to a stopped worker service to finish its current task.
+
+    """
+
+    def __init__(self,
+                 argv_factory: Callable[[int], List[str]],
+                 name: str = 'worker',
+                 env_factory: Optional[Callable[[int], Dict[str, str]]] = None,
+                 drain_timeout: float = var.WORKER_DRAIN_TIMEOUT):
+        self.argv_factory = argv_factory
+        self.name = name
+        self.env_factory = env_factory
+        self.drain_timeout = drain_timeout
+        self.indices = sorted(index for index in self._pidfile_indices() if self._is_alive(index))
+        self.draining: Dict[int, Tuple[psutil.Process, float]] = dict()
+
+    @property
+    def size(self) -> int:
+        """ The number of running worker services, the draining ones excluded. """
+
+        self.reap()
+
+        return len(self.indices)
+
+    def pidfile(self, index: int) -> Path:
+        """ Path to the pid file of the worker service with the given index. """
+
+        return var.CONFIG_DIR / f'{self.name}-{index}.pid'
+
+    def logfile(self, index: int) -> Path:
+        """ Path to the log file of the worker service with the given index. """
+
+        return var.LOGS_DIR / f'{self.name}-{index}.log'
+
+    def _pidfile_indices(self) -> List[int]:
+        return [int(path.stem.rsplit('-', 1)[1]) for path in var.CONFIG_DIR.glob(f'{self.name}-*.pid')
+                if path.stem.rsplit('-', 1)[1].isdigit()]
+
+    def _is_alive(self, index: int) -> bool:
+        try:
+            return service_alive(int(self.pidfile(index).read_text()), self.pidfile(index))
+        except (OSError, ValueError):
+            return False
+
+    def reap(self) -> None:
+        """ Clean up the draining worker services that have exited and kill the ones past the drain timeout. """
+
+        now = time.monotonic()
+
+        for index, (service, deadline) in list(self.draining.items()):
+            gone, _ = psutil.wait_procs([service], timeout=0)
+
+            if gone:
+                del self.draining[index]
+                self.pidfile(index).unlink(missing_ok=True)
+                self.logfile(index).unlink(missing_ok=True)
+                log.project_console.print(f'The {self.name}-{index} service is stopped', style='bright_blue')
+
+            elif now >= deadline:
+                del self.draining[index]
+                stop_service(name=f'{self.name}-{index}', pidfile=self.pidfile(index), logfile=self.logfile(index))
+
+    def wait_drained(self, period: float = 1) -> None:
+        """ Wait until the draining worker services have exited. """
+
+        while self.draining:
+            time.sleep(period)
+            self.reap()
+
+    def scale_to(self, n_workers: int) -> None:
+        """
+        Start or stop worker services so that exactly n_workers are running.
+        The most recently started workers are stopped first and drain without blocking the caller.
+
+        Parameters
+        ----------
+        n_workers : int
+            Desired number of running worker services.
+
+        """
+
+        while self.size < n_workers:
+            index = next(i for i in itertools.count() if i not in self.indices and i not in self.draining)
+            start_service(self.argv_factory(index), name=f'{self.name}-{index}',
+                          logfile=self.logfile(index), pidfile=self.pidfile(index),
+                          env=self.env_factory(index) if self.env_factory else None)
+            self.indices.append(index)
+
+        while self.size > n_workers:
+            index = self.indices.pop()
+
+            if service := drain_service(self.pidfile(index)):
+                self.draining[index] = (service, time.monotonic() + self.drain_timeout)
+                log.project_console.print(f'The {self.name}-{index} service is draining', style='bright_blue')
+            else:
+                stop_service(name=f'{self.name}-{index}', pidfile=self.pidfile(index), logfile=self.logfile(index))
+
+
+class SimulatedQueue:
+    """
+    Discrete-event model of the task queue and its workers used to evaluate the autoscaler
+    without a broker or real worker processes. It acts as both the probe and the worker pool.
+
+    Parameters
+    ----------
+    rate : Callable[[float], float]
+        Message arrival rate (messages per second) as a function of the simulated time.
+    service_time : float
+        Mean time in seconds that a worker spends on a single message.
+    warmup : float, default=0
+        Time in seconds a newly started worker needs before it consumes messages (model loading).
+    workers : int, default=0
+        The number of initially running (warm) workers.
+    seed : int, default=0
+        Random seed that makes the simulation reproducible.
+
+    """
+
+    def __init__(self,
+                 rate: Callable[[float], float],
+                 service_time: float,
+                 warmup: float = 0,
+                 workers: int = 0,
+                 seed: int = 0):
+        self.rate = rate
+        self.service_time = service_time
+        self.warmup = warmup
+        self.now = 0.0
+        self.drained = 0
+        self.waits: List[float] = list()
+
+        self._random = random.Random(seed)
+        self._queue: Deque[float] = deque()
+        self._workers: List[Dict[str, Optional[float]]] = [
+            {'ready_at': 0.0, 'free_at': 0.0, 'current': None} for _ in range(workers)
+        ]
+        self._draining: List[Dict[str, Optional[float]]] = list()
+        self._tick_waits: List[float] = list()
+        self._next_arrival = self._interarrival(0.0)
+
+    def _interarrival(self, at: float) -> float:
+        rate = self.rate(at)
+
+        return at + (self._random.expovariate(rate) if rate > 0 else 1.0)
+
+    def clock(self) -> float:
+        """ Current simulated time in seconds. """
+
+        return self.now
+
+    @property
+    def size(self) -> int:
+        """ The number of running workers. """
+
+        return len(self._workers)
+
+    def scale_to(self, n_workers: int) -> None:
+        """
+        Start or stop workers so that exactly n_workers are running. Idle workers are stopped first,
+        a stopped busy worker drains: it takes no new message and leaves once its current one is finished.
+
+        Parameters
+        ----------
+        n_workers : int
+            Desired number of running workers.
+
+        """
+
+        while self.size < n_workers:
+            self._workers.append({'ready_at': self.now + self.warmup, 'free_at': 0.0, 'current': None})
+
+        while self.size > n_workers:
+            worker = min(self._workers, key=lambda w: w['free_at'])
+            self._workers.remove(worker)
+
+            if worker['free_at'] > self.now:
+                self._draining.append(worker)
+                self.drained += 1
+
+    def advance(self, dt: float) -> None:
+        """
+        Advance the simulation by dt seconds.
+
+        Parameters
+        ----------
+        dt : float
+            Simulated time step in seconds.
+
+        """
+
+        end = self.now + dt
+
+        while self._next_arrival < end:
+            self._queue.append(self._next_arrival)
+            self._next_arrival = self._interarrival(self._next_arrival)
+
+        self._tick_waits = list()
+
+        while self._queue and self._workers:
+            worker = min(self._workers, key=lambda w: max(w['free_at'], w['ready_at']))
+            start = max(worker['free_at'], worker['ready_at'], self._queue[0])
+
+            if start >= end:
+                break
+
+            arrival = self._queue.popleft()
+            worker['current'] = arrival
+            worker['free_at'] = start + self._random.expovariate(1 / self.service_time)
+
+            self._tick_waits.append(start - arrival)
+            self.waits.append(start - arrival)
+
+        self._draining = [worker for worker in self._draining if worker['free_at'] > end]
+        self.now = end
+
+    def sample(self) -> QueueSample:
+        """ Get the current queue state. """
+
+        wait = max(self._tick_waits, default=0.0)
+
+        if self._queue:
+            wait = max(wait, self.now - self._queue[0])
+
+        return QueueSample(ready=len(self._queue),
+                           unacked=sum(1 for w in self._workers + self._draining if w['free_at'] > self.now),
+                           wait=wait)
+
+
+class Autoscaler:
+    """
+    Supervisor that adjusts the number of workers to the observed queue depth and p95 queue wait.
+
+    Parameters
+    ----------
+    probe : RabbitMQProbe or SimulatedQueue
+        Object with a sample() method that returns the current QueueSample.
+    pool : ServicePool or SimulatedQueue
+        Object with a size property and a scale_to(n_workers) method.
+    policy : ScalingPolicy
+        Scaling thresholds.
+    clock : Callable[[], float], default=time.monotonic
+        Time source in seconds.
+
+    """
+
+    def __init__(self, probe, pool, policy: ScalingPolicy, clock: Callable[[], float] = time.monotonic):
+        self.probe = probe
+        self.pool = pool
+        self.policy = policy
+        self.clock = clock
+
+        self._waits: Deque[float] = deque(maxlen=policy.window)
+        self._up_streak = 0
+        self._down_streak = 0
+        self._last_up = -math.inf
+        self._last_change = -math.inf
+
+    def step(self) -> ScalingDecision:
+        """
+        Observe the queue once and start or stop workers if the policy requires it.
+
+        Returns
+        -------
+        ScalingDecision:
+            Observed queue state together with the number of workers before and after the step.
+
+        """
+
+        policy = self.policy
+        sample = self.probe.sample()
+        now = self.clock()
+
+        self._waits.append(sample.wait)
+        p95_wait = percentile(self._waits, 95)
+
+        workers = self.pool.size
+        backlog = sample.ready / max(workers, 1)
+        target = workers
+
+        if workers < policy.min_workers or workers > policy.max_workers:
+            target = min(max(workers, policy.min_workers), policy.max_workers)
+
+        elif p95_wait > policy.up_wait or backlog > policy.up_backlog:
+            self._up_streak += 1
+            self._down_streak = 0
+
+            if self._up_streak >= policy.up_samples and now - self._last_up >= policy.up_cooldown:
+                needed = math.ceil(sample.ready / policy.up_backlog) if policy.up_backlog > 0 else workers + 1
+                target = min(policy.max_workers, workers + max(1, needed - workers))
+
+        elif p95_wait < policy.down_wait and backlog < policy.down_backlog and sample.unacked < workers:
+            self._down_streak += 1
+            self._up_streak = 0
+
+            if self._down_streak >= policy.down_samples and now - self._last_change >= policy.down_cooldown:
+                target = max(policy.min_workers, workers - 1)
+
+        else:
+            self._up_streak = 0
+            self._down_streak = 0
+
+        if target != workers:
+            self.pool.scale_to(target)
+
+            if target > workers:
+                self._last_up = now
+
+            self._last_change = now
+            self._up_streak = 0
+            self._down_streak = 0
+
+        return ScalingDecision(time=now, ready=sample.ready, unacked=sample.unacked, workers=workers,
+                               p95_wait=p95_wait, target=target)
+
+    def run(self, interval: float = var.AUTOSCALE_INTERVAL) -> None:
+        """
+        Observe the queue and scale the workers forever.
+
+        Parameters
+        ----------
+        interval : float, default=ENV(AUTOSCALE_INTERVAL) or 5
+            Delay in seconds between two observations.
+
+        """
+
+        while True:
+            try:
+                decision = self.step()
+            except Exception as e:
+                log.project_logger.error(f'Autoscaler failed to observe the queue: {e}')
+            else:
+                if decision.target != decision.workers:
+                    log.project_console.print(f'Scale workers {decision.workers} -> {decision.target} '
+                                              f'(ready={decision.ready}, p95 wait={decision.p95_wait:.1f} s)',
+                                              style='bright_blue')
+
+            time.sleep(interval)
+
+
+def simulate(queue: SimulatedQueue,
+             policy: ScalingPolicy,
+             duration: float,
+             interval: float = var.AUTOSCALE_INTERVAL
+             ) -> List[ScalingDecision]:
+    """
+    Run the autoscaler against a simulated queue.
+
+    Parameters
+    ----------
+    queue : SimulatedQueue
+        Simulated queue and worker pool.
+    policy : ScalingPolicy
+        Scaling thresholds.
+    duration : float
+        Simulated duration in seconds.
+    interval : float, default=ENV(AUTOSCALE_INTERVAL) or 5
+        Simulated delay in seconds between two observations.
+
+    Returns
+    -------
+    List[ScalingDecision]:
+        Autoscaler decisions for every observation.
+
+    """
+
+    autoscaler = Autoscaler(probe=queue, pool=queue, policy=policy, clock=queue.clock)
+    decisions = list()
+
+    while queue.now < duration:
+        queue.advance(interval)
+        decisions.append(autoscaler.step())
+
+    return decisions
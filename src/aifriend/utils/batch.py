@@ -0,0 +1,238 @@
+import itertools
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from aifriend.config import var, log
+
+llm = None
+
+
+def read_records(path: Path) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """ Stream the records of a JSONL file with their line numbers, skipping the blank lines. """
+
+    with path.open(encoding='utf-8') as f:
+        for index, line in enumerate(f):
+            if line.strip():
+                yield index, json.loads(line)
+
+
+def completed_records(path: Path) -> Set[int]:
+    """
+    Get the input line numbers of the records already written to an output file, so that a run resumes
+    after them. A partially written last line, e.g. of an interrupted run, is cut from the file.
+    """
+
+    if not path.exists():
+        return set()
+
+    completed = set()
+
+    with path.open('rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+
+        if end < len(data):
+            f.truncate(end)
+
+    for line in data[:end].splitlines():
+        if line.strip():
+            completed.add(json.loads(line)['index'])
+
+    return completed
+
+
+def length_sorted_batches(records: Iterator[Tuple[int, Dict[str, Any]]],
+                          batch_size: int,
+                          window: int
+                          ) -> Iterator[List[Tuple[int, Dict[str, Any]]]]:
+    """
+    Group the streamed records into batches of similar prompt lengths: every window of records
+    is sorted by the prompt length, so that a batch wastes few padding tokens, and cut into batches.
+    """
+
+    from aifriend.app.api.backend.routing import prompt_length
+
+    while chunk := list(itertools.islice(records, max(window, batch_size))):
+        chunk.sort(key=lambda item: prompt_length(item[1].get('message', ''), item[1].get('history', list())))
+
+        for start in range(0, len(chunk), batch_size):
+            yield chunk[start:start + batch_size]
+
+
+def load_llm(threads: Optional[int] = None) -> None:
+    """ Load the language model of the process once, in a worker process of the pool or in the main one. """
+
+    global llm
+
+    import torch
+
+    from aifriend.utils.inference import get_llm
+
+    if threads:
+        torch.set_num_threads(threads)
+
+    if llm is None:
+        llm = get_llm()
+
+
+def answer(batch: List[Tuple[int, Dict[str, Any]]], llm_kwargs: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Answer the last message of each conversation of a batch with a single generation call.
+
+    Parameters
+    ----------
+    batch : List[Tuple[int, Dict[str, Any]]]
+        Input line numbers and records with the 'message' and optional 'history' and 'id' fields.
+    llm_kwargs : Dict[str, Any]
+        Generation kwargs of the whole batch.
+
+    Returns
+    -------
+    List[Dict[str, Any]]:
+        Output records with the input line number, the id, the response, the updated history and the token counts.
+
+    """
+
+    from langchain.schema import messages_to_dict
+
+    from aifriend.utils.inference import get_conversation_chain
+
+    chains, prompts = list(), list()
+
+    for _, record in batch:
+        chain = get_conversation_chain(llm=llm, history=record.get('history', list()))
+        inputs = chain.prep_inputs(record['message'])
+        chains.append((chain, inputs))
+        prompts.append(chain.prompt.format(**{key: inputs[key] for key in chain.prompt.input_variables}))
+
+    result = llm.generate(prompts, **llm_kwargs)
+    outputs = list()
+
+    for (index, record), (chain, inputs), generations in zip(batch, chains, result.generations):
+        response = chain.output_parser.parse(generations[0].text)
+        chain.memory.save_context(inputs, {chain.output_key: response})
+        info = generations[0].generation_info or dict()
+
+        outputs.append({
+            'index': index,
+            'id': record.get('id'),
+            'response': response,
+            'history': messages_to_dict(chain.memory.chat_memory.messages),
+            'prompt_tokens': info.get('prompt_tokens'),
+            'generated_tokens': info.get('generated_tokens', len(generations[0].text.split())),
+        })
+
+    return outputs
+
+
+def run_batch(input_path: Path,
+              output_path: Path,
+              batch_size: int = 8,
+              window: int = 256,
+              workers: int = 1,
+              llm_kwargs: Optional[Dict[str, Any]] = None
+              ) -> Dict[str, Any]:
+    """
+    Answer the conversations of a JSONL file offline, without the API and the broker.
+
+    Each input line is a record with the 'message' to answer, an optional 'history' in the langchain
+    messages_to_dict format and an optional 'id'. The records are streamed, grouped into batches
+    of similar prompt lengths and each batch is generated in a single padded model call. The output
+    records are appended as soon as their batch is done, with the input line number in 'index',
+    so they are not in the input order. A run resumes after the records already in the output file.
+
+    Parameters
+    ----------
+    input_path : Path
+        Input JSONL file.
+    output_path : Path
+        Output JSONL file, appended to.
+    batch_size : int, default=8
+        The number of conversations per model call.
+    window : int, default=256
+        The number of records sorted by prompt length at once, a larger window pads less
+        but delays the first results.
+    workers : int, default=1
+        The number of processes, each of them loads the model once and uses a share of the CPU threads.
+    llm_kwargs : Optional[Dict[str, Any]], default=None
+        Generation kwargs of all the records, e.g. max_new_tokens, temperature or seed.
+
+    Returns
+    -------
+    report : Dict[str, Any]
+        Run report with the number of answered and skipped records and the throughput.
+
+    """
+
+    llm_kwargs = llm_kwargs or dict()
+    completed = completed_records(output_path)
+    records = ((index, record) for index, record in read_records(input_path) if index not in completed)
+    answered = prompt_tokens = generated_tokens = 0
+
+    if completed:
+        log.project_console.print(f'Resuming after {len(completed)} completed records', style='bright_blue')
+
+    if workers > 1:
+        results = answer_in_processes(length_sorted_batches(records, batch_size, window), llm_kwargs, workers)
+    else:
+        load_llm()
+        results = (answer(batch, llm_kwargs) for batch in length_sorted_batches(records, batch_size, window))
+
+    started = time.perf_counter()
+
+    with output_path.open('a', encoding='utf-8') as f:
+        for outputs in results:
+            f.writelines(json.dumps(output, ensure_ascii=False) + '\n' for output in outputs)
+            f.flush()
+
+            answered += len(outputs)
+            prompt_tokens += sum(output['prompt_tokens'] or 0 for output in outputs)
+            generated_tokens += sum(output['generated_tokens'] for output in outputs)
+            log.project_logger.info(f'Answered {answered} records, '
+                                    f'{answered / (time.perf_counter() - started):.2f} records/s')
+
+    elapsed = time.perf_counter() - started
+
+    return {
+        'model': var.MODEL_ID,
+        'answered': answered,
+        'skipped': len(completed),
+        'workers': workers,
+        'batch_size': batch_size,
+        'elapsed_sec': elapsed,
+        'records_per_sec': answered / elapsed if elapsed > 0 else None,
+        'prompt_tokens_per_sec': prompt_tokens / elapsed if elapsed > 0 else None,
+        'generated_tokens_per_sec': generated_tokens / elapsed if elapsed > 0 else None,
+    }
+
+
+def answer_in_processes(batches: Iterator[List[Tuple[int, Dict[str, Any]]]],
+                        llm_kwargs: Dict[str, Any],
+                        workers: int
+                        ) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Answer the batches in worker processes that share the CPU threads and load the model once each,
+    keeping two batches per process in flight so that the input is still streamed.
+    The elapsed time of the run includes the model loads.
+    """
+
+    import multiprocessing
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    threads = max((os.cpu_count() or 1) // workers, 1)
+    pending = set()
+
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=load_llm, initargs=(threads,)) as executor:
+        for batch in itertools.chain(batches, [None]):
+            if batch is not None:
+                pending.add(executor.submit(answer, batch, llm_kwargs))
+
+            while pending and (batch is None or len(pending) >= 2 * workers):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield future.result()
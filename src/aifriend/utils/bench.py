@@ -0,0 +1,1124 @@
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http import HTTPStatus
+from queue import PriorityQueue
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+from kombu.transport import TRANSPORT_ALIASES, memory
+
+from aifriend.config import var
+from aifriend.utils.stats import percentile
+
+
+class PriorityMemoryChannel(memory.Channel):
+    """ In-memory channel that delivers messages by priority like RabbitMQ priority queues (higher first). """
+
+    queues = {}
+    counter = itertools.count()
+
+    def _new_queue(self, queue, **kwargs):
+        if queue not in self.queues:
+            self.queues[queue] = PriorityQueue()
+
+    def _queue_for(self, queue):
+        if queue not in self.queues:
+            self.queues[queue] = PriorityQueue()
+        return self.queues[queue]
+
+    def _put(self, queue, message, **kwargs):
+        self._queue_for(queue).put((-self._get_message_priority(message), next(self.counter), message))
+
+    def _put_fanout(self, exchange, message, routing_key=None, **kwargs):
+        for queue in self._lookup(exchange, routing_key):
+            self._put(queue, message)
+
+    def _get(self, queue, timeout=None):
+        return self._queue_for(queue).get(block=False)[-1]
+
+
+class PriorityMemoryTransport(memory.Transport):
+    """ In-memory transport with message priorities. """
+
+    Channel = PriorityMemoryChannel
+
+
+TRANSPORT_ALIASES.setdefault('prioritymemory', f'{__name__}:PriorityMemoryTransport')
+
+
+def synthetic_conversation(seed: int, turns: int, min_words: int = 3, max_words: int = 20) -> List[str]:
+    """
+    Generate deterministic human messages of a single conversation.
+
+    Parameters
+    ----------
+    seed : int
+        Random seed of the conversation.
+    turns : int
+        The number of human messages.
+    min_words : int, default=3
+        The minimum number of words in a message.
+    max_words : int, default=20
+        The maximum number of words in a message.
+
+    Returns
+    -------
+    List[str]:
+        Human messages.
+
+    """
+
+    generator = random.Random(seed)
+
+    return [' '.join(generator.choice(var.BENCH_WORDS) for _ in range(generator.randint(min_words, max_words)))
+            for _ in range(turns)]
+
+
+@contextmanager
+def local_stack(token_delay: float = var.FAKE_TOKEN_DELAY,
+                prompt_token_delay: float = var.FAKE_PROMPT_TOKEN_DELAY
+                ) -> Generator[str, None, None]:
+    """
+    Run the API and a worker with the fake model inside the current process,
+    using the in-memory broker (with message priorities) and result backend instead of RabbitMQ and Redis.
+
+    Parameters
+    ----------
+    token_delay : float, default=ENV(FAKE_TOKEN_DELAY) or 0.005
+        Fake model decoding time per generated token in seconds.
+    prompt_token_delay : float, default=ENV(FAKE_PROMPT_TOKEN_DELAY) or 0.0001
+        Fake model prefill time per prompt token in seconds.
+
+    Yields
+    ------
+    str:
+        Url of the local API.
+
+    """
+
+    import uvicorn
+    from celery.contrib.testing.worker import start_worker
+
+    from aifriend.app.api.aifriendapi import api
+    from aifriend.app.api.backend.celeryapp import celery_app
+    from aifriend.app.api.backend.tasks import predict
+    from aifriend.utils.inference import FakeLLM
+
+    celery_app.conf.update({
+        'broker_url': 'prioritymemory://',
+        'result_backend': 'cache+memory://',
+    })
+    predict.llm = FakeLLM(token_delay=token_delay, prompt_token_delay=prompt_token_delay)
+
+    server = uvicorn.Server(uvicorn.Config(api, host='127.0.0.1', port=0, log_level='error'))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+
+    with start_worker(celery_app, pool='solo', perform_ping_check=False):
+        server_thread.start()
+
+        while not server.started:
+            time.sleep(0.01)
+
+        host, port = server.servers[0].sockets[0].getsockname()[:2]
+
+        try:
+            yield f'http://{host}:{port}'
+        finally:
+            server.should_exit = True
+            server_thread.join()
+
+
+def run_conversation(url: str,
+                     messages: List[str],
+                     poll: float,
+                     limits: Optional[List[Optional[int]]] = None
+                     ) -> Dict[str, Any]:
+    """
+    Replay a single conversation against the API turn by turn.
+
+    Parameters
+    ----------
+    url : str
+        API url.
+    messages : List[str]
+        Human messages of the conversation.
+    poll : float
+        Delay in seconds between two status requests.
+    limits : Optional[List[Optional[int]]], default=None
+        The max_new_tokens of each message, the server limit if None.
+
+    Returns
+    -------
+    Dict[str, Any]:
+        Per-turn latencies, queue waits, reply token counts and token limits, the time to the first reply,
+        the number of errors and the number of messages rejected by the API admission control
+        (the conversation stops on rejection).
+
+    """
+
+    import requests
+
+    result = {'latency': list(), 'queue_wait': list(), 'tokens': list(), 'limits': list(), 'ttfr': None,
+              'errors': 0, 'rejected': 0}
+    history = list()
+    started = time.perf_counter()
+
+    with requests.Session() as session:
+        for message, limit in zip(messages, limits or itertools.repeat(None)):
+            sent = time.perf_counter()
+            payload = {'message': message, 'history': history}
+
+            if limit:
+                payload['max_new_tokens'] = limit
+
+            try:
+                task_info = session.post(url=f'{url}/talk', json=payload)
+
+                if task_info.status_code in (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE):
+                    result['rejected'] += 1
+                    break
+
+                if not (task_id := task_info.json().get('task_id')):
+                    result['errors'] += 1
+                    break
+
+                picked = None
+
+                while True:
+                    status = session.get(url=f'{url}/status/{task_id}', params={'consume': 'true'}).json()
+
+                    if picked is None and status.get('state') != 'PENDING':
+                        picked = time.perf_counter()
+
+                    if status['status_code'] != HTTPStatus.PROCESSING:
+                        break
+
+                    time.sleep(poll)
+
+            except (requests.RequestException, ValueError, KeyError):
+                result['errors'] += 1
+                break
+
+            if status['status_code'] != HTTPStatus.OK:
+                result['errors'] += 1
+                break
+
+            replied = time.perf_counter()
+
+            if result['ttfr'] is None:
+                result['ttfr'] = replied - started
+
+            result['latency'].append(replied - sent)
+
+            if 'enqueued' in (timings := status.get('timings') or {}):
+                result['queue_wait'].append(timings['dequeued'] - timings['enqueued'])
+            else:
+                result['queue_wait'].append(picked - sent)
+
+            result['tokens'].append(len(status['message'].split()))
+            result['limits'].append(limit)
+            history = status['history']
+
+    return result
+
+
+def run_load(url: str,
+             conversations: int,
+             turns: int,
+             concurrency: int,
+             rate: float = 0,
+             poll: float = 0.05,
+             seed: int = 0,
+             max_tokens: Tuple[int, ...] = ()
+             ) -> Dict[str, Any]:
+    """
+    Replay synthetic multi-turn conversations against the API and summarize the observed performance.
+
+    Parameters
+    ----------
+    url : str
+        API url.
+    conversations : int
+        The number of conversations.
+    turns : int
+        The number of human messages per conversation.
+    concurrency : int
+        The maximum number of simultaneous conversations.
+    rate : float, default=0
+        Conversation arrival rate per second (Poisson process). Zero starts conversations
+        as soon as the concurrency limit allows.
+    poll : float, default=0.05
+        Delay in seconds between two status requests.
+    seed : int, default=0
+        Random seed of the synthetic conversations and arrivals.
+    max_tokens : Tuple[int, ...], default=()
+        The max_new_tokens values each message picks from at random, the server limit if empty.
+        With several values the latency is also reported per value.
+
+    Returns
+    -------
+    report : Dict[str, Any]
+        Benchmark report. Latencies are in seconds, tokens are whitespace-separated words.
+
+    """
+
+    generator = random.Random(seed)
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = list()
+
+        for i in range(conversations):
+            if rate > 0 and i > 0:
+                time.sleep(generator.expovariate(rate))
+
+            messages = synthetic_conversation(seed=seed * conversations + i, turns=turns)
+            limits = [generator.choice(max_tokens) for _ in messages] if max_tokens else None
+            futures.append(executor.submit(run_conversation, url, messages, poll, limits))
+
+        results = [future.result() for future in futures]
+
+    duration = time.perf_counter() - started
+
+    latency = [x for r in results for x in r['latency']]
+    queue_wait = [x for r in results for x in r['queue_wait']]
+    ttfr = [r['ttfr'] for r in results if r['ttfr'] is not None]
+    tokens = sum(sum(r['tokens']) for r in results)
+    errors = sum(r['errors'] for r in results)
+    rejected = sum(r['rejected'] for r in results)
+
+    report = {
+        'conversations': conversations,
+        'turns': len(latency),
+        'concurrency': concurrency,
+        'rate': rate,
+        'duration': duration,
+        'throughput': len(latency) / duration,
+        'tokens_per_sec': tokens / duration,
+        'errors': errors,
+        'error_rate': errors / max(len(latency) + errors, 1),
+        'rejected': rejected,
+        'rejection_rate': rejected / max(len(latency) + errors + rejected, 1),
+        'ttfr': summarize(ttfr),
+        'latency': summarize(latency),
+        'queue_wait': summarize(queue_wait),
+    }
+
+    if len(max_tokens) > 1:
+        for limit in sorted(set(max_tokens)):
+            report[f'latency_{limit}'] = summarize([x for r in results
+                                                    for x, m in zip(r['latency'], r['limits']) if m == limit])
+
+    return report
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Compute the mean, the max and the common percentiles of the given values.
+
+    Parameters
+    ----------
+    values : List[float]
+        Observed values.
+
+    Returns
+    -------
+    Dict[str, Optional[float]]:
+        Statistics of the values or Nones if there are no values.
+
+    """
+
+    if not values:
+        return {'mean': None, 'p50': None, 'p90': None, 'p95': None, 'p99': None, 'max': None}
+
+    return {
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+
+def run_logging(records: int = 2000, error_every: int = 50) -> Dict[str, Any]:
+    """
+    Measure the time the calling thread spends per log record with the synchronous Rich file handlers
+    and with the queued pipelines, writing to a temporary directory.
+
+    Parameters
+    ----------
+    records : int, default=2000
+        The number of records per pipeline.
+    error_every : int, default=50
+        Log every n-th record as an error with a traceback, zero disables errors.
+
+    Returns
+    -------
+    report : Dict[str, Any]
+        Benchmark report. Overheads are in microseconds per record.
+
+    """
+
+    import logging
+    import tempfile
+    from pathlib import Path
+
+    from rich.console import Console
+    from rich.logging import RichHandler
+
+    from aifriend.config.log import RotatingLogFileHandler, get_queue_pipeline
+
+    report = {'records': records, 'error_every': error_every}
+
+    with tempfile.TemporaryDirectory() as directory:
+        def sync_rich() -> List[logging.Handler]:
+            handlers = list()
+
+            for name, level in (('error', logging.ERROR), ('info', logging.INFO)):
+                handler = RichHandler(console=Console(file=Path(directory, f'sync-{name}.log').open(mode='a')),
+                                      markup=True, rich_tracebacks=True, tracebacks_show_locals=True)
+                handler.setLevel(level)
+                handlers.append(handler)
+
+            return handlers
+
+        def queued(fmt: str) -> List[logging.Handler]:
+            handlers = list()
+
+            for name, level in (('error', logging.ERROR), ('info', logging.INFO)):
+                handler = RotatingLogFileHandler(Path(directory, f'queued-{fmt}-{name}.log'), fmt=fmt)
+                handler.setLevel(level)
+                handlers.append(handler)
+
+            handler, listener = get_queue_pipeline(*handlers)
+            handler.listener = listener
+
+            return [handler]
+
+        pipelines = {
+            'sync_rich': sync_rich,
+            'queued_rich': lambda: queued('rich'),
+            'queued_json': lambda: queued('json'),
+        }
+
+        for name, factory in pipelines.items():
+            logger = logging.getLogger(f'aifriend.bench.{name}')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+
+            handlers = factory()
+
+            for handler in handlers:
+                logger.addHandler(handler)
+
+            overhead = list()
+            started = time.perf_counter()
+
+            for i in range(records):
+                request_id = f'{i:08d}'
+
+                if error_every and i % error_every == error_every - 1:
+                    try:
+                        raise RuntimeError(f'Request {request_id} failed')
+                    except RuntimeError:
+                        sent = time.perf_counter()
+                        logger.exception('Prediction failed for request %s', request_id)
+                else:
+                    sent = time.perf_counter()
+                    logger.info('Request %s is processed in %.3f seconds', request_id, 0.123)
+
+                overhead.append((time.perf_counter() - sent) * 1e6)
+
+            caller = time.perf_counter() - started
+
+            for handler in handlers:
+                if listener := getattr(handler, 'listener', None):
+                    listener.stop()
+
+                logger.removeHandler(handler)
+                handler.close()
+
+            report[f'{name}_seconds'] = caller
+            report[f'{name}_drained_seconds'] = time.perf_counter() - started
+            report[name] = summarize(overhead)
+
+    return report
+
+
+def synthetic_history(seed: int, messages: int) -> List[Dict[str, Any]]:
+    """
+    Generate a deterministic chat history in the langchain messages_to_dict format.
+
+    Parameters
+    ----------
+    seed : int
+        Random seed of the history.
+    messages : int
+        The number of messages, human and AI messages alternate.
+
+    Returns
+    -------
+    List[Dict[str, Any]]:
+        Chat history.
+
+    """
+
+    texts = synthetic_conversation(seed=seed, turns=messages, min_words=5, max_words=60)
+
+    return [{'type': 'human' if i % 2 == 0 else 'ai',
+             'data': {'content': text, 'additional_kwargs': {}, 'example': False}}
+            for i, text in enumerate(texts)]
+
+
+def run_serializers(sizes: Tuple[int, ...] = (10, 25, 50, 100, 200), repeat: int = 200) -> Dict[str, Any]:
+    """
+    Compare the message sizes and the encoding and decoding times of the JSON and the compact Celery serializers
+    on task payloads with chat histories of different lengths, together with their results stored as JSON
+    whatever the task serializer. Also check that an API and a worker with different serializers
+    read each other's tasks and results.
+
+    Parameters
+    ----------
+    sizes : Tuple[int, ...], default=(10, 25, 50, 100, 200)
+        History lengths in messages.
+    repeat : int, default=200
+        The number of encodings and decodings per measurement.
+
+    Returns
+    -------
+    report : Dict[str, Any]
+        Benchmark report. Sizes are in bytes (payload and result together), times are in microseconds.
+        The mixed deployments are reported as 'ok' or with the decoding error.
+
+    Raises
+    ------
+    RuntimeError:
+        If the compact serializer is not available.
+
+    """
+
+    from celery import Celery
+    from kombu.serialization import dumps, loads, prepare_accept_content
+
+    from aifriend.app.api.backend.serialization import COMPACT_SERIALIZER, register_compact_serializer, \
+        serializer_config
+
+    if not register_compact_serializer():
+        raise RuntimeError(f"The '{COMPACT_SERIALIZER}' serializer requires msgpack and zstandard")
+
+    report = {'repeat': repeat}
+
+    for size in sizes:
+        history = synthetic_history(seed=size, messages=size)
+        payload = ((var.BENCH_WORDS[0], history[:-2]), {}, {'callbacks': None, 'errbacks': None, 'chain': None,
+                                                            'chord': None})
+        result = {'status': 'SUCCESS', 'result': (history[-1]['data']['content'], history, {'dequeued': 0.0}),
+                  'traceback': None, 'children': [], 'date_done': '2023-01-01T00:00:00', 'task_id': '0' * 36}
+
+        for name in ('json', COMPACT_SERIALIZER):
+            formats = ((payload, name), (result, serializer_config(name)['result_serializer']))
+            encoded = [dumps(value, serializer=serializer) for value, serializer in formats]
+
+            started = time.perf_counter()
+
+            for _ in range(repeat):
+                for value, serializer in formats:
+                    dumps(value, serializer=serializer)
+
+            encoding = (time.perf_counter() - started) / repeat * 1e6
+            started = time.perf_counter()
+
+            for _ in range(repeat):
+                for content_type, content_encoding, data in encoded:
+                    loads(data, content_type, content_encoding, accept={content_type})
+
+            decoding = (time.perf_counter() - started) / repeat * 1e6
+
+            report[f'{name} {size}'] = {
+                'bytes': sum(len(data) for _, _, data in encoded),
+                'encode_us': encoding,
+                'decode_us': decoding,
+            }
+
+        report[f'{COMPACT_SERIALIZER} {size}']['ratio'] = (report[f'{COMPACT_SERIALIZER} {size}']['bytes'] /
+                                                           report[f'json {size}']['bytes'])
+        report[f'json {size}']['ratio'] = 1.0
+
+    for worker, api in ((COMPACT_SERIALIZER, 'json'), ('json', COMPACT_SERIALIZER)):
+        apps = dict()
+
+        for side, name in (('worker', worker), ('api', api)):
+            apps[side] = Celery(f'AIfriend-{side}', backend='cache+memory://', set_as_current=False)
+            apps[side].conf.update(serializer_config(name))
+
+        try:
+            config = apps['api'].conf
+            content_type, content_encoding, data = dumps(payload, serializer=config.task_serializer)
+            accept = prepare_accept_content(apps['worker'].conf.accept_content)
+            loads(data, content_type, content_encoding, accept=accept)
+            apps['api'].backend.decode(apps['worker'].backend.encode(result))
+        except Exception as e:
+            report[f'{worker} worker, {api} api'] = f'{type(e).__name__}: {e}'
+        else:
+            report[f'{worker} worker, {api} api'] = 'ok'
+
+    return report
+
+
+def run_status(url: str, tasks: int = 50, repeat: int = 20, poll: float = 0.05) -> Dict[str, Any]:
+    """
+    Compare a poll cycle over many tasks made of individual status requests with a single batch status request.
+
+    Parameters
+    ----------
+    url : str
+        API url.
+    tasks : int, default=50
+        The number of tasks polled per cycle.
+    repeat : int, default=20
+        The number of poll cycles per method.
+    poll : float, default=0.05
+        Delay in seconds between two batch requests while waiting for the tasks to finish.
+
+    Returns
+    -------
+    report : Dict[str, Any]
+        Benchmark report. Poll cycle durations are in milliseconds.
+
+    """
+
+    import requests
+
+    with requests.Session() as session:
+        task_ids = [session.post(url=f'{url}/talk', json={'message': message, 'history': []}).json()['task_id']
+                    for message in synthetic_conversation(seed=tasks, turns=tasks)]
+
+        while any(task['status_code'] == HTTPStatus.PROCESSING for task in
+                  session.post(url=f'{url}/status/batch', json={'task_ids': task_ids}).json()['tasks']):
+            time.sleep(poll)
+
+        individual = list()
+        batch = list()
+
+        for _ in range(repeat):
+            started = time.perf_counter()
+
+            for task_id in task_ids:
+                session.get(url=f'{url}/status/{task_id}').json()
+
+            individual.append((time.perf_counter() - started) * 1e3)
+
+            started = time.perf_counter()
+            session.post(url=f'{url}/status/batch', json={'task_ids': task_ids}).json()
+            batch.append((time.perf_counter() - started) * 1e3)
+
+        session.post(url=f'{url}/status/batch', json={'task_ids': task_ids, 'consume': True})
+
+    return {
+        'tasks': tasks,
+        'repeat': repeat,
+        'speedup': (sum(individual) / sum(batch)) if sum(batch) else None,
+        'individual': summarize(individual),
+        'batch': summarize(batch),
+    }
+
+
+def run_overload(conversations: int = 100,
+                 turns: int = 1,
+                 concurrency: int = 64,
+                 rate: float = 10,
+                 budget: float = 2,
+                 token_delay: float = var.FAKE_TOKEN_DELAY,
+                 poll: float = 0.05,
+                 seed: int = 0
+                 ) -> Dict[str, Any]:
+    """
+    Overload the in-process stack with arrivals above its capacity twice: without admission control and with
+    load shedding on the queue wait budget, to compare the latency of the accepted requests.
+
+    Parameters
+    ----------
+    conversations : int, default=100
+        The number of conversations per run.
+    turns : int, default=1
+        The number of human messages per conversation.
+    concurrency : int, default=64
+        The maximum number of simultaneous conversations.
+    rate : float, default=10
+        Conversation arrival rate per second.
+    budget : float, default=2
+        Queue wait budget in seconds of the load shedding run.
+    token_delay : float, default=ENV(FAKE_TOKEN_DELAY) or 0.005
+        Fake model decoding time per generated token in seconds.
+    poll : float, default=0.05
+        Delay in seconds between two status requests.
+    seed : int, default=0
+        Random seed of the synthetic conversations and arrivals.
+
+    Returns
+    -------
+    report : Dict[str, Any]
+        Benchmark report with the 'unprotected' and 'shedding' runs metrics.
+
+    """
+
+    from aifriend.app.api import admission
+
+    report = {'conversations': conversations, 'rate': rate, 'budget': budget}
+    initial_budget, initial_refresh = var.QUEUE_WAIT_BUDGET, admission.wait_estimator.refresh
+
+    try:
+        with local_stack(token_delay=token_delay) as url:
+            admission.wait_estimator.refresh = min(initial_refresh, 0.2)
+
+            for name, run_budget in (('unprotected', 0), ('shedding', budget)):
+                var.QUEUE_WAIT_BUDGET = run_budget
+                run = run_load(url, conversations=conversations, turns=turns, concurrency=concurrency,
+                               rate=rate, poll=poll, seed=seed)
+
+                for key in ('throughput', 'errors', 'rejection_rate'):
+                    report[f'{name}_{key}'] = run[key]
+
+                for key in ('latency', 'queue_wait'):
+                    report[f'{name}_{key}'] = run[key]
+    finally:
+        var.QUEUE_WAIT_BUDGET = initial_budget
+        admission.wait_estimator.refresh = initial_refresh
+
+    return report
+
+
+def run_scheduling(conversations: int = 100,
+                   turns: int = 1,
+                   concurrency: int = 64,
+                   rate: float = 8,
+                   max_tokens: Tuple[int, ...] = (16, 64),
+                   wait: float = 1,
+                   token_delay: float = var.FAKE_TOKEN_DELAY,
+                   poll: float = 0.05,
+                   seed: int = 0
+                   ) -> Dict[str, Any]:
+    """
+    Load the in-process stack above its capacity with a mix of token limits four times: FIFO with fixed limits,
+    with the adaptive token limit, with shortest-job-first priorities and with both.
+
+    Parameters
+    ----------
+    conversations : int, default=100
+        The number of conversations per run.
+    turns : int, default=1
+        The number of human messages per conversation.
+    concurrency : int, default=64
+        The maximum number of simultaneous conversations.
+    rate : float, default=8
+        Conversation arrival rate per second.
+    max_tokens : Tuple[int, ...], default=(16, 64)
+        The max_new_tokens values each message picks from at random.
+    wait : float, default=1
+        Queue wait in seconds above which the adaptive runs reduce the token limit.
+    token_delay : float, default=ENV(FAKE_TOKEN_DELAY) or 0.005
+        Fake model decoding time per generated token in seconds.
+    poll : float, default=0.05
+        Delay in seconds between two status requests.
+    seed : int, default=0
+        Random seed of the synthetic conversations and arrivals.
+
+    Returns
+    -------
+    report : Dict[str, Any]
+        Benchmark report with the throughput and the latency of each run.
+
+    """
+
+    report = {'conversations': conversations, 'rate': rate, 'wait': wait}
+    initial_wait, initial_sjf = var.ADAPTIVE_TOKENS_WAIT, var.SJF_SCHEDULING
+    runs = (('fifo', 0, False), ('adaptive', wait, False), ('sjf', 0, True), ('adaptive_sjf', wait, True))
+
+    try:
+        with local_stack(token_delay=token_delay) as url:
+            for name, run_wait, run_sjf in runs:
+                var.ADAPTIVE_TOKENS_WAIT, var.SJF_SCHEDULING = run_wait, run_sjf
+                run = run_load(url, conversations=conversations, turns=turns, concurrency=concurrency,
+                               rate=rate, poll=poll, seed=seed, max_tokens=max_tokens)
+
+                report[f'{name}_throughput'] = run['throughput']
+                report[f'{name}_tokens_per_sec'] = run['tokens_per_sec']
+                report[f'{name}_errors'] = run['errors']
+
+                for key in ('latency', *(f'latency_{limit}' for limit in sorted(set(max_tokens)))):
+                    if key in run:
+                        report[f'{name}_{key}'] = run[key]
+    finally:
+        var.ADAPTIVE_TOKENS_WAIT, var.SJF_SCHEDULING = initial_wait, initial_sjf
+
+    return report
+
+
+def run_kv_quantization(model_id: str = var.MODEL_ID,
+                        prompt_tokens: int = 512,
+                        new_tokens: int = 64,
+                        bits: Tuple[int, ...] = (8, 4),
+                        repeat: int = 3,
+                        seed: int = 0
+                        ) -> Dict[str, Any]:
+    """
+    Compare the full precision attention cache with the quantized ones on a local model: memory per sequence,
+    decoding speed and divergence of the greedy outputs and of the next token distributions.
+
+    Parameters
+    ----------
+    model_id : str, default=ENV(MODEL_ID)
+        Model id or path, a tiny local model is enough to compare the modes.
+    prompt_tokens : int, default=512
+        The number of random prompt tokens, reduced to fit the model context with the new tokens.
+    new_tokens : int, default=64
+        The number of generated tokens.
+    bits : Tuple[int, ...], default=(8, 4)
+        Quantization bits to compare with the full precision.
+    repeat : int, default=3
+        The number of timed generations per mode.
+    seed : int, default=0
+        Random seed of the prompt.
+
+    Returns
+    -------
+    report : Dict[str, Any]
+        Benchmark report with the metrics of each mode: attention cache bytes per sequence and per token,
+        decoding tokens per second, the share of greedy tokens equal to the full precision ones, the position
+        of the first different token and the mean KL divergence from the full precision next token distributions
+        with the full precision tokens fed back (teacher forcing).
+
+    """
+
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    from aifriend.utils.inference import StepTimer
+    from aifriend.utils.kvcache import past_nbytes, quantized_attention
+
+    model = AutoModelForCausalLM.from_pretrained(model_id, cache_dir=var.CHECKPOINTS_DIR).eval()
+    context = getattr(model.config, 'n_positions', None) or getattr(model.config, 'max_position_embeddings', 2048)
+    prompt_tokens = max(min(prompt_tokens, context - new_tokens), 1)
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(model.config.vocab_size, (1, prompt_tokens), generator=generator).to(model.device)
+
+    report: Dict[str, Any] = {'model': model_id, 'prompt_tokens': prompt_tokens, 'new_tokens': new_tokens}
+    reference_ids, reference_logprobs = None, None
+
+    for mode_bits in (None, *bits):
+        captured = dict()
+        speeds = list()
+
+        with torch.no_grad(), quantized_attention(model, mode_bits):
+            hook = model.register_forward_hook(lambda module, args, output:
+                                               captured.update(past=output.past_key_values))
+
+            for _ in range(repeat):
+                timer = StepTimer()
+                output_ids = model.generate(input_ids, attention_mask=torch.ones_like(input_ids), do_sample=False,
+                                            max_new_tokens=new_tokens, min_new_tokens=new_tokens,
+                                            pad_token_id=model.config.eos_token_id,
+                                            stopping_criteria=[timer])
+
+                if timer.last_step > timer.first_step:
+                    speeds.append((new_tokens - 1) / (timer.last_step - timer.first_step))
+
+            hook.remove()
+            generated_ids = output_ids[0, prompt_tokens:]
+
+            if reference_ids is None:
+                reference_ids = generated_ids
+
+            outputs = model(input_ids, use_cache=True)
+            logprobs = [outputs.logits[0, -1].log_softmax(-1)]
+
+            for token_id in reference_ids[:-1]:
+                outputs = model(token_id.view(1, 1), past_key_values=outputs.past_key_values, use_cache=True)
+                logprobs.append(outputs.logits[0, -1].log_softmax(-1))
+
+            logprobs = torch.stack(logprobs).float()
+
+        if reference_logprobs is None:
+            reference_logprobs = logprobs
+
+        nbytes = past_nbytes(captured['past'])
+        matches = (generated_ids == reference_ids).tolist()
+        kl_divergence = (reference_logprobs.exp() * (reference_logprobs - logprobs)).sum(-1)
+
+        report['full' if mode_bits is None else f'int{mode_bits}'] = {
+            'cache_mib_per_sequence': nbytes / 1024 ** 2,
+            'cache_bytes_per_token': nbytes / (prompt_tokens + new_tokens - 1),
+            'tokens_per_sec': sum(speeds) / len(speeds) if speeds else None,
+            'token_agreement': sum(matches) / len(matches),
+            'first_divergence': float(matches.index(False)) if False in matches else None,
+            'kl_divergence': kl_divergence.mean().item(),
+        }
+
+    return report
+
+
+def run_prefill(model_id: str = var.MODEL_ID,
+                chunks: Tuple[int, ...] = (0, 256, 64),
+                decoders: int = 4,
+                decode_tokens: int = 128,
+                long_prompts: int = 2,
+                long_prompt_tokens: int = 2048,
+                seed: int = 0
+                ) -> Dict[str, Any]:
+    """
+    Measure how long prompts arriving in the generation engine affect the running decodes with different
+    prefill chunk sizes: a few sequences with short prompts decode while long prompts arrive one after another.
+
+    Parameters
+    ----------
+    model_id : str, default=ENV(MODEL_ID)
+        Model id or path, a tiny local model is enough to compare the chunk sizes.
+    chunks : Tuple[int, ...], default=(0, 256, 64)
+        Prefill chunk sizes to compare, zero prefills whole prompts at once.
+    decoders : int, default=4
+        The number of decoding sequences with short prompts.
+    decode_tokens : int, default=128
+        The number of tokens each decoding sequence generates.
+    long_prompts : int, default=2
+        The number of long prompts.
+    long_prompt_tokens : int, default=2048
+        The number of tokens of a long prompt, reduced to fit the model context.
+    seed : int, default=0
+        Random seed of the prompts.
+
+    Returns
+    -------
+    report : Dict[str, Any]
+        Benchmark report with the inter-token latency of the decoding sequences, the time to the first token
+        of the long prompts (milliseconds) and the generated tokens per second of each chunk size.
+
+    """
+
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    from aifriend.utils.inference import EngineSequence, GenerationEngine
+
+    model = AutoModelForCausalLM.from_pretrained(model_id, cache_dir=var.CHECKPOINTS_DIR).eval()
+    context = getattr(model.config, 'n_positions', None) or getattr(model.config, 'max_position_embeddings', 2048)
+    long_prompt_tokens = max(min(long_prompt_tokens, context - decode_tokens), 1)
+    generator = torch.Generator().manual_seed(seed)
+
+    def prompt(tokens: int) -> Dict[str, torch.Tensor]:
+        return {'input_ids': torch.randint(model.config.vocab_size, (1, tokens), generator=generator).to(model.device)}
+
+    short_inputs = [prompt(16) for _ in range(decoders)]
+    long_inputs = [prompt(long_prompt_tokens) for _ in range(long_prompts)]
+    kwargs = {'max_new_tokens': decode_tokens, 'min_new_tokens': decode_tokens}
+    report: Dict[str, Any] = {'model': model_id, 'decoders': decoders, 'long_prompt_tokens': long_prompt_tokens}
+
+    for chunk in chunks:
+        engine = GenerationEngine(model, prefill_chunk=chunk)
+        started = time.perf_counter()
+
+        try:
+            decoding = [engine.submit(EngineSequence(inputs, generation_kwargs=kwargs)) for inputs in short_inputs]
+            prefilling = list()
+
+            for inputs in long_inputs:
+                # each long prompt arrives once the running sequences have generated a few more tokens
+                mark = min(len(sequence.token_times) for sequence in decoding) + decode_tokens // (2 * long_prompts)
+
+                while min(len(sequence.token_times) for sequence in decoding) < mark and \
+                        not all(sequence.done.is_set() for sequence in decoding):
+                    time.sleep(0.001)
+
+                prefilling.append(engine.submit(EngineSequence(inputs, generation_kwargs={'max_new_tokens': 1})))
+
+            for sequence in decoding + prefilling:
+                sequence.done.wait()
+        finally:
+            engine.close()
+
+        elapsed = time.perf_counter() - started
+        gaps = [(b - a) * 1e3 for sequence in decoding for a, b in zip(sequence.token_times, sequence.token_times[1:])]
+        name = f'chunk {chunk}' if chunk else 'unchunked'
+
+        report[f'{name} tokens_per_sec'] = sum(s.generated_tokens for s in decoding + prefilling) / elapsed
+        report[f'{name} inter_token_ms'] = summarize(gaps)
+        report[f'{name} first_token_ms'] = summarize([(s.first_token_at - s.submitted_at) * 1e3 for s in prefilling])
+
+    return report
+
+
+def run_memory(turns: int = 10000,
+               queries: int = 200,
+               top_k: int = 4,
+               dim: int = 384,
+               nprobe: int = var.MEMORY_NPROBE,
+               seed: int = 0
+               ) -> Dict[str, Any]:
+    """
+    Measure the long-term memory index of a single long conversation: the insert latency of a turn,
+    the query latency of the exact and the IVF search, the recall of the IVF search and the load time.
+
+    Turn vectors are drawn around a few hundred random topics, like the turns of a long conversation
+    that keeps coming back to the same subjects, and queries are noisy copies of random turns.
+
+    Parameters
+    ----------
+    turns : int, default=10000
+        The number of indexed turns.
+    queries : int, default=200
+        The number of queries.
+    top_k : int, default=4
+        The number of results per query.
+    dim : int, default=384
+        Vector size.
+    nprobe : int, default=ENV(MEMORY_NPROBE) or 8
+        The number of clusters scored per IVF query.
+    seed : int, default=0
+        Random seed of the vectors.
+
+    Returns
+    -------
+    report : Dict[str, Any]
+        Benchmark report with the latencies (milliseconds), the recall@k of the IVF search against the exact one
+        and the index size.
+
+    """
+
+    import tempfile
+    from pathlib import Path
+
+    import numpy as np
+
+    from aifriend.utils.memory import VectorIndex, normalize
+
+    generator = np.random.default_rng(seed)
+    topics = normalize(generator.standard_normal((max(turns // 32, 1), dim)))
+    vectors = normalize(topics[generator.integers(len(topics), size=turns)] + 0.5 * generator.standard_normal(
+        (turns, dim)) / np.sqrt(dim))
+    picked = vectors[generator.integers(turns, size=queries)]
+    targets = normalize(picked + 0.5 * generator.standard_normal((queries, dim)) / np.sqrt(dim))
+    report: Dict[str, Any] = {'turns': turns, 'dim': dim, 'nprobe': nprobe}
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = VectorIndex(Path(directory), dim, nprobe=nprobe, train_threshold=min(var.MEMORY_IVF_THRESHOLD, turns))
+        inserts = list()
+
+        for position in range(turns):
+            started = time.perf_counter()
+            index.add(vectors[position:position + 1], [f'turn {position}'])
+            inserts.append((time.perf_counter() - started) * 1e3)
+
+        started = time.perf_counter()
+        index = VectorIndex(Path(directory), dim, nprobe=nprobe, train_threshold=min(var.MEMORY_IVF_THRESHOLD, turns))
+        report['load_ms'] = (time.perf_counter() - started) * 1e3
+        report['index_mb'] = sum(path.stat().st_size for path in Path(directory).iterdir()) / 2 ** 20
+
+    ivf_times, exact_times, recalls = list(), list(), list()
+    centroids = index.centroids
+
+    for query in targets:
+        started = time.perf_counter()
+        found = {position for _, position in index.search(query, top_k)}
+        ivf_times.append((time.perf_counter() - started) * 1e3)
+
+        index.centroids = None
+        started = time.perf_counter()
+        exact = {position for _, position in index.search(query, top_k)}
+        exact_times.append((time.perf_counter() - started) * 1e3)
+        index.centroids = centroids
+
+        recalls.append(len(found & exact) / max(len(exact), 1))
+
+    report['clusters'] = len(centroids) if centroids is not None else 0
+    report['insert_ms'] = summarize(inserts)
+    report['exact_query_ms'] = summarize(exact_times)
+    report['ivf_query_ms'] = summarize(ivf_times)
+    report[f'ivf recall@{top_k}'] = sum(recalls) / len(recalls) if recalls else None
+
+    return report
+
+
+def import_times(argv: List[str]) -> Dict[str, Tuple[float, int]]:
+    """
+    Run a python command with -X importtime and get the cumulative import time of each module.
+
+    Parameters
+    ----------
+    argv : List[str]
+        Python arguments after the interpreter options, e.g. ['-c', 'import aifriend'].
+
+    Returns
+    -------
+    Dict[str, Tuple[float, int]]:
+        Cumulative import times in milliseconds and import depths (0 for the imports of the command itself)
+        keyed by the module names.
+
+    """
+
+    import subprocess
+    import sys
+
+    process = subprocess.run([sys.executable, '-X', 'importtime', *argv], capture_output=True, text=True)
+    times = dict()
+
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and (columns := line[len('import time:'):].split('|'))[1].strip().isdigit():
+            times[columns[2].strip()] = (int(columns[1]) / 1e3, (len(columns[2]) - len(columns[2].lstrip()) - 1) // 2)
+
+    return times
+
+
+def run_startup(commands: Tuple[Tuple[str, ...], ...] = (('worker', 'status'), ('api', 'status'),
+                                                          ('dashboard', 'status')),
+                repeat: int = 5,
+                top: int = 10
+                ) -> Dict[str, Any]:
+    """
+    Measure the startup of the CLI: the import time of the CLI module, the heaviest modules
+    a command imports and the wall time of the commands (the status commands by default).
+
+    Parameters
+    ----------
+    commands : Tuple[Tuple[str, ...], ...], default=(('worker', 'status'), ('api', 'status'), ('dashboard', 'status'))
+        CLI commands to run.
+    repeat : int, default=5
+        The number of runs per command.
+    top : int, default=10
+        The number of the heaviest top-level imports of the first command to report.
+
+    Returns
+    -------
+    report : Dict[str, Any]
+        Benchmark report with the import times and the wall times of the commands (milliseconds).
+
+    """
+
+    import subprocess
+    import sys
+
+    cli_module = 'aifriend.app.cli.aifriendcli'
+    report: Dict[str, Any] = {'cli import_ms': import_times(['-c', f'import {cli_module}'])[cli_module][0]}
+
+    if commands:
+        times = import_times(['-m', cli_module, *commands[0]])
+        heaviest = sorted(((time_ms, module) for module, (time_ms, depth) in times.items() if depth == 0),
+                          reverse=True)[:top]
+
+        for time_ms, module in heaviest:
+            report[f"{' '.join(commands[0])} import {module}_ms"] = time_ms
+
+    for command in commands:
+        durations = list()
+
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, '-m', cli_module, *command], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            durations.append((time.perf_counter() - started) * 1e3)
+
+        report[f"{' '.join(command)} wall_ms"] = summarize(durations)
+
+    return report
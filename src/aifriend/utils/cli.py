@@ -1,16 +1,20 @@
 import os
 import platform
-import time
 from pathlib import Path
 from subprocess import Popen, STDOUT
-from typing import Optional, List, Tuple, Generator, Union
+from typing import Optional, List, Tuple, Generator, Union, Dict
 
 import psutil
 
 from aifriend.config import var, log
 
 
-def start_service(argv: List[str], name: str, logfile: Path, pidfile: Path) -> None:
+def start_service(argv: List[str],
+                  name: str,
+                  logfile: Path,
+                  pidfile: Path,
+                  env: Optional[Dict[str, str]] = None
+                  ) -> Popen:
     """
     Start service as a new process with given pid and log files.
 
@@ -24,27 +28,43 @@ def start_service(argv: List[str], name: str, logfile: Path, pidfile: Path) -> N
         Service logfile path.
     pidfile : Path
         Service pidfile path.
+    env : Optional[Dict[str, str]], default=None
+        Extra environment variables of the new process.
+
+    Returns
+    -------
+    Popen:
+        Service process.
 
     """
 
+    if env is not None:
+        env = {**os.environ, **env}
+
+    logfile.parent.mkdir(parents=True, exist_ok=True)
+
     if platform.system() == 'Windows':
         from subprocess import CREATE_NO_WINDOW
 
         process = Popen(argv, creationflags=CREATE_NO_WINDOW, stdout=logfile.open(mode='w+'), stderr=STDOUT,
-                        universal_newlines=True, start_new_session=True)
+                        universal_newlines=True, start_new_session=True, env=env)
     else:
         process = Popen(argv, stdout=logfile.open(mode='w+'), stderr=STDOUT, universal_newlines=True,
-                        start_new_session=True)
+                        start_new_session=True, env=env)
 
     with pidfile.open('w') as f:
         f.write(str(process.pid))
 
     log.project_console.print(f'The {name} service is started', style='bright_blue')
 
+    return process
+
 
-def stop_service(name: str, pidfile: Path, logfile: Path) -> None:
+def stop_service(name: str, pidfile: Path, logfile: Path, timeout: float = 0) -> None:
     """
-    Send an interrupt signal to the process with given pid.
+    Stop the process with given pid. With a timeout the process is asked to exit with SIGTERM first,
+    so that a Celery worker stops consuming and finishes its current tasks (warm shutdown),
+    and it is killed with its children only if it is still running after the timeout.
 
     Parameters
     ----------
@@ -54,6 +74,8 @@ def stop_service(name: str, pidfile: Path, logfile: Path) -> None:
         Service pidfile path.
     logfile : Path
         Service logfile path.
+    timeout : float, default=0
+        Delay in seconds given to the process to exit, 0 kills it at once.
 
     """
 
@@ -62,14 +84,26 @@ def stop_service(name: str, pidfile: Path, logfile: Path) -> None:
             pid = int(f.read())
 
         service = psutil.Process(pid=pid)
+        alive = [service]
 
-        for child_proc in service.children(recursive=True):
-            child_proc.kill()
+        if timeout > 0 and platform.system() != 'Windows':
+            service.terminate()
 
-        if platform.system() != 'Windows':
-            service.kill()
+            with log.project_console.status(f'Waiting for the {name} service to finish its tasks'):
+                _, alive = psutil.wait_procs([service], timeout=timeout)
 
-        service.wait()
+            if alive:
+                log.project_console.print(f'The {name} service is still running after {timeout:.0f} s '
+                                          'and is killed', style='yellow')
+
+        if alive:
+            for child_proc in service.children(recursive=True):
+                child_proc.kill()
+
+            if platform.system() != 'Windows':
+                service.kill()
+
+            service.wait()
 
         if logfile.exists():
             os.remove(logfile)
@@ -88,6 +122,50 @@ def stop_service(name: str, pidfile: Path, logfile: Path) -> None:
             os.remove(pidfile)
 
 
+def drain_service(pidfile: Path) -> Optional[psutil.Process]:
+    """
+    Ask the process with given pid to exit with SIGTERM without waiting for it,
+    a Celery worker stops consuming and exits once its current tasks are finished.
+
+    Parameters
+    ----------
+    pidfile : Path
+        Service pidfile path.
+
+    Returns
+    -------
+    Optional[psutil.Process]:
+        Draining process or None if it is not running.
+
+    """
+
+    try:
+        pid = int(pidfile.read_text())
+
+        if not service_alive(pid, pidfile):
+            return None
+
+        service = psutil.Process(pid)
+        service.terminate()
+
+        return service
+
+    except (OSError, ValueError, psutil.NoSuchProcess):
+        return None
+
+
+def service_alive(pid: int, pidfile: Path) -> bool:
+    """
+    Check that the process with given pid is the one that wrote the pidfile: a pid of a dead service
+    can be reused by an unrelated process started after the pidfile was written.
+    """
+
+    try:
+        return psutil.Process(pid).create_time() <= pidfile.stat().st_mtime + 1
+    except psutil.NoSuchProcess:
+        return False
+
+
 def check_service(name: str, pidfile: Path) -> None:
     """
     Display status of the process with given pid.
@@ -105,7 +183,7 @@ def check_service(name: str, pidfile: Path) -> None:
         with pidfile.open() as f:
             pid = int(f.read())
 
-        if psutil.pid_exists(pid):
+        if service_alive(pid, pidfile):
             log.project_console.print(f':rocket: The {name} status: running', style='bright_blue')
         else:
             log.project_console.print(f'The {name} status: dead', style='red')
@@ -120,10 +198,14 @@ def check_service(name: str, pidfile: Path) -> None:
 
 def stream(*services: Union[Tuple[str, Path], Tuple[Tuple[str, Path]]],
            live: bool = False,
-           period: float = 0.1
+           period: float = 0.1,
+           lines: int = 0,
+           level: Optional[str] = None,
+           pattern: Optional[str] = None
            ) -> Optional[Generator[str, None, None]]:
     """
-    Get a generator that yields the services' stdout streams.
+    Get a generator that yields the services' stdout streams. New records are awaited with inotify
+    if it is available or by polling otherwise. Rotated and truncated log files are followed.
 
     Parameters
     ----------
@@ -132,7 +214,13 @@ def stream(*services: Union[Tuple[str, Path], Tuple[Tuple[str, Path]]],
     live : bool, default=False
         Yield only new services' logs.
     period : float, default=0.1
-        Generator's delay.
+        Initial polling delay if inotify is not available.
+    lines : int, default=0
+        Start from the last lines of the logs. Takes precedence over live.
+    level : Optional[str], default=None
+        Yield only records with the level not lower than the given one.
+    pattern : Optional[str], default=None
+        Yield only lines matching the regular expression.
 
     Returns
     -------
@@ -141,40 +229,44 @@ def stream(*services: Union[Tuple[str, Path], Tuple[Tuple[str, Path]]],
 
     """
 
-    names = list()
-    streams = list()
-    alignment = 0
+    from rich.markup import escape
 
-    try:
-        for (name, log_file) in services:
-            if not log_file.exists():
-                continue
+    from aifriend.utils.follow import FileFollower, LineFilter, get_watcher
+
+    services = [(name, Path(log_file).absolute()) for (name, log_file) in services if log_file.exists()]
 
-            names.append(name)
+    if not services:
+        return None
 
-            service_stream = log_file.open()
+    alignment = max(len(name) for name, _ in services)
+    followers = [FileFollower(log_file, live=live, lines=lines) for _, log_file in services]
+    filters = [LineFilter(level=level, pattern=pattern) for _ in services]
+    watcher = get_watcher({log_file.parent for _, log_file in services}, period=period)
+    changed = None
 
-            if live:
-                service_stream.seek(0, 2)
+    try:
+        while True:
+            active = False
 
-            streams.append(service_stream)
+            for i, ((name, log_file), follower) in enumerate(zip(services, followers)):
+                if changed is not None and log_file not in changed and not follower.pending():
+                    continue
 
-            if len(name) > alignment:
-                alignment = len(name)
+                color = var.COLORS[i % len(var.COLORS)]
 
-        if not (n_services := len(names)):
-            return None
+                for record_line in follower.read():
+                    active = True
 
-        while True:
-            for i in range(n_services):
-                if record := streams[i].read().strip():
-                    color = var.COLORS[i % len(var.COLORS)]
+                    if filters[i](record_line):
+                        yield f'[{color}]{name: <{alignment}} |[/{color}] {escape(record_line)}'
 
-                    for record_line in record.split('\n'):
-                        yield f'[{color}]{names[i]: <{alignment}} |[/{color}] {record_line}'
+                active = active or follower.pending()
 
-            time.sleep(period)
+            watcher.activity(active)
+            changed = None if active else watcher.wait()
 
     finally:
-        for service_stream in streams:
-            service_stream.close()
+        watcher.close()
+
+        for follower in followers:
+            follower.close()
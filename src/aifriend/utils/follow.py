@@ -0,0 +1,352 @@
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import time
+from pathlib import Path
+from typing import BinaryIO, Iterable, List, Optional, Set
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+
+def tail_offset(file: BinaryIO, lines: int, block: int = 8192) -> int:
+    """
+    Find the offset of the last lines of a file by reading it backwards block by block.
+
+    Parameters
+    ----------
+    file : BinaryIO
+        File opened in binary mode.
+    lines : int
+        The number of last lines.
+    block : int, default=8192
+        Size of a block read at once.
+
+    Returns
+    -------
+    int:
+        Offset of the first of the last lines.
+
+    """
+
+    end = file.seek(0, os.SEEK_END)
+
+    if lines <= 0:
+        return end
+
+    # The trailing newline terminates the last line, so one more newline must be found
+    file.seek(max(end - 1, 0))
+    target = lines + (file.read(1) == b'\n')
+
+    position = end
+    newlines = 0
+
+    while position > 0:
+        size = min(block, position)
+        position -= size
+        file.seek(position)
+        chunk = file.read(size)
+        index = len(chunk)
+
+        while (index := chunk.rfind(b'\n', 0, index)) >= 0:
+            newlines += 1
+
+            if newlines == target:
+                return position + index + 1
+
+    return 0
+
+
+class FileFollower:
+    """
+    Follow a growing file that can be rotated (renamed or removed and created again) or truncated.
+
+    Parameters
+    ----------
+    path : Path
+        File path. The file may not exist yet.
+    live : bool, default=False
+        Skip the existing contents of the file.
+    lines : int, default=0
+        Start from the last lines of the existing contents. Takes precedence over live.
+
+    """
+
+    def __init__(self, path: Path, live: bool = False, lines: int = 0):
+        self.path = Path(path)
+        self.file = None
+        self.inode = None
+        self.buffer = b''
+
+        if self._open():
+            if lines > 0:
+                self.file.seek(tail_offset(self.file, lines))
+            elif live:
+                self.file.seek(0, os.SEEK_END)
+
+    def _open(self) -> bool:
+        try:
+            self.file = self.path.open(mode='rb')
+        except OSError:
+            return False
+
+        stat = os.fstat(self.file.fileno())
+        self.inode = (stat.st_dev, stat.st_ino)
+
+        return True
+
+    def _rotated(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+
+        return (stat.st_dev, stat.st_ino) != self.inode
+
+    def read(self, limit: int = 65536) -> List[str]:
+        """
+        Read complete new lines.
+
+        Parameters
+        ----------
+        limit : int, default=65536
+            The maximum number of bytes read at once, so that a single busy file does not starve the others.
+
+        Returns
+        -------
+        List[str]:
+            New lines without line endings.
+
+        """
+
+        if self.file is None and not self._open():
+            return list()
+
+        if os.fstat(self.file.fileno()).st_size < self.file.tell():
+            self.file.seek(0)
+            self.buffer = b''
+
+        data = self.file.read(limit)
+
+        if not data and self._rotated():
+            # The rest of the old file is read, switch to the new one
+            self.close()
+
+            if self.buffer:
+                lines, self.buffer = [self.buffer], b''
+                return [line.decode(errors='replace') for line in lines]
+
+            return self.read(limit) if self.path.exists() else list()
+
+        *lines, self.buffer = (self.buffer + data).split(b'\n')
+
+        return [line.rstrip(b'\r').decode(errors='replace') for line in lines]
+
+    def pending(self) -> bool:
+        """ Whether the last read hit the limit and there may be more data to read. """
+
+        if self.file is None:
+            return False
+
+        try:
+            return os.fstat(self.file.fileno()).st_size > self.file.tell()
+        except OSError:
+            return False
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class InotifyWatcher:
+    """
+    Wait for changes of the files in the given directories with Linux inotify.
+    Directories are watched instead of files to notice rotated and recreated files.
+
+    Parameters
+    ----------
+    directories : Iterable[Path]
+        Directories to watch.
+
+    Raises
+    ------
+    OSError:
+        If inotify is not available.
+
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, directories: Iterable[Path]):
+        if not hasattr(select, 'poll'):
+            raise OSError('inotify is not supported on this platform')
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not supported on this platform')
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.directories = dict()
+
+        for directory in set(Path(d).absolute() for d in directories):
+            if (wd := libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)) < 0:
+                errno = ctypes.get_errno()
+                self.close()
+                raise OSError(errno, f'inotify_add_watch failed for {directory}')
+
+            self.directories[wd] = directory
+
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Set[Path]]:
+        """
+        Block until some files change.
+
+        Parameters
+        ----------
+        timeout : Optional[float], default=None
+            The maximum waiting time in seconds, None waits forever.
+
+        Returns
+        -------
+        Optional[Set[Path]]:
+            Paths of the changed files, empty if the timeout has expired.
+
+        """
+
+        if not self.poller.poll(None if timeout is None else timeout * 1000):
+            return set()
+
+        changed = set()
+
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            offset = 0
+
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if wd in self.directories and name:
+                    changed.add(self.directories[wd] / os.fsdecode(name))
+
+        return changed
+
+    def activity(self, active: bool) -> None:
+        pass
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Fallback watcher that reports all files as possibly changed after a delay.
+    The delay grows while nothing changes, up to max_period.
+
+    Parameters
+    ----------
+    period : float, default=0.1
+        Initial delay in seconds.
+    max_period : float, default=1.0
+        The maximum delay in seconds.
+
+    """
+
+    def __init__(self, period: float = 0.1, max_period: float = 1.0):
+        self.period = period
+        self.max_period = max(max_period, period)
+        self.delay = period
+
+    def activity(self, active: bool) -> None:
+        """ Reset the delay after new data or back off after an idle check. """
+
+        self.delay = self.period if active else min(self.delay * 2, self.max_period)
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Set[Path]]:
+        time.sleep(self.delay if timeout is None else min(self.delay, timeout))
+
+        return None
+
+    def close(self) -> None:
+        pass
+
+
+def get_watcher(directories: Iterable[Path], period: float = 0.1):
+    """
+    Get the inotify watcher if it is available or the polling one otherwise.
+
+    Parameters
+    ----------
+    directories : Iterable[Path]
+        Directories to watch.
+    period : float, default=0.1
+        Initial delay of the polling watcher.
+
+    Returns
+    -------
+    Union[InotifyWatcher, PollingWatcher]:
+        Watcher instance.
+
+    """
+
+    try:
+        return InotifyWatcher(directories)
+    except (OSError, AttributeError):
+        return PollingWatcher(period=period)
+
+
+class LineFilter:
+    """
+    Keep the lines of log records with the level not lower than the given one and matching the pattern.
+    Lines without a level (e.g. traceback lines) belong to the preceding record.
+
+    Parameters
+    ----------
+    level : Optional[str], default=None
+        The minimum level name.
+    pattern : Optional[str], default=None
+        Regular expression the lines must contain.
+
+    """
+
+    def __init__(self, level: Optional[str] = None, pattern: Optional[str] = None):
+        self.levels = None
+        self.pattern = re.compile(pattern) if pattern else None
+        self.keep = True
+
+        if level:
+            self.levels = re.compile(r'\b(' + '|'.join(LEVELS) + r')\b')
+            self.allowed = set(LEVELS[LEVELS.index(level.upper()):])
+
+    def __call__(self, line: str) -> bool:
+        if self.levels is not None:
+            if found := self.levels.search(line):
+                self.keep = found.group(1) in self.allowed
+
+            if not self.keep:
+                return False
+
+        return self.pattern is None or self.pattern.search(line) is not None
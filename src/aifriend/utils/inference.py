@@ -1,23 +1,37 @@
+import hashlib
+import random
 import re
-from typing import List, Dict, Any
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Union, NamedTuple, Tuple
 
 import torch
 from langchain import PromptTemplate
 from langchain.chains import ConversationChain
 from langchain.chains.conversation.memory import ConversationBufferWindowMemory
-from langchain.llms import HuggingFacePipeline
+from langchain.llms.base import LLM
+from langchain.llms.utils import enforce_stop_tokens
 from langchain.memory.chat_message_histories.in_memory import ChatMessageHistory
-from langchain.schema import BaseOutputParser, messages_from_dict
+from langchain.schema import BaseOutputParser, Generation, LLMResult, messages_from_dict
+from pydantic import Field
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     StoppingCriteria,
     StoppingCriteriaList,
-    pipeline,
-    BitsAndBytesConfig
+    BitsAndBytesConfig,
+    LogitsProcessorList,
+    MinNewTokensLengthLogitsProcessor,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+    set_seed
 )
 
 from aifriend.config import var
+from aifriend.utils.kvcache import TieredCache, common_prefix, crop_past, quantized_attention
 
 
 class StopGenerationCriteria(StoppingCriteria):
@@ -38,6 +52,315 @@ class StopGenerationCriteria(StoppingCriteria):
         return False
 
 
+class StepTimer(StoppingCriteria):
+    """ Record the time of the first and the last generation steps without ever stopping the generation """
+
+    def __init__(self):
+        self.first_step = None
+        self.last_step = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        self.last_step = time.time()
+
+        if self.first_step is None:
+            self.first_step = self.last_step
+
+        return False
+
+
+class BatchStopCriteria(StoppingCriteria):
+    """
+    Stop a batched generation once every sequence has generated a stop sequence or the eos token,
+    and record the length of each sequence at its end.
+    """
+
+    def __init__(self, stopping_criteria: StopGenerationCriteria, eos_token_id: Optional[int], batch_size: int):
+        self.stop_token_ids = stopping_criteria.stop_token_ids
+        self.eos_token_id = eos_token_id
+        self.ends = torch.zeros(batch_size, dtype=torch.long)
+        self.reasons = [None] * batch_size
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        for row, ids in enumerate(input_ids):
+            if self.reasons[row] is not None:
+                continue
+
+            if any(torch.eq(ids[-len(stop_ids):], stop_ids).all() for stop_ids in self.stop_token_ids):
+                self.reasons[row] = "stop_sequence"
+            elif ids[-1].item() == self.eos_token_id:
+                self.reasons[row] = "eos"
+            else:
+                continue
+
+            self.ends[row] = len(ids)
+
+        return all(reason is not None for reason in self.reasons)
+
+
+class GenerationStats(NamedTuple):
+    """ Token counts and stage timestamps (seconds since the epoch) of a single generation call. """
+
+    prompt_tokens: int
+    generated_tokens: int
+    stop_reason: str
+    started_at: float
+    tokenized_at: float
+    prefilled_at: float
+    decoded_at: float
+    cached_tokens: int = 0
+
+    @property
+    def prefill_time(self) -> float:
+        """ Time to the first generated token. """
+
+        return self.prefilled_at - self.tokenized_at
+
+    @property
+    def decode_time(self) -> float:
+        """ Time spent generating tokens after the first one. """
+
+        return self.decoded_at - self.prefilled_at
+
+    @property
+    def tokens_per_sec(self) -> float:
+        """ Decoding speed excluding the prefill (the first token). """
+
+        if self.generated_tokens < 2 or self.decode_time <= 0:
+            return 0.0
+
+        return (self.generated_tokens - 1) / self.decode_time
+
+
+class EngineSequence:
+    """
+    Generation state of a single sequence in the engine.
+
+    Parameters
+    ----------
+    inputs : Dict[str, torch.Tensor]
+        Tokenizer outputs of the prompt with a batch of one.
+    past : Optional[Past], default=None
+        Attention tensors of the first prompt tokens.
+    past_length : int, default=0
+        The number of prompt tokens covered by the attention tensors.
+    generation_kwargs : Optional[Dict[str, Any]], default=None
+        The model.generate kwargs of the sequence: max_new_tokens, min_new_tokens, do_sample, temperature, top_k,
+        top_p, repetition_penalty, eos_token_id and seed, the other ones are ignored.
+    stopping_criteria : Optional[List[StoppingCriteria]], default=None
+        Criteria called after each generated token.
+
+    """
+
+    def __init__(self,
+                 inputs: Dict[str, torch.Tensor],
+                 past: Optional[Any] = None,
+                 past_length: int = 0,
+                 generation_kwargs: Optional[Dict[str, Any]] = None,
+                 stopping_criteria: Optional[List[StoppingCriteria]] = None):
+        kwargs = generation_kwargs or dict()
+        self.token_ids = inputs["input_ids"][0]
+        self.extra = {k: v for k, v in inputs.items() if k not in ("input_ids", "attention_mask")}
+        self.prompt_length = len(self.token_ids)
+        self.past = past if past_length else None
+        self.position = past_length if past is not None else 0
+        self.max_new_tokens = kwargs.get("max_new_tokens") or 20
+        self.stopping_criteria = stopping_criteria or list()
+        self.do_sample = kwargs.get("do_sample", False)
+        self.generator = None
+
+        eos_token_id = kwargs.get("eos_token_id")
+        self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]) - {None}
+
+        self.processors = LogitsProcessorList()
+
+        if (repetition_penalty := kwargs.get("repetition_penalty")) is not None and repetition_penalty != 1.0:
+            self.processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+
+        if (min_new_tokens := kwargs.get("min_new_tokens")) and self.eos_token_ids:
+            self.processors.append(MinNewTokensLengthLogitsProcessor(self.prompt_length, min_new_tokens,
+                                                                     list(self.eos_token_ids)))
+
+        if self.do_sample:
+            if (temperature := kwargs.get("temperature")) is not None and temperature != 1.0:
+                self.processors.append(TemperatureLogitsWarper(temperature))
+
+            if top_k := kwargs.get("top_k"):
+                self.processors.append(TopKLogitsWarper(top_k))
+
+            if (top_p := kwargs.get("top_p")) is not None and top_p < 1.0:
+                self.processors.append(TopPLogitsWarper(top_p))
+
+            if (seed := kwargs.get("seed")) is not None:
+                self.generator = torch.Generator(device=self.token_ids.device).manual_seed(seed)
+
+        self.submitted_at = time.time()
+        self.token_times: List[float] = list()
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+    @property
+    def generated_tokens(self) -> int:
+        return len(self.token_ids) - self.prompt_length
+
+    @property
+    def first_token_at(self) -> Optional[float]:
+        return self.token_times[0] if self.token_times else None
+
+    def forward(self, model: Any, end: int) -> torch.Tensor:
+        """ Run the tokens from the current position to the end position and get the logits of the last one. """
+
+        extra = {name: value[:, self.position:end] if end <= value.shape[1] else
+                 value[:, -1:].expand(-1, end - self.position) for name, value in self.extra.items()}
+        outputs = model(input_ids=self.token_ids[None, self.position:end], past_key_values=self.past,
+                        use_cache=True, **extra)
+        self.past, self.position = outputs.past_key_values, end
+
+        return outputs.logits[0, -1]
+
+    def sample(self, logits: torch.Tensor) -> None:
+        """ Choose the next token and check whether the generation is over. """
+
+        scores = self.processors(self.token_ids[None], logits[None].float())
+
+        if self.do_sample:
+            token_id = torch.multinomial(scores.softmax(dim=-1), num_samples=1, generator=self.generator)[0]
+        else:
+            token_id = scores.argmax(dim=-1)
+
+        self.token_ids = torch.cat([self.token_ids, token_id.to(self.token_ids.dtype)])
+        self.token_times.append(time.time())
+
+        self.finished = token_id.item() in self.eos_token_ids or self.generated_tokens >= self.max_new_tokens or \
+            any(criteria(self.token_ids[None], scores) for criteria in self.stopping_criteria)
+
+
+class GenerationEngine:
+    """
+    Generate the sequences submitted from several threads with a single model thread
+    that schedules the work per iteration (continuous batching at the iteration level):
+    every iteration decodes one token of each prefilled sequence, then prefills the waiting prompts
+    up to the chunk budget, so that a long prompt is split across iterations instead of stalling the decodes.
+
+    A larger chunk shortens the time to the first token of the new sequences, a smaller one
+    keeps the inter-token latency of the running sequences low. Zero prefills whole prompts at once.
+
+    Parameters
+    ----------
+    model : Any
+        Transformers causal language model.
+    prefill_chunk : int, default=ENV(PREFILL_CHUNK_TOKENS) or 256
+        The maximum number of prompt tokens prefilled per iteration, zero disables the chunking.
+    kv_cache_bits : Optional[int], default=None
+        Keep the attention tensors quantized to 8 or 4 bits.
+
+    """
+
+    def __init__(self, model: Any, prefill_chunk: int = var.PREFILL_CHUNK_TOKENS, kv_cache_bits: Optional[int] = None):
+        self.model = model
+        self.prefill_chunk = prefill_chunk
+        self.kv_cache_bits = kv_cache_bits
+        self.waiting: List[EngineSequence] = list()
+        self.running: List[EngineSequence] = list()
+        self.condition = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+        self.closed = False
+
+    def submit(self, sequence: EngineSequence) -> EngineSequence:
+        """ Queue a sequence, starting the model thread on the first call. """
+
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The generation engine is closed")
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="GenerationEngine", daemon=True)
+                self.thread.start()
+
+            self.waiting.append(sequence)
+            self.condition.notify()
+
+        return sequence
+
+    def generate(self, sequence: EngineSequence) -> EngineSequence:
+        """
+        Generate a sequence and wait for the end of the generation.
+
+        Parameters
+        ----------
+        sequence : EngineSequence
+            Sequence to generate.
+
+        Returns
+        -------
+        EngineSequence:
+            Generated sequence with the prompt and the generated token ids and the final attention tensors.
+
+        Raises
+        ------
+        Exception:
+            The error the model thread raised while generating the sequence.
+
+        """
+
+        self.submit(sequence).done.wait()
+
+        if sequence.error is not None:
+            raise sequence.error
+
+        return sequence
+
+    def step(self) -> None:
+        """ Run a single iteration: a decoding step of the prefilled sequences and a prefill chunk. """
+
+        budget = self.prefill_chunk or float("inf")
+
+        for sequence in self.running:
+            try:
+                if sequence.position >= sequence.prompt_length:
+                    sequence.sample(sequence.forward(self.model, len(sequence.token_ids)))
+                elif budget > 0:
+                    end = int(min(sequence.prompt_length, sequence.position + budget))
+                    budget -= end - sequence.position
+                    logits = sequence.forward(self.model, end)
+
+                    if end == sequence.prompt_length:
+                        sequence.sample(logits)
+            except Exception as e:
+                sequence.error, sequence.finished = e, True
+
+        for sequence in [sequence for sequence in self.running if sequence.finished]:
+            self.running.remove(sequence)
+            sequence.done.set()
+
+    def run(self) -> None:
+        """ Model thread loop, it ends once the engine is closed and all the sequences are generated. """
+
+        with torch.no_grad(), quantized_attention(self.model, self.kv_cache_bits):
+            while True:
+                with self.condition:
+                    while not self.waiting and not self.running and not self.closed:
+                        self.condition.wait()
+
+                    if not self.waiting and not self.running:
+                        return
+
+                    self.running.extend(self.waiting)
+                    self.waiting.clear()
+
+                self.step()
+
+    def close(self) -> None:
+        """ Reject new sequences and stop the model thread after the submitted ones. """
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+        if self.thread is not None:
+            self.thread.join()
+
+
 class CleanupOutputParser(BaseOutputParser):
     """ Helps to remove the trailing user/human/ai string from the generated output """
     def parse(self, text: str) -> str:
@@ -53,7 +376,412 @@ class CleanupOutputParser(BaseOutputParser):
         return "output_parser"
 
 
-def get_llm() -> HuggingFacePipeline:
+class FakeLLM(LLM):
+    """
+    Deterministic stand-in for the language model. The reply depends only on the prompt,
+    and the call sleeps in proportion to the prompt and reply lengths to imitate prefill and decoding.
+    """
+
+    max_new_tokens: int = 64
+    token_delay: float = var.FAKE_TOKEN_DELAY
+    prompt_token_delay: float = var.FAKE_PROMPT_TOKEN_DELAY
+
+    thread_stats: Dict[int, GenerationStats] = Field(default_factory=dict)
+
+    @property
+    def last_stats(self) -> Optional[GenerationStats]:
+        """ Statistics of the last call made by the current thread. """
+
+        return self.thread_stats.get(threading.get_ident())
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        seed = int(hashlib.sha256(prompt.encode()).hexdigest()[:16], 16) ^ kwargs.get("seed", 0)
+        generator = random.Random(seed)
+        max_new_tokens = min(kwargs.get("max_new_tokens") or self.max_new_tokens, self.max_new_tokens)
+        n_tokens = generator.randint(min(8, max_new_tokens), max_new_tokens)
+        started_at = time.time()
+        n_prompt_tokens = len(prompt.split())
+        tokenized_at = time.time()
+
+        time.sleep(self.prompt_token_delay * n_prompt_tokens + self.token_delay)
+        prefilled_at = time.time()
+
+        time.sleep(self.token_delay * (n_tokens - 1))
+
+        self.thread_stats[threading.get_ident()] = GenerationStats(
+            prompt_tokens=n_prompt_tokens,
+            generated_tokens=n_tokens,
+            stop_reason="length" if n_tokens == max_new_tokens else "eos",
+            started_at=started_at,
+            tokenized_at=tokenized_at,
+            prefilled_at=prefilled_at,
+            decoded_at=time.time()
+        )
+
+        return " ".join(generator.choice(var.BENCH_WORDS) for _ in range(n_tokens))
+
+
+class TransformersLLM(LLM):
+    """
+    Causal language model that generates text with model.generate and keeps the statistics
+    (token counts, prefill and decoding durations, stop reason) of the last call per thread.
+    The generation kwargs of a call (e.g. temperature, top_p or seed) override the default ones.
+    The calls of concurrent threads are serialized unless the generation engine interleaves them.
+
+    The 'token_segments' kwarg gives the token ids of the history messages in the prompt,
+    then only the text between them is tokenized.
+
+    With an attention cache, the attention tensors of a conversation (the 'conversation_id' kwarg)
+    are kept after the call and the next call only prefills the prompt tokens after their common prefix.
+    With 8 or 4 attention cache bits, the attention tensors are kept quantized during the generation
+    and in the attention cache (the beam search keeps the full precision).
+    """
+
+    model: Any
+    tokenizer: Any
+    stopping_criteria: Any
+    generation_kwargs: Dict[str, Any]
+    attention_cache: Optional[TieredCache] = None
+    kv_cache_bits: Optional[int] = None
+    engine: Optional[GenerationEngine] = None
+    lock: Any = Field(default_factory=threading.Lock)
+    encodings: Any = Field(default_factory=OrderedDict)
+    thread_stats: Dict[int, GenerationStats] = Field(default_factory=dict)
+
+    @property
+    def last_stats(self) -> Optional[GenerationStats]:
+        """ Statistics of the last call made by the current thread. """
+
+        return self.thread_stats.get(threading.get_ident())
+
+    @property
+    def _llm_type(self) -> str:
+        return "transformers"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+        started_at = time.time()
+        generation_kwargs = {**self.generation_kwargs, **kwargs}
+        conversation_id = generation_kwargs.pop("conversation_id", None)
+        inputs = self._tokenize(prompt, generation_kwargs.pop("token_segments", None))
+        n_prompt_tokens = inputs["input_ids"].shape[1]
+        tokenized_at = time.time()
+
+        if self.engine is not None:
+            with torch.no_grad():
+                past, cached_tokens = self._cached_past(conversation_id, inputs)
+
+            sequence = self.engine.generate(EngineSequence(inputs, past=past, past_length=cached_tokens,
+                                                           generation_kwargs=generation_kwargs,
+                                                           stopping_criteria=[self.stopping_criteria]))
+            output_ids, past, prefilled_at = sequence.token_ids[None], sequence.past, sequence.first_token_at
+        else:
+            with self.lock:
+                output_ids, past, cached_tokens, prefilled_at = self._generate_with_model(conversation_id, inputs,
+                                                                                          generation_kwargs)
+
+        decoded_at = time.time()
+
+        if self.attention_cache is not None and conversation_id is not None and past is not None:
+            # the attention tensors of the last forward pass cover all the tokens but the last generated one
+            self.attention_cache.put(conversation_id, output_ids[0][:-1], past)
+
+        generated_ids = output_ids[0][n_prompt_tokens:]
+        max_new_tokens = generation_kwargs.get("max_new_tokens")
+
+        if self.stopping_criteria(output_ids, None):
+            stop_reason = "stop_sequence"
+        elif len(generated_ids) and generated_ids[-1].item() == self.tokenizer.eos_token_id:
+            stop_reason = "eos"
+        elif len(generated_ids) == max_new_tokens:
+            stop_reason = "length"
+        else:
+            stop_reason = "other"
+
+        self.thread_stats[threading.get_ident()] = GenerationStats(prompt_tokens=n_prompt_tokens,
+                                                                   generated_tokens=len(generated_ids),
+                                                                   stop_reason=stop_reason,
+                                                                   started_at=started_at,
+                                                                   tokenized_at=tokenized_at,
+                                                                   prefilled_at=prefilled_at or decoded_at,
+                                                                   decoded_at=decoded_at,
+                                                                   cached_tokens=cached_tokens)
+
+        text = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
+
+        if stop:
+            text = enforce_stop_tokens(text, stop)
+
+        return text
+
+    def _generate(self,
+                  prompts: List[str],
+                  stop: Optional[List[str]] = None,
+                  run_manager: Any = None,
+                  **kwargs: Any
+                  ) -> LLMResult:
+        """
+        Generate several prompts as a single left-padded batch, the prompts of a conversation
+        (the 'conversation_id' or 'token_segments' kwargs) and the generation engine keep generating one by one.
+        The statistics of the call sum up the batch, the ones of each prompt are in the generation info.
+        """
+
+        if len(prompts) < 2 or self.engine is not None or "conversation_id" in kwargs or "token_segments" in kwargs:
+            result = super()._generate(prompts, stop=stop, run_manager=run_manager, **kwargs)
+
+            if len(prompts) == 1 and (stats := self.last_stats) is not None:
+                result.generations[0][0].generation_info = {"prompt_tokens": stats.prompt_tokens,
+                                                            "generated_tokens": stats.generated_tokens,
+                                                            "stop_reason": stats.stop_reason}
+
+            return result
+
+        started_at = time.time()
+        generation_kwargs = {**self.generation_kwargs, **kwargs}
+        kv_cache_bits = self.kv_cache_bits if generation_kwargs.get("num_beams", 1) == 1 else None
+        criteria = BatchStopCriteria(self.stopping_criteria, generation_kwargs.get("eos_token_id"), len(prompts))
+        step_timer = StepTimer()
+
+        with self.lock:
+            padding_side, self.tokenizer.padding_side = self.tokenizer.padding_side, "left"
+
+            try:
+                inputs = self.tokenizer(prompts, padding=True, return_tensors="pt").to(self.model.device)
+            finally:
+                self.tokenizer.padding_side = padding_side
+
+            tokenized_at = time.time()
+
+            if (seed := generation_kwargs.pop("seed", None)) is not None:
+                set_seed(seed)
+
+            with torch.no_grad(), quantized_attention(self.model, kv_cache_bits):
+                output_ids = self.model.generate(**inputs,
+                                                 **generation_kwargs,
+                                                 stopping_criteria=StoppingCriteriaList([criteria, step_timer]))
+
+        decoded_at = time.time()
+        padded_length = inputs["input_ids"].shape[1]
+        prompt_tokens = inputs["attention_mask"].sum(dim=1).tolist()
+        generations = list()
+
+        for row, reason in enumerate(criteria.reasons):
+            end = int(criteria.ends[row]) if reason is not None else output_ids.shape[1]
+            generated_ids = output_ids[row, padded_length:end]
+            text = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
+
+            if stop:
+                text = enforce_stop_tokens(text, stop)
+
+            info = {"prompt_tokens": prompt_tokens[row], "generated_tokens": len(generated_ids),
+                    "stop_reason": reason or "length"}
+            generations.append([Generation(text=text, generation_info=info)])
+
+        self.thread_stats[threading.get_ident()] = GenerationStats(
+            prompt_tokens=sum(prompt_tokens),
+            generated_tokens=sum(g[0].generation_info["generated_tokens"] for g in generations),
+            stop_reason="batch",
+            started_at=started_at,
+            tokenized_at=tokenized_at,
+            prefilled_at=step_timer.first_step or decoded_at,
+            decoded_at=decoded_at
+        )
+
+        return LLMResult(generations=generations)
+
+    def _encode(self, text: str) -> List[int]:
+        """ Tokenize a piece of the prompt, the recent pieces (e.g. the persona prompt) are cached. """
+
+        if (ids := self.encodings.get(text)) is None:
+            ids = self.tokenizer(text, add_special_tokens=False)["input_ids"]
+            self.encodings[text] = ids
+
+            if len(self.encodings) > 256:
+                self.encodings.popitem(last=False)
+
+        return ids
+
+    def _tokenize(self, prompt: str, segments: Optional[List[Tuple[str, List[int]]]] = None) -> Dict[str, torch.Tensor]:
+        """
+        Tokenize the prompt, taking the token ids of the history messages from their segments
+        and tokenizing only the text between them (the prompt template and the new message).
+        """
+
+        if not segments:
+            return self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
+
+        ids = list()
+        position = 0
+
+        for text, segment_ids in segments:
+            if (start := prompt.find(text, position)) < 0:
+                continue
+
+            ids += self._encode(prompt[position:start]) + list(segment_ids)
+            position = start + len(text)
+
+        ids += self._encode(prompt[position:])
+        input_ids = torch.tensor([self.tokenizer.build_inputs_with_special_tokens(ids)], device=self.model.device)
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+        if "token_type_ids" in self.tokenizer.model_input_names:
+            inputs["token_type_ids"] = torch.zeros_like(input_ids)
+
+        return inputs
+
+    def _cached_past(self, conversation_id: Optional[str], inputs: Dict[str, torch.Tensor]) -> Tuple[Any, int]:
+        """ Get the cached attention tensors of the longest prompt prefix but the last token and its length. """
+
+        if self.attention_cache is None or conversation_id is None:
+            return None, 0
+
+        if (cached := self.attention_cache.get(conversation_id)) is None:
+            return None, 0
+
+        cached_ids, past = cached
+        # the last prompt token is always fed to the model, which computes the first logits with it
+        cached_tokens = common_prefix(cached_ids, inputs["input_ids"][0][:-1].to("cpu"))
+
+        if not cached_tokens:
+            return None, 0
+
+        return crop_past(past, len(cached_ids), cached_tokens), cached_tokens
+
+    def _generate_with_model(self,
+                             conversation_id: Optional[str],
+                             inputs: Dict[str, torch.Tensor],
+                             generation_kwargs: Dict[str, Any]
+                             ) -> Tuple[torch.Tensor, Any, int, Optional[float]]:
+        """ Generate with model.generate, resuming from the cached attention tensors of the conversation. """
+
+        step_timer = StepTimer()
+        captured = dict()
+        hook = None
+        kv_cache_bits = self.kv_cache_bits if generation_kwargs.get("num_beams", 1) == 1 else None
+
+        if (seed := generation_kwargs.pop("seed", None)) is not None:
+            set_seed(seed)
+
+        with torch.no_grad(), quantized_attention(self.model, kv_cache_bits):
+            past, cached_tokens = self._cached_past(conversation_id, inputs)
+
+            if past is not None:
+                if cached_tokens < inputs["input_ids"].shape[1] - 1:
+                    tail = {k: v[:, cached_tokens:-1] for k, v in inputs.items() if k != "attention_mask"}
+                    past = self.model(**tail,
+                                      attention_mask=inputs["attention_mask"][:, :-1],
+                                      past_key_values=past,
+                                      use_cache=True).past_key_values
+
+                generation_kwargs["past_key_values"] = past
+
+            if self.attention_cache is not None and conversation_id is not None:
+                hook = self.model.register_forward_hook(
+                    lambda module, args, output: captured.update(past=output.past_key_values)
+                )
+
+            try:
+                output_ids = self.model.generate(
+                    **inputs,
+                    **generation_kwargs,
+                    stopping_criteria=StoppingCriteriaList([self.stopping_criteria, step_timer]),
+                )
+            finally:
+                if hook is not None:
+                    hook.remove()
+
+        return output_ids, captured.get("past"), cached_tokens, step_timer.first_step
+
+
+MESSAGE_PREFIXES = {"human": "Human", "ai": "AI", "system": "System"}
+
+
+def message_segment(message: Dict[str, Any]) -> Optional[str]:
+    """ Render a message of the history as the conversation memory puts it in the prompt. """
+
+    if (prefix := MESSAGE_PREFIXES.get(message.get("type"))) is None:
+        return None
+
+    return f"{prefix}: {message.get('data', {}).get('content', '')}"
+
+
+def valid_token_ids(ids: Any, tokenizer: Any) -> bool:
+    """
+    Check that client-supplied token ids are plain tokens of the vocabulary.
+    The tokenizer id and the segment hash only tell that the ids were made for the segment by an honest client,
+    so ids outside the vocabulary or special tokens (which could forge conversation turns) are rejected.
+    """
+
+    if not isinstance(ids, list):
+        return False
+
+    special_ids = set(tokenizer.all_special_ids)
+
+    return all(
+        isinstance(i, int) and not isinstance(i, bool) and 0 <= i < tokenizer.vocab_size and i not in special_ids
+        for i in ids
+    )
+
+
+def pretokenize_history(history: List[Dict[str, Any]],
+                        tokenizer: Any,
+                        tokenizer_id: str = var.TOKENIZER_ID
+                        ) -> List[Tuple[str, List[int]]]:
+    """
+    Attach the token ids of their prompt segments to the history messages that do not carry valid ones yet.
+    The ids are stored in 'data.additional_kwargs.tokens' with the tokenizer id and a hash of the segment,
+    so that they are recomputed if the tokenizer or the message changes. The history comes from the client,
+    so the ids are also recomputed if they are not plain tokens of the vocabulary.
+
+    Parameters
+    ----------
+    history : List[Dict[str, Any]]
+        Chat history, updated in place.
+    tokenizer : Any
+        Transformers tokenizer.
+    tokenizer_id : str, default=ENV(TOKENIZER_ID)
+        Tokenizer id recorded with the token ids.
+
+    Returns
+    -------
+    List[Tuple[str, List[int]]]:
+        Prompt segments of the messages and their token ids in the history order.
+
+    """
+
+    segments = list()
+
+    for message in history:
+        if (text := message_segment(message)) is None:
+            continue
+
+        data = message.setdefault("data", dict())
+        additional_kwargs = data.get("additional_kwargs") or dict()
+        digest = hashlib.sha1(text.encode()).hexdigest()[:16]
+        tokens = additional_kwargs.get("tokens")
+
+        if (
+            not isinstance(tokens, dict)
+            or tokens.get("tokenizer") != tokenizer_id
+            or tokens.get("hash") != digest
+            or not valid_token_ids(tokens.get("ids"), tokenizer)
+        ):
+            tokens = {"tokenizer": tokenizer_id, "hash": digest,
+                      "ids": tokenizer(text, add_special_tokens=False)["input_ids"]}
+            data["additional_kwargs"] = {**additional_kwargs, "tokens": tokens}
+
+        segments.append((text, tokens["ids"]))
+
+    return segments
+
+
+def get_llm() -> Union[TransformersLLM, FakeLLM]:
+    if var.MODEL_ID == var.FAKE_MODEL_ID:
+        return FakeLLM()
+
     if torch.cuda.is_available():
         quantization_config = BitsAndBytesConfig(
             load_in_4bit=True,
@@ -83,29 +811,47 @@ def get_llm() -> HuggingFacePipeline:
 
     model = model.eval()
     tokenizer = AutoTokenizer.from_pretrained(var.TOKENIZER_ID, cache_dir=var.CHECKPOINTS_DIR)
-    stopping_criteria = StoppingCriteriaList([StopGenerationCriteria(var.STOP_TOKENS, tokenizer, model.device)])
 
-    generation_pipeline = pipeline(
-        "text-generation",
+    if "pad_token" not in tokenizer.special_tokens_map:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    return TransformersLLM(
         model=model,
         tokenizer=tokenizer,
-        max_new_tokens=300,
-        # max_length=300,
-        do_sample=True,
-        top_k=10,
-        device_map="auto",
-        use_cache=True,
-        num_return_sequences=1,
-        eos_token_id=tokenizer.eos_token_id,
-        pad_token_id=tokenizer.eos_token_id,
-        stopping_criteria=stopping_criteria,
+        stopping_criteria=StopGenerationCriteria(var.STOP_TOKENS, tokenizer, model.device),
+        attention_cache=TieredCache() if var.ATTENTION_CACHE else None,
+        kv_cache_bits=var.KV_CACHE_BITS or None,
+        engine=GenerationEngine(model, kv_cache_bits=var.KV_CACHE_BITS or None) if var.GENERATION_ENGINE else None,
+        generation_kwargs=dict(
+            max_new_tokens=var.MAX_NEW_TOKENS,
+            do_sample=True,
+            top_k=10,
+            use_cache=True,
+            num_return_sequences=1,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.eos_token_id,
+        )
     )
 
-    return HuggingFacePipeline(pipeline=generation_pipeline)
+
+class RecallWindowMemory(ConversationBufferWindowMemory):
+    """ History window preceded by the old turns recalled from the long-term memory. """
+
+    memories: List[str] = []
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        variables = super().load_memory_variables(inputs)
+
+        if self.memories and not self.return_messages:
+            variables[self.memory_key] = "\n".join([*self.memories, variables[self.memory_key]]).strip("\n")
+
+        return variables
 
 
-def get_conversation_chain(llm: HuggingFacePipeline,
-                           history: List[Dict[str, Any]]
+def get_conversation_chain(llm: Union[TransformersLLM, FakeLLM],
+                           history: List[Dict[str, Any]],
+                           llm_kwargs: Optional[Dict[str, Any]] = None,
+                           memories: Optional[List[str]] = None
                            ) -> ConversationChain:
     prompt = PromptTemplate(input_variables=["history", "input"], template=var.INTRODUCTION_PROMPT)
 
@@ -115,10 +861,11 @@ def get_conversation_chain(llm: HuggingFacePipeline,
         elif len(history[0]) > var.FRIEND_THRESHOLD:
             prompt = PromptTemplate(input_variables=["history", "input"], template=var.FRIEND_PROMPT)
 
-    memory = ConversationBufferWindowMemory(
+    memory = RecallWindowMemory(
         chat_memory=ChatMessageHistory(messages=messages_from_dict(history)),
         memory_key="history",
         k=var.HISTORY_SIZE,
+        memories=memories or list(),
         return_only_outputs=True)
 
     return ConversationChain(
@@ -126,5 +873,6 @@ def get_conversation_chain(llm: HuggingFacePipeline,
         memory=memory,
         prompt=prompt,
         output_parser=CleanupOutputParser(),
-        verbose=True
+        llm_kwargs=llm_kwargs or dict(),
+        verbose=var.CHAIN_VERBOSE
     )
@@ -0,0 +1,606 @@
+import hashlib
+import inspect
+import os
+import shutil
+import socket
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Generator, List, Optional, Tuple, Union
+
+import numpy as np
+import psutil
+import torch
+
+from aifriend.config import var, log
+
+QUANTIZATION_BITS = (8, 4)
+PAST_ARGUMENTS = ('layer_past', 'past_key_value')
+
+
+class QuantizedTensor:
+    """
+    Attention tensor quantized to 8 or 4 bits per value with an offset and a scale per row of the last axis
+    (asymmetric round-to-nearest), two 4-bit values are packed per byte.
+
+    Parameters
+    ----------
+    tensor : torch.Tensor
+        Tensor to quantize.
+    bits : {8, 4}
+        Bits per value.
+
+    """
+
+    def __init__(self, tensor: torch.Tensor, bits: int):
+        if bits not in QUANTIZATION_BITS:
+            raise ValueError(f'Attention tensors can be quantized to {" or ".join(map(str, QUANTIZATION_BITS))} '
+                             f'bits, got {bits}')
+
+        levels = 2 ** bits - 1
+        values = tensor.detach().float()
+        low = values.amin(dim=-1, keepdim=True)
+        scale = ((values.amax(dim=-1, keepdim=True) - low) / levels).clamp_(min=1e-8)
+        data = ((values - low) / scale).round_().clamp_(0, levels).to(torch.uint8)
+
+        if bits == 4:
+            if data.shape[-1] % 2:
+                data = torch.nn.functional.pad(data, (0, 1))
+
+            data = data[..., 0::2] | (data[..., 1::2] << 4)
+
+        self.bits = bits
+        self.dtype = tensor.dtype
+        self.shape = tensor.shape
+        self.data = data
+        self.scale = scale.to(tensor.dtype)
+        self.low = low.to(tensor.dtype)
+
+    @classmethod
+    def from_components(cls, bits: int, dtype: torch.dtype, shape: Tuple[int, ...],
+                        data: torch.Tensor, scale: torch.Tensor, low: torch.Tensor) -> 'QuantizedTensor':
+        """ Rebuild a quantized tensor from the tensors returned by components. """
+
+        tensor = cls.__new__(cls)
+        tensor.bits, tensor.dtype, tensor.shape = bits, dtype, torch.Size(shape)
+        tensor.data, tensor.scale, tensor.low = data, scale, low
+
+        return tensor
+
+    def components(self) -> List[torch.Tensor]:
+        """ The packed values, the scales and the offsets. """
+
+        return [self.data, self.scale, self.low]
+
+    @property
+    def device(self) -> torch.device:
+        return self.data.device
+
+    @property
+    def nbytes(self) -> int:
+        return sum(tensor.nelement() * tensor.element_size() for tensor in self.components())
+
+    def size(self, dim: Optional[int] = None) -> Union[torch.Size, int]:
+        return self.shape if dim is None else self.shape[dim]
+
+    def dequantize(self) -> torch.Tensor:
+        """ Restore the tensor in its original dtype. """
+
+        data = self.data
+
+        if self.bits == 4:
+            data = torch.stack((data & 15, data >> 4), dim=-1).flatten(-2)[..., :self.shape[-1]]
+
+        return (data.to(self.scale.dtype) * self.scale + self.low).to(self.dtype)
+
+    def crop(self, new_length: int) -> 'QuantizedTensor':
+        """ Keep the first rows of the last but one axis. """
+
+        shape = (*self.shape[:-2], new_length, self.shape[-1])
+
+        return self.from_components(self.bits, self.dtype, shape, *(t[..., :new_length, :] for t in self.components()))
+
+
+AttentionTensor = Union[torch.Tensor, QuantizedTensor]
+Past = Tuple[Tuple[AttentionTensor, ...], ...]
+
+
+def tensor_nbytes(tensor: AttentionTensor) -> int:
+    """ The number of bytes used by an attention tensor. """
+
+    if isinstance(tensor, QuantizedTensor):
+        return tensor.nbytes
+
+    return tensor.nelement() * tensor.element_size()
+
+
+def past_nbytes(past: Past) -> int:
+    """ The number of bytes used by the attention tensors. """
+
+    return sum(tensor_nbytes(tensor) for layer in past for tensor in layer)
+
+
+def quantize_layer(layer: Tuple[AttentionTensor, ...], bits: int) -> Tuple[AttentionTensor, ...]:
+    """ Quantize the attention tensors of a layer that are not quantized yet. """
+
+    return tuple(t if isinstance(t, QuantizedTensor) else QuantizedTensor(t, bits) for t in layer)
+
+
+def dequantize_layer(layer: Tuple[AttentionTensor, ...]) -> Tuple[torch.Tensor, ...]:
+    """ Restore the quantized attention tensors of a layer. """
+
+    return tuple(t.dequantize() if isinstance(t, QuantizedTensor) else t for t in layer)
+
+
+def is_layer_past(value: Any) -> bool:
+    return isinstance(value, tuple) and len(value) > 0 and \
+        all(isinstance(t, (torch.Tensor, QuantizedTensor)) for t in value)
+
+
+@contextmanager
+def quantized_attention(model: torch.nn.Module, bits: Optional[int]) -> Generator[bool, None, None]:
+    """
+    Keep the attention cache (past key values) of the model quantized between the forward passes.
+    Each decoder layer gets its own tensors restored right before it runs and quantizes the ones it returns,
+    so that only one layer at a time holds them at full precision. Works with the greedy and sampling
+    generation, not with the beam search that reorders the cache.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Transformers model whose decoder layers take the 'layer_past' or 'past_key_value' argument.
+    bits : Optional[int]
+        Bits per value (8 or 4), None or zero keeps the full precision.
+
+    Yields
+    ------
+    bool:
+        Whether the attention cache is quantized.
+
+    Raises
+    ------
+    ValueError:
+        If the number of bits is not supported.
+
+    """
+
+    if not bits:
+        yield False
+        return
+
+    if bits not in QUANTIZATION_BITS:
+        raise ValueError(f'Attention tensors can be quantized to {" or ".join(map(str, QUANTIZATION_BITS))} '
+                         f'bits, got {bits}')
+
+    handles = list()
+    hooked: List[str] = list()
+
+    def restore(name: str, position: int):
+        def hook(module: torch.nn.Module, args: Tuple[Any, ...], kwargs: Dict[str, Any]):
+            if is_layer_past(kwargs.get(name)):
+                kwargs[name] = dequantize_layer(kwargs[name])
+            elif len(args) > position and is_layer_past(args[position]):
+                args = (*args[:position], dequantize_layer(args[position]), *args[position + 1:])
+
+            return args, kwargs
+
+        return hook
+
+    def quantize(module: torch.nn.Module, args: Tuple[Any, ...], output: Any) -> Any:
+        if isinstance(output, tuple):
+            return tuple(quantize_layer(item, bits) if is_layer_past(item) else item for item in output)
+
+        return output
+
+    for module_name, module in model.named_modules():
+        if any(module_name.startswith(f'{prefix}.') for prefix in hooked):
+            continue
+
+        parameters = list(inspect.signature(module.forward).parameters)
+
+        if (name := next((name for name in PAST_ARGUMENTS if name in parameters), None)) is None:
+            continue
+
+        hooked.append(module_name)
+        handles.append(module.register_forward_pre_hook(restore(name, parameters.index(name)), with_kwargs=True))
+        handles.append(module.register_forward_hook(quantize))
+
+    if not handles:
+        log.project_logger.warning(f'{type(model).__name__} has no decoder layers with an attention cache argument, '
+                                   f'the attention cache is not quantized')
+
+    try:
+        yield bool(handles)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+def crop_past(past: Past, length: int, new_length: int) -> Past:
+    """
+    Keep the attention tensors of the first tokens only.
+
+    Parameters
+    ----------
+    past : Past
+        Attention tensors per layer, the sequence axis is found by its length
+        (the last but one axis in most models, the last one for the keys of some of them).
+    length : int
+        The number of tokens in the attention tensors.
+    new_length : int
+        The number of tokens to keep.
+
+    Returns
+    -------
+    Past:
+        Cropped attention tensors (views of the original ones unless they are quantized along the sequence axis).
+
+    """
+
+    if new_length == length:
+        return past
+
+    def crop(tensor: AttentionTensor) -> AttentionTensor:
+        if isinstance(tensor, QuantizedTensor):
+            if tensor.shape[-2] == length:
+                return tensor.crop(new_length)
+
+            return QuantizedTensor(tensor.dequantize()[..., :new_length], tensor.bits)
+
+        if tensor.shape[-2] == length:
+            return tensor[..., :new_length, :]
+
+        return tensor[..., :new_length]
+
+    return tuple(tuple(crop(tensor) for tensor in layer) for layer in past)
+
+
+def common_prefix(a: torch.Tensor, b: torch.Tensor) -> int:
+    """ The length of the common prefix of two 1D token id tensors. """
+
+    n = min(len(a), len(b))
+    mismatch = torch.nonzero(a[:n] != b[:n])
+
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+class CacheEntry:
+    """
+    Attention tensors of a conversation and the token ids they were computed for. Depending on the tier,
+    the tensors are kept as they are (hot), as compressed bytes in host RAM (warm) or in a file (cold).
+    """
+
+    def __init__(self, token_ids: torch.Tensor, past: Past):
+        self.token_ids = token_ids
+        self.past: Optional[Past] = past
+        self.nbytes = past_nbytes(past)
+        self.device = str(past[0][0].device)
+        self.structure = [len(layer) for layer in past]
+        self.quantization = [(t.bits, t.dtype, tuple(t.shape)) if isinstance(t, QuantizedTensor) else None
+                             for layer in past for t in layer]
+        self.layout = [[(c.dtype, tuple(c.shape)) for c in self._components(t)] for layer in past for t in layer]
+        self.compressed: Optional[bytes] = None
+        self.path: Optional[Path] = None
+
+    @property
+    def tier(self) -> str:
+        return 'hot' if self.past is not None else 'warm' if self.compressed is not None else 'cold'
+
+    @property
+    def stored_bytes(self) -> int:
+        return len(self.compressed) if self.compressed is not None else self.nbytes
+
+    @staticmethod
+    def _components(tensor: AttentionTensor) -> List[torch.Tensor]:
+        return tensor.components() if isinstance(tensor, QuantizedTensor) else [tensor]
+
+    def raw(self) -> bytes:
+        """ Concatenated bytes of the tensors (the components of the quantized ones) moved to host memory. """
+
+        return b''.join(component.detach().to('cpu').contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+                        for layer in self.past for tensor in layer for component in self._components(tensor))
+
+    def restore(self, buffer: Any) -> Past:
+        """ Rebuild the tensors on their device from the bytes made by raw. """
+
+        tensors = list()
+        offset = 0
+
+        for quantization, layout in zip(self.quantization, self.layout):
+            components = list()
+
+            for dtype, shape in layout:
+                size = int(np.prod(shape)) * torch.tensor([], dtype=dtype).element_size()
+                chunk = torch.from_numpy(np.frombuffer(buffer, dtype=np.uint8, count=size, offset=offset).copy())
+                components.append(chunk.view(dtype).reshape(shape).to(self.device))
+                offset += size
+
+            tensors.append(components[0] if quantization is None
+                           else QuantizedTensor.from_components(*quantization, *components))
+
+        layers = list()
+
+        for count in self.structure:
+            layers.append(tuple(tensors[:count]))
+            tensors = tensors[count:]
+
+        return tuple(layers)
+
+
+class TieredCache:
+    """
+    Per-conversation attention cache with three tiers under byte budgets: hot entries stay in the model memory,
+    warm ones are compressed in host RAM and cold ones are written to memory-mapped files.
+    The least recently used entries are demoted in a background thread when a tier exceeds its budget,
+    and the entries evicted from the cold tier are deleted. Entries are promoted back to the hot tier on lookup,
+    which can be started ahead of time with prefetch.
+
+    Parameters
+    ----------
+    hot_bytes : int, default=ENV(ATTENTION_CACHE_HOT_BYTES) or 1 GiB
+        Budget of the tensors kept in the model memory.
+    warm_bytes : int, default=ENV(ATTENTION_CACHE_WARM_BYTES) or 4 GiB
+        Budget of the compressed tensors kept in host RAM.
+    cold_bytes : int, default=ENV(ATTENTION_CACHE_COLD_BYTES) or 32 GiB
+        Budget of the tensors kept on disk.
+    directory : Path, default=ENV(ATTENTION_CACHE_DIR) or CHECKPOINTS_DIR/attention
+        Directory of the cold tier files, each process writes them to its own '<hostname>-<pid>' subdirectory.
+
+    """
+
+    def __init__(self,
+                 hot_bytes: int = var.ATTENTION_CACHE_HOT_BYTES,
+                 warm_bytes: int = var.ATTENTION_CACHE_WARM_BYTES,
+                 cold_bytes: int = var.ATTENTION_CACHE_COLD_BYTES,
+                 directory: Path = var.ATTENTION_CACHE_DIR):
+        self.budgets = {'hot': hot_bytes, 'warm': warm_bytes, 'cold': cold_bytes}
+        self.tiers: Dict[str, 'OrderedDict[str, CacheEntry]'] = {tier: OrderedDict() for tier in self.budgets}
+        self.root = Path(directory)
+        self.directory = self.root / f'{socket.gethostname()}-{os.getpid()}'
+        self.promotions: Dict[str, Future] = dict()
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='AttentionCache')
+
+        try:
+            import zstandard
+
+            self.compress = zstandard.ZstdCompressor(level=1).compress
+            self.decompress = zstandard.ZstdDecompressor().decompress
+        except ImportError:
+            self.compress = lambda data: zlib.compress(data, 1)
+            self.decompress = zlib.decompress
+
+        self._clear_stale_directories()
+
+    def _clear_stale_directories(self) -> None:
+        """ Delete the cold tier directories left on this host by the processes that are not running anymore. """
+
+        hostname = socket.gethostname()
+
+        for path in self.root.glob(f'{hostname}-*'):
+            pid = path.name[len(hostname) + 1:]
+
+            if path == self.directory or not pid.isdigit() or not psutil.pid_exists(int(pid)):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def usage(self) -> Dict[str, Tuple[int, int]]:
+        """ The number of entries and the number of stored bytes per tier. """
+
+        with self.lock:
+            return {tier: (len(entries), sum(entry.stored_bytes for entry in entries.values()))
+                    for tier, entries in self.tiers.items()}
+
+    def _find(self, key: str) -> Optional[CacheEntry]:
+        for entries in self.tiers.values():
+            if key in entries:
+                return entries[key]
+
+        return None
+
+    def _remove(self, key: str) -> Optional[CacheEntry]:
+        for entries in self.tiers.values():
+            if key in entries:
+                return entries.pop(key)
+
+        return None
+
+    def _discard(self, key: str) -> None:
+        with self.lock:
+            entry = self._remove(key)
+
+        if entry is not None and entry.path is not None:
+            entry.path.unlink(missing_ok=True)
+
+    def _file(self, key: str) -> Path:
+        return self.directory / f'{hashlib.sha256(key.encode()).hexdigest()[:32]}.kv'
+
+    def _promote(self, key: str) -> None:
+        with self.lock:
+            entry = self._find(key)
+
+            if entry is None or entry.tier == 'hot':
+                return
+
+            tier, compressed, path = entry.tier, entry.compressed, entry.path
+
+        if tier == 'warm':
+            past = entry.restore(self.decompress(compressed))
+        else:
+            past = entry.restore(np.memmap(path, dtype=np.uint8, mode='r'))
+
+        with self.lock:
+            if self.tiers[tier].get(key) is not entry:
+                return
+
+            del self.tiers[tier][key]
+            entry.past, entry.compressed = past, None
+
+            if entry.path is not None:
+                entry.path.unlink(missing_ok=True)
+                entry.path = None
+
+            self.tiers['hot'][key] = entry
+
+        self._schedule()
+
+    def prefetch(self, key: str) -> None:
+        """ Start promoting the entry of the key to the hot tier in the background. """
+
+        with self.lock:
+            entry = self._find(key)
+
+            if entry is None or entry.tier == 'hot' or key in self.promotions:
+                return
+
+            future = self.executor.submit(self._promote, key)
+            self.promotions[key] = future
+
+        future.add_done_callback(lambda _: self.promotions.pop(key, None))
+
+    def get(self, key: str) -> Optional[Tuple[torch.Tensor, Past]]:
+        """
+        Get the attention tensors of the conversation and their token ids, promoting them to the hot tier.
+
+        Parameters
+        ----------
+        key : str
+            Conversation id.
+
+        Returns
+        -------
+        Optional[Tuple[torch.Tensor, Past]]:
+            Token ids and attention tensors or None if the conversation is not cached.
+
+        """
+
+        try:
+            if (future := self.promotions.get(key)) is not None:
+                future.result()
+
+            with self.lock:
+                entry = self._find(key)
+
+            if entry is None:
+                return None
+
+            if entry.tier != 'hot':
+                self._promote(key)
+        except Exception as e:
+            log.project_logger.warning(f'Attention cache entry could not be restored: {e}')
+            self._discard(key)
+
+            return None
+
+        with self.lock:
+            if (entry := self.tiers['hot'].get(key)) is None:
+                return None
+
+            self.tiers['hot'].move_to_end(key)
+
+            return entry.token_ids, entry.past
+
+    def put(self, key: str, token_ids: torch.Tensor, past: Past) -> None:
+        """
+        Store the attention tensors of the conversation in the hot tier.
+
+        Parameters
+        ----------
+        key : str
+            Conversation id.
+        token_ids : torch.Tensor
+            1D tensor of the token ids the attention tensors were computed for.
+        past : Past
+            Attention tensors per layer.
+
+        """
+
+        entry = CacheEntry(token_ids.detach().to('cpu'), past)
+
+        with self.lock:
+            if (previous := self._remove(key)) is not None and previous.path is not None:
+                previous.path.unlink(missing_ok=True)
+
+            self.tiers['hot'][key] = entry
+
+        self._schedule()
+
+    def _schedule(self) -> None:
+        with self.lock:
+            if any(sum(e.stored_bytes for e in self.tiers[tier].values()) > self.budgets[tier] for tier in self.tiers):
+                self.executor.submit(self._rebalance)
+
+    def _over_budget(self, tier: str) -> Optional[Tuple[str, CacheEntry]]:
+        with self.lock:
+            entries = self.tiers[tier]
+
+            if entries and sum(entry.stored_bytes for entry in entries.values()) > self.budgets[tier]:
+                return next(iter(entries.items()))
+
+        return None
+
+    def _rebalance(self) -> None:
+        try:
+            while (item := self._over_budget('hot')) is not None:
+                key, entry = item
+                compressed = self.compress(entry.raw())
+
+                with self.lock:
+                    if self.tiers['hot'].get(key) is entry:
+                        del self.tiers['hot'][key]
+                        entry.past, entry.compressed = None, compressed
+                        self.tiers['warm'][key] = entry
+
+            while (item := self._over_budget('warm')) is not None:
+                key, entry = item
+                path = self._file(key)
+                self.directory.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(self.decompress(entry.compressed))
+
+                with self.lock:
+                    if self.tiers['warm'].get(key) is entry:
+                        del self.tiers['warm'][key]
+                        entry.compressed, entry.path = None, path
+                        self.tiers['cold'][key] = entry
+                    else:
+                        path.unlink(missing_ok=True)
+
+            while (item := self._over_budget('cold')) is not None:
+                key, entry = item
+
+                with self.lock:
+                    if self.tiers['cold'].get(key) is entry:
+                        del self.tiers['cold'][key]
+
+                if entry.path is not None:
+                    entry.path.unlink(missing_ok=True)
+        except Exception as e:
+            log.project_logger.warning(f'Attention cache demotion failed: {e}')
+
+    def flush(self) -> None:
+        """ Wait for the background promotions and demotions scheduled so far. """
+
+        self.executor.submit(lambda: None).result()
+
+    def clear(self) -> None:
+        """ Drop all the entries and delete the cold tier files. """
+
+        self.flush()
+
+        with self.lock:
+            paths: List[Path] = [e.path for e in self.tiers['cold'].values() if e.path is not None]
+
+            for entries in self.tiers.values():
+                entries.clear()
+
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        """ Drop all the entries and delete the cold tier directory of the process. """
+
+        self.clear()
+        self.executor.shutdown()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,410 @@
+import hashlib
+import json
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from aifriend.config import var, log
+
+HASH_EMBEDDING_ID = 'hash'
+
+
+class HashingEmbedder:
+    """
+    Embed texts by hashing their words and word pairs into a fixed number of signed buckets.
+    Needs no model, which is enough for tests and benchmarks but only matches shared words.
+
+    Parameters
+    ----------
+    dim : int, default=384
+        Embedding size.
+
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+
+        for row, text in enumerate(texts):
+            words = re.findall(r'\w+', text.lower())
+
+            for feature in (*words, *(f'{a} {b}' for a, b in zip(words, words[1:]))):
+                digest = int.from_bytes(hashlib.md5(feature.encode()).digest()[:8], 'little')
+                vectors[row, digest % self.dim] += 1.0 if digest >> 63 else -1.0
+
+        return normalize(vectors)
+
+
+class TransformersEmbedder:
+    """
+    Embed texts with the mean of the last hidden states of a small local encoder (e.g. a sentence-transformers one).
+
+    Parameters
+    ----------
+    model_id : str
+        Model id or path.
+    batch_size : int, default=32
+        The number of texts per forward pass.
+
+    """
+
+    def __init__(self, model_id: str, batch_size: int = 32):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id, cache_dir=var.CHECKPOINTS_DIR)
+        self.model = AutoModel.from_pretrained(model_id, cache_dir=var.CHECKPOINTS_DIR).eval()
+        self.batch_size = batch_size
+        self.dim = self.model.config.hidden_size
+
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        batches = list()
+
+        for start in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(texts[start:start + self.batch_size], padding=True, truncation=True,
+                                    max_length=512, return_tensors='pt').to(self.model.device)
+            inputs.pop('token_type_ids', None)
+
+            with self.torch.no_grad():
+                hidden = self.model(**inputs).last_hidden_state
+
+            mask = inputs['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+            batches.append(((hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)).float().cpu().numpy())
+
+        return normalize(np.concatenate(batches) if batches else np.zeros((0, self.dim), dtype=np.float32))
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """ Scale the rows to the unit length, so that the dot product is the cosine similarity. """
+
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def get_embedder(model_id: str = var.MEMORY_EMBEDDING_ID) -> Any:
+    """ Get the hashing embedder for the 'hash' id or a local encoder otherwise. """
+
+    if model_id == HASH_EMBEDDING_ID:
+        return HashingEmbedder()
+
+    return TransformersEmbedder(model_id)
+
+
+def kmeans(vectors: np.ndarray, clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """ Spherical k-means centroids of unit vectors. """
+
+    generator = np.random.default_rng(seed)
+    centroids = vectors[generator.choice(len(vectors), size=clusters, replace=False)]
+
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind='stable')
+        present, starts = np.unique(assignments[order], return_index=True)
+        sums = np.zeros_like(centroids)
+        sums[present] = np.add.reduceat(vectors[order], starts, axis=0)
+        empty = ~np.any(sums, axis=1)
+        sums[empty] = vectors[generator.choice(len(vectors), size=int(empty.sum()))]
+        centroids = normalize(sums)
+
+    return centroids
+
+
+class VectorIndex:
+    """
+    Append-only vector index of a conversation with an inverted file (IVF) structure for approximate search:
+    once it holds enough vectors, they are clustered with k-means and a query only scores the vectors
+    of its nearest clusters. The clusters are trained again each time the index doubles.
+
+    Files of the index directory:
+
+    - vectors.f32: raw float32 vectors, appended on insert;
+    - turns.jsonl: texts of the vectors, appended on insert;
+    - ivf.npz: cluster centroids and the cluster of each vector, written on training.
+
+    Parameters
+    ----------
+    directory : Path
+        Index directory.
+    dim : int
+        Vector size.
+    nprobe : int, default=ENV(MEMORY_NPROBE) or 8
+        The number of clusters scored per query.
+    train_threshold : int, default=ENV(MEMORY_IVF_THRESHOLD) or 2048
+        The number of vectors from which the clusters are used, the search is exact below it.
+
+    """
+
+    def __init__(self,
+                 directory: Path,
+                 dim: int,
+                 nprobe: int = var.MEMORY_NPROBE,
+                 train_threshold: int = var.MEMORY_IVF_THRESHOLD):
+        self.directory = Path(directory)
+        self.dim = dim
+        self.nprobe = nprobe
+        self.train_threshold = train_threshold
+        self.buffer = np.zeros((0, dim), dtype=np.float32)
+        self.texts: List[str] = list()
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.trained_count = 0
+        self.load()
+
+    @property
+    def count(self) -> int:
+        return len(self.texts)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """ Vectors of the index, a view of the buffer that grows by doubling. """
+
+        return self.buffer[:self.count]
+
+    def load(self) -> None:
+        """ Read the index files if they exist, dropping a partially written tail. """
+
+        vectors_path, texts_path = self.directory / 'vectors.f32', self.directory / 'turns.jsonl'
+
+        if not vectors_path.exists() or not texts_path.exists():
+            return
+
+        vectors = np.fromfile(vectors_path, dtype=np.float32)
+        vectors = vectors[:len(vectors) // self.dim * self.dim].reshape(-1, self.dim)
+
+        with texts_path.open(encoding='utf-8') as f:
+            texts = [json.loads(line)['text'] for line in f if line.endswith('\n')]
+
+        count = min(len(vectors), len(texts))
+        self.buffer, self.texts = vectors[:count].copy(), texts[:count]
+
+        if (ivf_path := self.directory / 'ivf.npz').exists():
+            ivf = np.load(ivf_path)
+
+            if len(ivf['assignments']) <= count:
+                self.centroids, self.trained_count = ivf['centroids'], len(ivf['assignments'])
+                self.assignments = np.concatenate([ivf['assignments'], self._assign(self.vectors[self.trained_count:])])
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def train(self) -> None:
+        """ Cluster the vectors into about 4 * sqrt(count) clusters and save them. """
+
+        clusters = max(int(4 * np.sqrt(self.count)), 1)
+        generator = np.random.default_rng(self.count)
+        sample = self.vectors[generator.choice(self.count, size=min(self.count, 32 * clusters), replace=False)]
+        self.centroids = kmeans(sample, min(clusters, len(sample)))
+        self.assignments = self._assign(self.vectors)
+        self.trained_count = self.count
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        np.savez(self.directory / 'ivf.npz', centroids=self.centroids, assignments=self.assignments)
+
+    def add(self, vectors: np.ndarray, texts: List[str]) -> None:
+        """
+        Append vectors and their texts to the index and its files.
+
+        Parameters
+        ----------
+        vectors : np.ndarray
+            Unit vectors of shape (n, dim).
+        texts : List[str]
+            Texts of the vectors.
+
+        """
+
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        with (self.directory / 'vectors.f32').open('ab') as f:
+            f.write(vectors.tobytes())
+
+        with (self.directory / 'turns.jsonl').open('a', encoding='utf-8') as f:
+            f.writelines(json.dumps({'text': text}) + '\n' for text in texts)
+
+        if (size := self.count + len(vectors)) > len(self.buffer):
+            buffer = np.zeros((max(size, 2 * len(self.buffer), 64), self.dim), dtype=np.float32)
+            buffer[:self.count] = self.vectors
+            self.buffer = buffer
+
+        self.buffer[self.count:size] = vectors
+        self.texts.extend(texts)
+
+        if self.centroids is not None:
+            self.assignments = np.concatenate([self.assignments, self._assign(vectors)])
+
+        if self.count >= self.train_threshold and self.count >= 2 * self.trained_count:
+            self.train()
+
+    def search(self, query: np.ndarray, k: int) -> List[Tuple[float, int]]:
+        """
+        Find the vectors closest to the query.
+
+        Parameters
+        ----------
+        query : np.ndarray
+            Unit vector of shape (dim,).
+        k : int
+            The number of results.
+
+        Returns
+        -------
+        List[Tuple[float, int]]:
+            Cosine similarities and positions of the results, the most similar first.
+
+        """
+
+        if not self.count or k <= 0:
+            return list()
+
+        if self.centroids is None:
+            candidates = np.arange(self.count)
+        else:
+            probes = np.argsort(-(self.centroids @ query))[:self.nprobe]
+            candidates = np.flatnonzero(np.isin(self.assignments, probes))
+
+        scores = self.vectors[candidates] @ query
+        top = np.argsort(-scores)[:k]
+
+        return [(float(scores[i]), int(candidates[i])) for i in top]
+
+
+class LongTermMemory:
+    """
+    Per-conversation vector indexes of the turns that fell out of the history window, stored on disk,
+    to recall the old turns most relevant to a new message. Prompts stay bounded by the window
+    and the number of recalled turns however long the conversation gets.
+
+    The indexes are kept in sync with the chat history the client sends: the turns that are not indexed yet
+    are embedded on the next message, and an index is rebuilt if the history no longer matches it.
+
+    Parameters
+    ----------
+    directory : Path, default=ENV(MEMORY_DIR) or CHECKPOINTS_DIR/memory
+        Directory of the indexes.
+    embedder : Any, default=None
+        Callable embedding a list of texts into unit vectors, the ENV(MEMORY_EMBEDDING_ID) model if None.
+    top_k : int, default=ENV(MEMORY_TOP_K) or 4
+        The number of recalled turns.
+    max_open : int, default=64
+        The number of indexes kept in memory.
+
+    """
+
+    def __init__(self,
+                 directory: Path = var.MEMORY_DIR,
+                 embedder: Any = None,
+                 top_k: int = var.MEMORY_TOP_K,
+                 max_open: int = 64):
+        self.directory = Path(directory)
+        self.embedder = embedder or get_embedder()
+        self.top_k = top_k
+        self.max_open = max_open
+        self.indexes: Dict[str, VectorIndex] = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def turns(history: List[Dict[str, Any]]) -> List[str]:
+        """ Render the history as turns: a human message with the AI answer that follows it. """
+
+        turns, lines = list(), list()
+
+        for message in history:
+            content = message.get('data', {}).get('content', '')
+
+            if message.get('type') == 'human' and lines:
+                turns.append('\n'.join(lines))
+                lines = list()
+
+            lines.append(f"{'Human' if message.get('type') == 'human' else 'AI'}: {content}")
+
+        if lines:
+            turns.append('\n'.join(lines))
+
+        return turns
+
+    def open(self, conversation_id: str) -> VectorIndex:
+        """ Get the index of the conversation, loading it from disk if needed. """
+
+        if (index := self.indexes.get(conversation_id)) is None:
+            directory = self.directory / hashlib.sha256(conversation_id.encode()).hexdigest()[:32]
+            index = VectorIndex(directory, self.embedder.dim)
+            self.indexes[conversation_id] = index
+
+            while len(self.indexes) > self.max_open:
+                self.indexes.popitem(last=False)
+
+        self.indexes.move_to_end(conversation_id)
+
+        return index
+
+    def reset(self, conversation_id: str) -> VectorIndex:
+        """ Delete the index of the conversation and open an empty one. """
+
+        index = self.open(conversation_id)
+
+        for name in ('vectors.f32', 'turns.jsonl', 'ivf.npz'):
+            (index.directory / name).unlink(missing_ok=True)
+
+        del self.indexes[conversation_id]
+
+        return self.open(conversation_id)
+
+    def recall(self, conversation_id: str, history: List[Dict[str, Any]], message: str,
+               window: int = var.HISTORY_SIZE) -> List[str]:
+        """
+        Index the turns older than the history window and recall the ones most relevant to the message.
+
+        Parameters
+        ----------
+        conversation_id : str
+            Conversation id.
+        history : List[Dict[str, Any]]
+            Chat history.
+        message : str
+            Human message to answer.
+        window : int, default=ENV(HISTORY_SIZE) or 40
+            The number of the last message pairs the prompt keeps anyway.
+
+        Returns
+        -------
+        List[str]:
+            Recalled turns in the conversation order.
+
+        """
+
+        cut = max(len(history) - 2 * window, 0) if window > 0 else len(history)
+        old_turns = self.turns(history[:cut])
+
+        if cut < len(history) and history[cut].get('type') != 'human' and old_turns:
+            # the answer of the last old turn is still in the window, the turn is indexed once it is complete
+            old_turns.pop()
+
+        with self.lock:
+            index = self.open(conversation_id)
+
+            if index.count > len(old_turns) or index.texts != old_turns[:index.count]:
+                log.project_logger.info(f'Long-term memory of {conversation_id} does not match its history, '
+                                        f'rebuilding it')
+                index = self.reset(conversation_id)
+
+            if new_turns := old_turns[index.count:]:
+                index.add(self.embedder(new_turns), new_turns)
+
+            if not index.count:
+                return list()
+
+            results = index.search(self.embedder([message])[0], self.top_k)
+
+        return [index.texts[position] for _, position in sorted(results, key=lambda result: result[1])]
@@ -0,0 +1,151 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Generator, Optional
+
+
+class StackSampler:
+    """
+    Sampling profiler that periodically captures the Python stacks of the process threads
+    and aggregates them in the folded format understood by flamegraph tools.
+
+    Parameters
+    ----------
+    interval : float, default=0.005
+        Delay in seconds between two samples.
+    thread_id : Optional[int], default=None
+        Identifier of the only thread to sample. All threads are sampled if it is None.
+
+    """
+
+    def __init__(self, interval: float = 0.005, thread_id: Optional[int] = None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.samples = Counter()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='StackSampler', daemon=True)
+        self._ignored = {threading.get_ident()} if thread_id is None else set()
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':')
+
+    def _run(self) -> None:
+        self._ignored.add(threading.get_ident())
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in self._ignored or (self.thread_id is not None and thread_id != self.thread_id):
+                    continue
+
+                stack = list()
+
+                while frame is not None:
+                    stack.append(self._frame_label(frame))
+                    frame = frame.f_back
+
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+                stack.append(names.get(thread_id, str(thread_id)).replace(';', ':'))
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self) -> 'StackSampler':
+        """ Start sampling in a background thread. """
+
+        self._thread.start()
+
+        return self
+
+    def stop(self) -> 'StackSampler':
+        """ Stop sampling and wait for the background thread. """
+
+        self._stop.set()
+        self._thread.join()
+
+        return self
+
+    def folded(self) -> str:
+        """ Collected samples in the folded stacks format: one 'frame;frame;frame count' line per stack. """
+
+        return '\n'.join(f'{stack} {count}' for stack, count in self.samples.most_common()) + '\n'
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> str:
+    """
+    Sample the stacks of all the process threads (except the calling one) for the given time.
+
+    Parameters
+    ----------
+    seconds : float
+        Sampling duration in seconds.
+    interval : float, default=0.005
+        Delay in seconds between two samples.
+
+    Returns
+    -------
+    str:
+        Samples in the folded stacks format.
+
+    """
+
+    sampler = StackSampler(interval=interval).start()
+    time.sleep(seconds)
+
+    return sampler.stop().folded()
+
+
+@contextmanager
+def profile(path: Path, mode: str = 'sampling') -> Generator[None, None, None]:
+    """
+    Profile the code executed inside the context in the current thread and save the trace.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the trace file without a suffix. Sampling profiles get '.folded' suffix
+        (folded stacks), torch profiles get '.json' suffix (Chrome trace format).
+    mode : {'sampling', 'torch'}, default='sampling'
+        Profiler type.
+
+    Raises
+    ------
+    ValueError:
+        If the profiler type is unknown.
+
+    """
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    if mode == 'torch':
+        import torch
+        from torch.profiler import ProfilerActivity
+
+        activities = [ProfilerActivity.CPU]
+
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+
+        with torch.profiler.profile(activities=activities) as profiler:
+            yield
+
+        profiler.export_chrome_trace(str(path.with_suffix('.json')))
+
+    elif mode == 'sampling':
+        sampler = StackSampler(thread_id=threading.get_ident()).start()
+
+        try:
+            yield
+        finally:
+            path.with_suffix('.folded').write_text(sampler.stop().folded())
+
+    else:
+        raise ValueError(f"Unknown profiler type '{mode}'")
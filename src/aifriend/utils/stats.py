@@ -0,0 +1,37 @@
+import math
+from typing import Sequence
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """
+    Compute the q-th percentile of the given values using the nearest-rank method.
+
+    Parameters
+    ----------
+    values : Sequence[float]
+        Observed values.
+    q : float
+        Percentile to compute, must be between 0 and 100 inclusive.
+
+    Returns
+    -------
+    float:
+        The q-th percentile or 0.0 if there are no values.
+
+    Raises
+    ------
+    ValueError:
+        If q is out of the [0, 100] range.
+
+    """
+
+    if not 0 <= q <= 100:
+        raise ValueError(f'Percentile must be in the [0, 100] range, got {q}')
+
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+
+    return float(ordered[rank - 1])
@@ -0,0 +1,347 @@
+import json
+import math
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import psutil
+
+from aifriend.config import var, log
+
+
+class ServiceSpec(NamedTuple):
+    """ Command of a supervised service. """
+
+    name: str
+    argv: List[str]
+    logfile: Path
+    env: Optional[Dict[str, str]] = None
+    stop_timeout: float = var.SUPERVISOR_STOP_TIMEOUT
+
+
+class SupervisedProcess:
+    """
+    Process of a supervised service that is restarted with an exponential backoff when it exits unexpectedly.
+    The supervisor owns the process, so its exit is observed directly instead of guessed from a pid.
+
+    States:
+
+    - running: the process is alive;
+    - stopping: the process is asked to exit (SIGTERM) and is killed with its children after the stop timeout;
+    - backoff: the process exited unexpectedly and waits for its restart;
+    - stopped: the process is not running and is not restarted.
+
+    Parameters
+    ----------
+    spec : ServiceSpec
+        Service command.
+    backoff : float, default=ENV(SUPERVISOR_BACKOFF) or 1
+        Delay in seconds before the first restart, doubled after each quick exit.
+    max_backoff : float, default=ENV(SUPERVISOR_MAX_BACKOFF) or 60
+        Maximum delay in seconds before a restart.
+    stable_after : float, default=30
+        The number of seconds after which a running process is considered healthy and the backoff is reset.
+
+    """
+
+    def __init__(self,
+                 spec: ServiceSpec,
+                 backoff: float = var.SUPERVISOR_BACKOFF,
+                 max_backoff: float = var.SUPERVISOR_MAX_BACKOFF,
+                 stable_after: float = 30):
+        self.spec = spec
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.process: Optional[subprocess.Popen] = None
+        self.state = 'stopped'
+        self.wanted = False
+        self.failures = 0
+        self.restarts = 0
+        self.exit_code: Optional[int] = None
+        self.started_at: Optional[float] = None
+        self.stop_deadline: Optional[float] = None
+        self.restart_at: Optional[float] = None
+
+    def start(self) -> None:
+        """ Start the process, its output is appended to the service log file. """
+
+        self.spec.logfile.parent.mkdir(parents=True, exist_ok=True)
+
+        with self.spec.logfile.open(mode='a') as logfile:
+            self.process = subprocess.Popen(self.spec.argv, stdout=logfile, stderr=subprocess.STDOUT,
+                                            universal_newlines=True, start_new_session=True,
+                                            env={**os.environ, **(self.spec.env or dict())})
+
+        self.state, self.started_at, self.stop_deadline, self.restart_at = 'running', time.monotonic(), None, None
+        log.project_logger.info(f'The {self.spec.name} service is started (pid {self.process.pid})')
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Ask the process to exit and kill it if it is still alive after the timeout.
+
+        Parameters
+        ----------
+        timeout : Optional[float], default=None
+            Delay in seconds before the process is killed, the stop timeout of the service if None.
+
+        """
+
+        if self.process is None:
+            if self.state == 'backoff':
+                self.state = 'stopped'
+
+            return
+
+        if self.state != 'stopping':
+            self.process.terminate()
+
+        self.state = 'stopping'
+        self.stop_deadline = time.monotonic() + (self.spec.stop_timeout if timeout is None else timeout)
+
+    def kill(self) -> None:
+        """ Kill the process with its children. """
+
+        if self.process is None:
+            return
+
+        try:
+            for child in psutil.Process(self.process.pid).children(recursive=True):
+                child.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+        self.process.kill()
+        log.project_logger.warning(f'The {self.spec.name} service is killed after the stop timeout')
+
+    def poll(self, now: float) -> None:
+        """ Observe the process exit, kill it after the stop timeout and start it if it is wanted. """
+
+        if self.process is not None and (exit_code := self.process.poll()) is not None:
+            self.process, self.exit_code = None, exit_code
+
+            if self.state == 'stopping' or not self.wanted:
+                self.state = 'stopped'
+                log.project_logger.info(f'The {self.spec.name} service is stopped (exit code {exit_code})')
+            else:
+                self.failures = 1 if now - self.started_at >= self.stable_after else self.failures + 1
+                delay = min(self.backoff * 2 ** (self.failures - 1), self.max_backoff)
+                self.state, self.restart_at = 'backoff', now + delay
+                log.project_logger.warning(f'The {self.spec.name} service exited with code {exit_code}, '
+                                           f'restarting in {delay:.0f} s')
+
+        elif self.state == 'stopping' and now >= self.stop_deadline:
+            self.kill()
+            self.stop_deadline = math.inf
+
+        if self.wanted and (self.state == 'stopped' or self.state == 'backoff' and now >= self.restart_at):
+            self.restarts += self.state == 'backoff'
+            self.start()
+
+    def status(self, now: float) -> Dict[str, Any]:
+        """ Get the state of the process as a JSON-serializable dictionary. """
+
+        return {
+            'name': self.spec.name,
+            'state': self.state,
+            'pid': self.process.pid if self.process is not None else None,
+            'uptime': now - self.started_at if self.process is not None else None,
+            'restarts': self.restarts,
+            'exit_code': self.exit_code,
+            'restart_in': max(self.restart_at - now, 0) if self.state == 'backoff' else None,
+        }
+
+
+class Supervisor:
+    """
+    Single daemon that runs the services, restarts them with backoff and serves their status
+    and control commands over a local socket (see supervisor_request).
+
+    Commands:
+
+    - status: the state of the services;
+    - start: start the stopped services;
+    - stop: stop the services, the workers finish their current tasks first (Celery warm shutdown);
+    - restart: stop the services and start them once they have exited;
+    - shutdown: stop all the services and exit.
+
+    Parameters
+    ----------
+    specs : List[ServiceSpec]
+        Commands of the services.
+    interval : float, default=0.5
+        Delay in seconds between two observations of the processes.
+
+    """
+
+    def __init__(self, specs: List[ServiceSpec], interval: float = 0.5):
+        self.processes = {spec.name: SupervisedProcess(spec) for spec in specs}
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.shutting_down = False
+        self.stop_requested = threading.Event()
+
+    def command(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Run a control command.
+
+        Parameters
+        ----------
+        request : Dict[str, Any]
+            Command name in 'command', optional service names in 'services' (all the services if empty)
+            and an optional stop timeout in seconds in 'timeout'.
+
+        Returns
+        -------
+        Dict[str, Any]:
+            Status of the services or the error.
+
+        """
+
+        command, names, timeout = request.get('command'), request.get('services') or list(self.processes), \
+            request.get('timeout')
+
+        if unknown := [name for name in names if name not in self.processes]:
+            return {'error': f"Unknown services: {', '.join(unknown)}"}
+
+        with self.lock:
+            processes = [self.processes[name] for name in names]
+
+            if command == 'shutdown':
+                self.shutting_down = True
+                processes = list(self.processes.values())
+
+            if command in ('start', 'restart'):
+                for process in processes:
+                    process.wanted = True
+
+            if command in ('stop', 'restart', 'shutdown'):
+                for process in processes:
+                    process.wanted = command == 'restart'
+                    process.stop(timeout)
+
+            elif command not in ('status', 'start'):
+                return {'error': f"Unknown command '{command}'"}
+
+            now = time.monotonic()
+
+            return {'services': [process.status(now) for process in self.processes.values()]}
+
+    def step(self) -> bool:
+        """ Observe the processes once, returns False once the supervisor has shut down. """
+
+        if self.stop_requested.is_set() and not self.shutting_down:
+            self.command({'command': 'shutdown'})
+
+        with self.lock:
+            now = time.monotonic()
+
+            for process in self.processes.values():
+                process.poll(now)
+
+            return not self.shutting_down or any(p.process is not None for p in self.processes.values())
+
+    def run(self) -> None:
+        """ Start the services and supervise them until the shutdown command or SIGTERM. """
+
+        server = control_server(self)
+        threading.Thread(target=server.serve_forever, name='SupervisorControl', daemon=True).start()
+
+        def shutdown(signum: int, frame: Any) -> None:
+            # the main thread may hold the lock in step(), so the loop turns the flag into the shutdown command
+            self.stop_requested.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        self.command({'command': 'start'})
+
+        try:
+            while self.step():
+                time.sleep(self.interval)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+            if isinstance(server.server_address, str):
+                Path(server.server_address).unlink(missing_ok=True)
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """ Answer a single JSON line command with a JSON line. """
+
+    def handle(self) -> None:
+        try:
+            response = self.server.supervisor.command(json.loads(self.rfile.readline()))
+        except Exception as e:
+            response = {'error': str(e)}
+
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+def control_server(supervisor: Supervisor) -> socketserver.BaseServer:
+    """ Create the control server on the ENV(SUPERVISOR_SOCKET) Unix socket or on the ENV(SUPERVISOR_PORT) port. """
+
+    if hasattr(socket, 'AF_UNIX'):
+        var.SUPERVISOR_SOCKET.unlink(missing_ok=True)
+        server = socketserver.ThreadingUnixStreamServer(str(var.SUPERVISOR_SOCKET), ControlHandler)
+    else:
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', var.SUPERVISOR_PORT), ControlHandler)
+
+    server.daemon_threads = True
+    server.supervisor = supervisor
+
+    return server
+
+
+def supervisor_request(command: str,
+                       services: Optional[List[str]] = None,
+                       timeout: Optional[float] = None,
+                       connect_timeout: float = 5
+                       ) -> Optional[Dict[str, Any]]:
+    """
+    Send a control command to the running supervisor.
+
+    Parameters
+    ----------
+    command : str
+        'status', 'start', 'stop', 'restart' or 'shutdown'.
+    services : Optional[List[str]], default=None
+        Service names, all the services if None.
+    timeout : Optional[float], default=None
+        Stop timeout in seconds, the one of each service if None.
+    connect_timeout : float, default=5
+        Socket timeout in seconds.
+
+    Returns
+    -------
+    Optional[Dict[str, Any]]:
+        Supervisor response or None if the supervisor is not running.
+
+    """
+
+    try:
+        if hasattr(socket, 'AF_UNIX'):
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(connect_timeout)
+            connection.connect(str(var.SUPERVISOR_SOCKET))
+        else:
+            connection = socket.create_connection(('127.0.0.1', var.SUPERVISOR_PORT), timeout=connect_timeout)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+
+    with connection, connection.makefile('rwb') as stream:
+        try:
+            stream.write((json.dumps({'command': command, 'services': services, 'timeout': timeout}) + '\n').encode())
+            stream.flush()
+            response = stream.readline()
+        except ConnectionError:
+            return None
+
+        return json.loads(response) if response else None
@@ -0,0 +1,7 @@
+import os
+
+# the settings are read on import, so the tests use the fake model and in-memory Celery transports
+os.environ.setdefault('MODEL_ID', 'fake')
+os.environ.setdefault('CELERY_BROKER', 'memory://')
+os.environ.setdefault('CELERY_BACKEND', 'cache+memory://')
+os.environ.setdefault('WORKER_METRICS_PORT', '0')
@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import pytest
+from kombu import Producer, Queue
+
+from aifriend.app.api import admission
+from aifriend.app.api.admission import QueueWaitEstimator, RateLimiter
+from aifriend.app.api.backend import results
+from aifriend.app.api.backend.celeryapp import celery_app
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(admission, 'time', SimpleNamespace(monotonic=lambda: now.value, time=lambda: now.value))
+
+    return now
+
+
+def test_bucket_allows_burst_then_waits(clock):
+    limiter = RateLimiter(rate=2, burst=3, backend='memory')
+
+    assert [limiter.acquire('client') for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire('client') == pytest.approx(0.5)
+
+
+def test_bucket_refills_with_time(clock):
+    limiter = RateLimiter(rate=2, burst=3, backend='memory')
+
+    for _ in range(3):
+        limiter.acquire('client')
+
+    clock.value += 0.25
+    assert limiter.acquire('client') == pytest.approx(0.25)
+
+    clock.value += 0.25
+    assert limiter.acquire('client') == 0.0
+
+    clock.value += 100
+    assert [limiter.acquire('client') for _ in range(4)] == [0.0, 0.0, 0.0, pytest.approx(0.5)]
+
+
+def test_buckets_are_per_client(clock):
+    limiter = RateLimiter(rate=1, burst=1, backend='memory')
+
+    assert limiter.acquire('first') == 0.0
+    assert limiter.acquire('second') == 0.0
+    assert limiter.acquire('first') > 0
+
+
+def test_zero_rate_disables_limiter(clock):
+    limiter = RateLimiter(rate=0, burst=1, backend='memory')
+
+    assert all(limiter.acquire('client') == 0.0 for _ in range(100))
+
+
+def test_redis_buckets_are_shared(clock, monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(results, 'get_redis', lambda: client)
+    first, second = RateLimiter(rate=2, burst=2, backend='redis'), RateLimiter(rate=2, burst=2, backend='redis')
+
+    assert first.acquire('client') == 0.0
+    assert second.acquire('client') == 0.0
+    assert first.acquire('client') == pytest.approx(0.5)
+
+
+def test_redis_failure_falls_back_to_memory(clock, monkeypatch):
+    def unavailable():
+        raise ConnectionError('Redis is down')
+
+    monkeypatch.setattr(results, 'get_redis', unavailable)
+    limiter = RateLimiter(rate=1, burst=1, backend='redis')
+
+    assert limiter.acquire('client') == 0.0
+    assert limiter.acquire('client') == pytest.approx(1.0)
+
+
+def test_queue_wait_counts_model_and_direct_queues(clock, monkeypatch):
+    shared, direct = ['admission', 'admission.small', 'admission.large'], ['w1@admission.dq2']
+    estimator = QueueWaitEstimator(service_time=10, refresh=0)
+    monkeypatch.setattr(estimator, '_queues', lambda: (shared, direct))
+
+    with celery_app.connection_for_write() as connection:
+        for name, tasks in (('admission', 1), ('admission.small', 2), ('w1@admission.dq2', 3)):
+            Queue(name).bind(connection.default_channel).declare()
+
+            for _ in range(tasks):
+                Producer(connection.default_channel).publish('task', exchange='', routing_key=name)
+
+    # the missing model queue is skipped, the memory transport reports no consumers
+    assert estimator.estimate() == pytest.approx(60)
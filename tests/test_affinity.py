@@ -0,0 +1,75 @@
+from celery.utils.nodenames import worker_direct
+from kombu import Producer, Queue
+
+from aifriend.app.api.backend.affinity import HashRing, StickyRouter, conversation_key
+from aifriend.app.api.backend.celeryapp import celery_app
+
+KEYS = [f'conversation-{i}' for i in range(2000)]
+
+
+def test_empty_ring_has_no_node():
+    assert HashRing().node('conversation') is None
+
+
+def test_ring_is_deterministic():
+    first, second = HashRing(['w1', 'w2', 'w3']), HashRing(['w3', 'w1', 'w2', 'w1'])
+
+    assert first.nodes == ['w1', 'w2', 'w3']
+    assert all(first.node(key) == second.node(key) for key in KEYS)
+
+
+def test_ring_spreads_keys():
+    ring = HashRing(['w1', 'w2', 'w3', 'w4'])
+    counts = {node: sum(ring.node(key) == node for key in KEYS) for node in ring.nodes}
+
+    assert all(len(KEYS) / 8 < count < len(KEYS) / 2 for count in counts.values())
+
+
+def test_leaving_node_moves_only_its_keys():
+    before, after = HashRing(['w1', 'w2', 'w3', 'w4']), HashRing(['w1', 'w2', 'w4'])
+
+    for key in KEYS:
+        if before.node(key) != 'w3':
+            assert after.node(key) == before.node(key)
+
+
+def test_joining_node_takes_keys_only_for_itself():
+    before, after = HashRing(['w1', 'w2', 'w3']), HashRing(['w1', 'w2', 'w3', 'w4'])
+    moved = [key for key in KEYS if after.node(key) != before.node(key)]
+
+    assert moved and all(after.node(key) == 'w4' for key in moved)
+    assert len(moved) < len(KEYS) / 2
+
+
+def test_conversation_key_follows_first_human_message():
+    history = [{'type': 'human', 'data': {'content': 'hello'}}, {'type': 'ai', 'data': {'content': 'hi'}}]
+
+    assert conversation_key('hello', []) == conversation_key('how are you?', history)
+    assert conversation_key('hello', []) != conversation_key('hi', [])
+
+
+def test_departed_worker_backlog_is_handed_over(monkeypatch):
+    router = StickyRouter()
+    router.rings = {'affinity': HashRing(['w1@affinity', 'w2@affinity'])}
+    replies = {'w2@affinity': [{'name': 'affinity'}, {'name': worker_direct('w2@affinity').name}]}
+    monkeypatch.setattr(celery_app.control, 'inspect',
+                        lambda timeout: type('Inspect', (), {'active_queues': lambda self: replies})())
+
+    with celery_app.connection_for_write() as connection:
+        channel = connection.default_channel
+        direct_queue = worker_direct('w1@affinity').bind(channel)
+        direct_queue.declare()
+        producer = Producer(channel)
+        producer.publish('recorded', exchange=direct_queue.exchange, routing_key='w1@affinity',
+                         headers={'shared_queue': 'affinity.small'})
+        producer.publish('unrecorded', exchange=direct_queue.exchange, routing_key='w1@affinity')
+
+        for name in ('affinity', 'affinity.small'):
+            Queue(name).bind(channel).declare()
+
+        router.update()
+
+        assert router.rings['affinity'].nodes == ['w2@affinity']
+        assert direct_queue.get() is None
+        assert Queue('affinity.small').bind(channel).get().body == b'recorded'
+        assert Queue('affinity').bind(channel).get().body == b'unrecorded'
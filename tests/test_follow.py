@@ -0,0 +1,79 @@
+import io
+import os
+
+import pytest
+
+from aifriend.utils.follow import FileFollower, tail_offset
+
+
+@pytest.mark.parametrize('block', [1, 3, 8192])
+@pytest.mark.parametrize('data, lines, expected', [
+    (b'a\nb\nc\n', 2, b'b\nc\n'),
+    (b'a\nb\nc', 2, b'b\nc'),
+    (b'a\nb\nc\n', 5, b'a\nb\nc\n'),
+    (b'a\nb\nc\n', 0, b''),
+    (b'', 3, b''),
+    (b'\n\n\n', 1, b'\n'),
+])
+def test_tail_offset(data, lines, expected, block):
+    file = io.BytesIO(data)
+
+    assert data[tail_offset(file, lines, block=block):] == expected
+
+
+def test_follower_reads_complete_lines(tmp_path):
+    path = tmp_path / 'service.log'
+    path.write_bytes(b'first\nsec')
+    follower = FileFollower(path)
+
+    assert follower.read() == ['first']
+
+    with path.open(mode='ab') as file:
+        file.write(b'ond\r\nthird\n')
+
+    assert follower.read() == ['second', 'third']
+    assert follower.read() == []
+
+
+def test_follower_starts_from_last_lines(tmp_path):
+    path = tmp_path / 'service.log'
+    path.write_bytes(b'a\nb\nc\n')
+
+    assert FileFollower(path, lines=2).read() == ['b', 'c']
+    assert FileFollower(path, live=True).read() == []
+
+
+def test_follower_waits_for_missing_file(tmp_path):
+    path = tmp_path / 'service.log'
+    follower = FileFollower(path)
+
+    assert follower.read() == []
+
+    path.write_bytes(b'created\n')
+
+    assert follower.read() == ['created']
+
+
+def test_follower_switches_to_rotated_file(tmp_path):
+    path = tmp_path / 'service.log'
+    path.write_bytes(b'old\n')
+    follower = FileFollower(path, live=True)
+
+    with path.open(mode='ab') as file:
+        file.write(b'last old\nunterminated')
+
+    os.rename(path, tmp_path / 'service.log.1')
+    path.write_bytes(b'new\n')
+
+    assert follower.read() == ['last old']
+    assert follower.read() == ['unterminated']
+    assert follower.read() == ['new']
+
+
+def test_follower_restarts_truncated_file(tmp_path):
+    path = tmp_path / 'service.log'
+    path.write_bytes(b'a long line before truncation\n')
+    follower = FileFollower(path, live=True)
+    path.write_bytes(b'short\n')
+
+    assert follower.read() == ['short']
@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import pytest
+
+from aifriend.app.api.backend import idempotency
+from aifriend.app.api.backend.idempotency import claim, fingerprint, forget_task, release
+
+
+@pytest.fixture(params=['local', 'redis'])
+def storage(request, monkeypatch):
+    client = None
+
+    if request.param == 'redis':
+        fakeredis = pytest.importorskip('fakeredis')
+        client = fakeredis.FakeRedis()
+
+    monkeypatch.setattr(idempotency, 'get_redis', lambda: client)
+    monkeypatch.setattr(idempotency, '_local_keys', dict())
+
+    return request.param
+
+
+def test_fingerprint_depends_on_contents():
+    assert fingerprint('hi', []) == fingerprint('hi', [], {})
+    assert fingerprint('hi', []) != fingerprint('hi', [], {'temperature': 0.5})
+    assert fingerprint('hi', []) != fingerprint('hello', [])
+
+
+def test_claim_returns_first_task_to_duplicates(storage):
+    assert claim('key', 'task-1', 'request') == ('task-1', False)
+    assert claim('key', 'task-2', 'request') == ('task-1', True)
+    assert claim('other', 'task-3', 'request') == ('task-3', False)
+
+
+def test_claim_rejects_key_reused_for_other_request(storage):
+    claim('key', 'task-1', 'request')
+
+    with pytest.raises(ValueError):
+        claim('key', 'task-2', 'other request')
+
+
+def test_release_lets_retry_publish_again(storage):
+    claim('key', 'task-1', 'request')
+    release('key')
+
+    assert claim('key', 'task-2', 'request') == ('task-2', False)
+
+
+def test_forget_task_releases_its_key(storage):
+    claim('key', 'task-1', 'request')
+    forget_task('task-1')
+
+    assert claim('key', 'task-2', 'request') == ('task-2', False)
+
+
+def test_forget_task_keeps_key_claimed_again(storage):
+    claim('key', 'task-1', 'request')
+    release('key')
+    claim('key', 'task-2', 'request')
+    forget_task('task-1')
+
+    assert claim('key', 'task-3', 'request') == ('task-2', True)
+
+
+def test_local_keys_expire(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(idempotency, 'get_redis', lambda: None)
+    monkeypatch.setattr(idempotency, '_local_keys', dict())
+    monkeypatch.setattr(idempotency, 'time', SimpleNamespace(monotonic=lambda: now[0]))
+    claim('key', 'task-1', 'request', ttl=10)
+    now[0] = 11
+
+    assert claim('key', 'task-2', 'request') == ('task-2', False)
@@ -0,0 +1,75 @@
+import pytest
+from celery import states
+
+from aifriend.app.api.backend import results
+from aifriend.app.api.backend.celeryapp import celery_app
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(results, 'get_redis', lambda: client)
+
+    return client
+
+
+def store(client, task_id, status, result=None, ttl=None):
+    backend = celery_app.backend
+    value = backend.encode({'task_id': task_id, 'status': status, 'result': result})
+    client.set(backend.get_key_for_task(task_id), value, ex=ttl)
+
+
+def key(task_id):
+    return celery_app.backend.get_key_for_task(task_id)
+
+
+def test_consume_deletes_finished_result(redis):
+    store(redis, 'done', states.SUCCESS, ['hello', []])
+
+    meta = results.consume_result('done')
+
+    assert meta['status'] == states.SUCCESS and meta['result'] == ['hello', []]
+    assert not redis.exists(key('done'))
+
+
+def test_consume_restores_unfinished_state_with_its_ttl(redis):
+    store(redis, 'running', states.STARTED, ttl=100)
+
+    assert results.consume_result('running')['status'] == states.STARTED
+    assert redis.exists(key('running'))
+    assert 0 < redis.pttl(key('running')) <= 100000
+
+
+def test_consume_keeps_result_stored_meanwhile(redis, monkeypatch):
+    store(redis, 'racing', states.STARTED)
+    decode_result = celery_app.backend.decode_result
+
+    def store_result_while_decoding(value):
+        # the worker stores the result between the transaction and the restore of the unfinished state
+        store(redis, 'racing', states.SUCCESS, ['late', []])
+        return decode_result(value)
+
+    monkeypatch.setattr(celery_app.backend, 'decode_result', store_result_while_decoding)
+
+    assert results.consume_result('racing')['status'] == states.STARTED
+
+    monkeypatch.undo()
+
+    assert celery_app.backend.decode_result(redis.get(key('racing')))['status'] == states.SUCCESS
+
+
+def test_consume_unknown_task_is_pending(redis):
+    assert results.consume_result('unknown') == {'status': states.PENDING, 'result': None}
+
+
+def test_batch_consume_restores_only_unfinished(redis):
+    store(redis, 'done', states.SUCCESS, ['hello', []])
+    store(redis, 'running', states.STARTED)
+
+    metas = results.get_results(['done', 'running', 'unknown'], consume=True)
+
+    assert [meta['status'] for meta in metas] == [states.SUCCESS, states.STARTED, states.PENDING]
+    assert not redis.exists(key('done'))
+    assert redis.exists(key('running'))
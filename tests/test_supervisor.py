@@ -0,0 +1,139 @@
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+from aifriend.utils import supervisor
+from aifriend.utils.supervisor import ServiceSpec, SupervisedProcess
+
+PIDS = itertools.count(10 ** 9)
+
+
+class FakeProcess:
+    """ Stand-in for the Popen of a service that exits when told to. """
+
+    def __init__(self, argv, **kwargs):
+        self.argv = argv
+        self.pid = next(PIDS)
+        self.returncode = None
+        self.terminated = False
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        self.terminated = True
+
+    def kill(self):
+        self.returncode = -9
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=0.0)
+    monkeypatch.setattr(supervisor, 'time', SimpleNamespace(monotonic=lambda: now.value))
+    monkeypatch.setattr(supervisor, 'subprocess', SimpleNamespace(Popen=FakeProcess, STDOUT=-2))
+
+    return now
+
+
+@pytest.fixture
+def service(tmp_path, clock):
+    spec = ServiceSpec(name='worker', argv=['worker'], logfile=tmp_path / 'worker.log', stop_timeout=5)
+    service = SupervisedProcess(spec, backoff=1, max_backoff=4, stable_after=30)
+    service.wanted = True
+
+    return service
+
+
+def exit_at(service, clock, seconds, code=1):
+    clock.value = seconds
+    service.process.returncode = code
+    service.poll(clock.value)
+
+
+def test_wanted_service_is_started(service, clock):
+    service.poll(clock.value)
+
+    assert service.state == 'running' and service.process.argv == ['worker']
+
+
+def test_quick_exits_back_off_exponentially(service, clock):
+    service.poll(clock.value)
+    delays = list()
+
+    for _ in range(5):
+        exit_at(service, clock, clock.value + 1)
+        assert service.state == 'backoff'
+        delays.append(service.restart_at - clock.value)
+
+        service.poll(service.restart_at - 0.1)
+        assert service.state == 'backoff'
+
+        clock.value = service.restart_at
+        service.poll(clock.value)
+        assert service.state == 'running'
+
+    assert delays == [1, 2, 4, 4, 4]
+    assert service.restarts == 5 and service.exit_code == 1
+
+
+def test_stable_run_resets_backoff(service, clock):
+    service.poll(clock.value)
+
+    for _ in range(3):
+        exit_at(service, clock, clock.value + 1)
+        clock.value = service.restart_at
+        service.poll(clock.value)
+
+    exit_at(service, clock, clock.value + 30)
+
+    assert service.restart_at - clock.value == 1
+
+
+def test_stopped_service_is_not_restarted(service, clock):
+    service.poll(clock.value)
+    service.wanted = False
+    service.stop()
+
+    assert service.state == 'stopping' and service.process.terminated
+
+    exit_at(service, clock, 1, code=0)
+    service.poll(100)
+
+    assert service.state == 'stopped' and service.process is None and service.exit_code == 0
+
+
+def test_stuck_service_is_killed_after_stop_timeout(service, clock):
+    service.poll(clock.value)
+    service.wanted = False
+    service.stop()
+    process = service.process
+
+    service.poll(4)
+    assert process.returncode is None
+
+    service.poll(5)
+    assert process.returncode == -9
+
+    service.poll(5)
+    assert service.state == 'stopped'
+
+
+def test_stop_during_backoff_cancels_restart(service, clock):
+    service.poll(clock.value)
+    exit_at(service, clock, 1)
+    service.wanted = False
+    service.stop()
+    service.poll(100)
+
+    assert service.state == 'stopped' and service.process is None
+
+
+def test_status_reports_restart_delay(service, clock):
+    service.poll(clock.value)
+    exit_at(service, clock, 1)
+
+    status = service.status(1.5)
+
+    assert status['state'] == 'backoff' and status['pid'] is None and status['restart_in'] == 0.5